@@ -46,6 +46,32 @@ def merge(appfile, group, entitys, agent=None, databases=None):
     print('===========================')
 
 
+def plan(group, entitys, workers=None):
+    _client = client()
+    body = {'group_id': group,
+            'entitys': entitys}
+    if workers:
+        body['workers'] = workers
+    code, result, data = prepare_results(_client.merge_plan, body)
+    if code:
+        print('\033[1;31;40m')
+        print 'Fail, code %d, result %s' % (code, result)
+        if data:
+            print data
+        print('\033[0m')
+        sys.exit(1)
+    plan = data[0]
+    print('%-8s %-16s %-8s %-12s %-16s %-16s' % ('entity', 'host', 'tables', 'rows', 'datasize', 'indexsize'))
+    for info in plan['entitys']:
+        print('%-8d %-16s %-8d %-12d %-16d %-16d' % (info['entity'], info['host'], info['tables'],
+                                                   info['rows'], info['datasize'], info['indexsize']))
+    print('===========================')
+    print('total size %d, history %d' % (plan['datasize'], plan['speed']['history']))
+    print('workers %d, recommend %d' % (plan['workers'], plan['recommend']))
+    print('predict dump %ds, load %ds' % (plan['dumptime'], plan['loadtime']))
+    print('===========================')
+
+
 def continue_merge(uuid):
     _client = client()
     code, result, data = prepare_results(_client.continue_merge, uuid)
@@ -72,6 +98,7 @@ def main():
     entitys = []
     agent = None
     databases = {'gamedb': 2, 'logdb': 2}
+    # plan(group, entitys)
     merge(appfile, group, entitys, agent=agent, databases=databases)
 
     #uuid = ''
@@ -18,4 +18,24 @@ alter TABLE `groups` modify column `platfrom_id` mediumint(8) unsigned NOT NULL;
 
 alter TABLE `groups` add column `warsvr` tinyint(1) DEFAULT NULL after `platfrom_id`;
 update `groups` set `warsvr` = 0;
-alter TABLE `groups` modify column `warsvr` tinyint(1) NOT NULL;
\ No newline at end of file
+alter TABLE `groups` modify column `warsvr` tinyint(1) NOT NULL;
+
+
+alter TABLE `mergetasks` add column `metrics` blob DEFAULT NULL after `mergetime`;
+
+
+CREATE TABLE `objtypefiledeltas` (
+  `md5` char(36) NOT NULL,
+  `target` char(36) NOT NULL,
+  `base` char(36) NOT NULL,
+  `size` bigint(20) unsigned NOT NULL,
+  `resource_id` int(10) unsigned DEFAULT NULL,
+  PRIMARY KEY (`md5`),
+  UNIQUE KEY `delta_unique` (`target`,`base`),
+  KEY `base` (`base`),
+  CONSTRAINT `objtypefiledeltas_ibfk_1` FOREIGN KEY (`target`) REFERENCES `objtypefiles` (`md5`) ON DELETE CASCADE,
+  CONSTRAINT `objtypefiledeltas_ibfk_2` FOREIGN KEY (`base`) REFERENCES `objtypefiles` (`md5`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+
+alter TABLE `objtypefiles` add column `manifest` mediumblob DEFAULT NULL after `resource_id`;
@@ -14,6 +14,7 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
     objfiles_path = '/gogamechen3/objfiles'
     objfile_path = '/gogamechen3/objfiles/%s'
     objfile_path_ex = '/gogamechen3/objfiles/%s/%s'
+    objfile_delta_path = '/gogamechen3/objfiles/%s/delta/%s'
 
     groups_path = '/gogamechen3/groups'
     group_path = '/gogamechen3/groups/%s'
@@ -26,6 +27,9 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
     continue_merge_path = '/gogamechen3/merge/%s'
     finsh_merge_path = '/gogamechen3/finish/%s'
     mergeing_path = '/gogamechen3/mergeing/%s/%s'
+    merge_plan_path = '/gogamechen3/mergeplan'
+    metrics_path = '/gogamechen3/metrics'
+    profile_path = '/gogamechen3/profile'
 
     appentitys_path = '/gogamechen3/group/%s/%s/entitys'
     appentity_path = '/gogamechen3/group/%s/%s/entitys/%s'
@@ -35,6 +39,8 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
     appentitys_all_path = '/gogamechen3/entitys'
 
     all_packages_path = '/gogamechen3/packages'
+    packages_changes_path = '/gogamechen3/packages/changes'
+    serverlist_path = '/gogamechen3/serverlist'
     group_resources_path = '/gogamechen3/group/%s/resources'
     group_resource_path = '/gogamechen3/group/%s/resources/%s'
     packages_path = '/gogamechen3/group/%s/packages'
@@ -95,6 +101,41 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
                                             resone=results['result'])
         return results
 
+    def objfile_manifest(self, md5):
+        resp, results = self.get(action=self.objfile_path_ex % (md5, 'manifest'), body=None)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='get gogamechen3 objfile manifest fail:%d' % results['resultcode'],
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def objfile_deltas(self, md5):
+        resp, results = self.get(action=self.objfile_path_ex % (md5, 'delta'), body=None)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='list gogamechen3 objfile deltas fail:%d' % results['resultcode'],
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def objfile_add_delta(self, md5, base, fileinfo, body=None):
+        body = body or {}
+        body.setdefault('base', base)
+        body.setdefault('fileinfo', fileinfo)
+        resp, results = self.retryable_post(action=self.objfile_path_ex % (md5, 'delta'), body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='add gogamechen3 objfile delta fail:%d' % results['resultcode'],
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def objfile_del_delta(self, md5, delta):
+        resp, results = self.delete(action=self.objfile_delta_path % (md5, delta))
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='delete gogamechen3 objfile delta fail:%d' % results['resultcode'],
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
     # -----------group api-----------------
     def groups_index(self, body=None):
         resp, results = self.get(action=self.groups_path, body=body)
@@ -163,6 +204,18 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
                                             resone=results['result'])
         return results
 
+    def group_areachanges(self, group_id, generation=None, body=None):
+        body = body or {}
+        if generation is not None:
+            body.setdefault('generation', generation)
+        resp, results = self.get(action=self.group_path_ex % (str(group_id), 'areachanges'), body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='get gogamechen3 group areas changes fail:%d' %
+                                                    results['resultcode'],
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
     def group_packages(self, group_id, body=None):
         resp, results = self.get(action=self.group_path_ex % (str(group_id), 'packages'), body=body)
         if results['resultcode'] != common.RESULT_SUCCESS:
@@ -238,14 +291,46 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
                                             resone=results['result'])
         return results
 
-    def finish_merge(self, uuid):
-        resp, results = self.put(action=self.finsh_merge_path % uuid)
+    def finish_merge(self, uuid, body=None):
+        resp, results = self.put(action=self.finsh_merge_path % uuid, body=body)
         if results['resultcode'] != common.RESULT_SUCCESS:
             raise ServerExecuteRequestError(message='finish merge entitys fail',
                                             code=resp.status_code,
                                             resone=results['result'])
         return results
 
+    def merge_plan(self, body):
+        resp, results = self.get(action=self.merge_plan_path, body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='plan merge entitys fail',
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def metrics(self, body=None):
+        resp, results = self.get(action=self.metrics_path, body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='get taskflow metrics fail',
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def profile(self, body=None):
+        resp, results = self.get(action=self.profile_path, body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='get agent profile fail',
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def profile_reset(self, body=None):
+        resp, results = self.put(action=self.profile_path, body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='reset agent profile fail',
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
     def swallow_entity(self, entity, uuid, newentity):
         resp, results = self.post(action=self.mergeing_path % (str(entity), 'swallow'),
                                   body={'uuid': uuid, 'entity': newentity})
@@ -356,6 +441,33 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
                                             resone=results['result'])
         return results
 
+    def appentity_prepare(self, group_id, objtype, entity, body=None):
+        resp, results = self.post(action=self.appentity_path_ex % (str(group_id), objtype, str(entity), 'prepare'),
+                                  body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='prepare %s fail:%d' % (objtype, results['resultcode']),
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def appentity_commit(self, group_id, objtype, entity, body=None):
+        resp, results = self.post(action=self.appentity_path_ex % (str(group_id), objtype, str(entity), 'commit'),
+                                  body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='commit %s fail:%d' % (objtype, results['resultcode']),
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def appentity_rollback(self, group_id, objtype, entity, body=None):
+        resp, results = self.post(action=self.appentity_path_ex % (str(group_id), objtype, str(entity), 'rollback'),
+                                  body=body)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='rollback %s fail:%d' % (objtype, results['resultcode']),
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
     def appentity_flushconfig(self, group_id, objtype, entity, body=None):
         resp, results = self.put(action=self.appentity_path_ex % (str(group_id), objtype,
                                                                   str(entity), 'flushconfig'),
@@ -435,6 +547,31 @@ class Gogamechen3DBClient(GopDBClient, GopCdnClient):
                                             resone=results['result'])
         return results
 
+    def package_changes(self, generation, areas=False):
+        resp, results = self.get(action=self.packages_changes_path,
+                                 body={'generation': generation, 'areas': areas})
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='list package changes fail',
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def serverlist_show(self):
+        resp, results = self.get(action=self.serverlist_path)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='get server list fail',
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
+    def serverlist_publish(self):
+        resp, results = self.post(action=self.serverlist_path)
+        if results['resultcode'] != common.RESULT_SUCCESS:
+            raise ServerExecuteRequestError(message='publish server list fail',
+                                            code=resp.status_code,
+                                            resone=results['result'])
+        return results
+
     def package_group_resources(self, group_id):
         resp, results = self.get(action=self.group_resources_path % str(group_id))
         if results['resultcode'] != common.RESULT_SUCCESS:
@@ -0,0 +1,222 @@
+# -*- coding:utf-8 -*-
+"""
+程序文件差分包
+
+差分包为tar.gz, 第一个文件为delta.json, 记录目标程序文件的成员顺序与每个文件的md5
+内容未变化的文件从基础包取, 变化的文件用xdelta3生成补丁, 补丁不划算或者没有xdelta3时直接放入完整文件
+agent用本地已有的基础包与差分包重建目标程序文件, 重建后逐个文件校验md5
+"""
+import os
+import json
+import stat
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import subprocess
+
+from distutils.spawn import find_executable
+
+
+DELTAFILE = 'delta.json'
+# 补丁超过完整文件的比例时放入完整文件
+PATCH_RATIO = 0.8
+
+KEEP = 'keep'
+PATCH = 'patch'
+ADD = 'add'
+
+
+class DeltaError(Exception):
+    """Build or apply delta fail"""
+
+
+def xdelta3():
+    return find_executable('xdelta3')
+
+
+def filemd5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1048576)
+            if not buf:
+                break
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def archive_format(path):
+    ext = os.path.splitext(path)[1][1:]
+    return 'zip' if ext == 'zip' else 'gz'
+
+
+def _checkname(name):
+    """成员名称不能是绝对路径或者包含.."""
+    if not name or os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+        raise DeltaError('Member %s out of archive' % name)
+
+
+def _extract_tar(objtarget, dst):
+    """逐个检查并解压tar成员, 不允许链接与设备文件"""
+    members = []
+    for tarinfo in objtarget:
+        if not tarinfo.isdir() and not tarinfo.isfile():
+            raise DeltaError('Member %s not file or dir' % tarinfo.name)
+        name = tarinfo.name.rstrip('/')
+        _checkname(name)
+        if tarinfo.isdir():
+            path = os.path.join(dst, name)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        else:
+            objtarget.extract(tarinfo, dst)
+        members.append((name, tarinfo.isdir()))
+    return members
+
+
+def _extract(path, dst):
+    """逐个检查并解压, 返回成员列表[(name, isdir)], 保持压缩包中的顺序"""
+    members = []
+    if archive_format(path) == 'zip':
+        with zipfile.ZipFile(path) as objtarget:
+            for info in objtarget.infolist():
+                if stat.S_ISLNK(info.external_attr >> 16):
+                    raise DeltaError('Member %s not file or dir' % info.filename)
+                name = info.filename.rstrip('/')
+                _checkname(name)
+                objtarget.extract(info, dst)
+                members.append((name, info.filename.endswith('/')))
+    else:
+        with tarfile.open(path) as objtarget:
+            members = _extract_tar(objtarget, dst)
+    return members
+
+
+def _run(args):
+    sub = subprocess.Popen(args, close_fds=True,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = sub.communicate()
+    if sub.returncode:
+        raise DeltaError('%s fail: %s' % (' '.join(args), stderr.strip()))
+
+
+def build(base, target, output):
+    """生成base到target的差分包, 返回记录信息"""
+    executable = xdelta3()
+    tmp = tempfile.mkdtemp(prefix='gdelta-')
+    try:
+        basedir = os.path.join(tmp, 'base')
+        targetdir = os.path.join(tmp, 'target')
+        _extract(base, basedir)
+        members = _extract(target, targetdir)
+        info = dict(base=filemd5(base), target=filemd5(target),
+                    format=archive_format(target), members=[])
+        size = dict(keep=0, patch=0, add=0)
+        with tarfile.open(output, 'w:gz') as delta:
+            payloads = []
+            for name, isdir in members:
+                if isdir:
+                    info['members'].append(dict(name=name, dir=True))
+                    continue
+                path = os.path.join(targetdir, name)
+                basefile = os.path.join(basedir, name)
+                md5 = filemd5(path)
+                member = dict(name=name, md5=md5,
+                              mode=os.stat(path).st_mode & 0o7777)
+                if os.path.isfile(basefile) and filemd5(basefile) == md5:
+                    member['op'] = KEEP
+                    size[KEEP] += 1
+                else:
+                    member['op'] = ADD
+                    payload = path
+                    if executable and os.path.isfile(basefile):
+                        patch = os.path.join(tmp, 'patch', name)
+                        if not os.path.exists(os.path.dirname(patch)):
+                            os.makedirs(os.path.dirname(patch))
+                        _run([executable, '-e', '-9', '-f', '-s', basefile, path, patch])
+                        if os.path.getsize(patch) < os.path.getsize(path) * PATCH_RATIO:
+                            member['op'] = PATCH
+                            payload = patch
+                    size[member['op']] += 1
+                    payloads.append((payload, '%s/%s' % (member['op'], name)))
+                info['members'].append(member)
+            info['count'] = size
+            manifestfile = os.path.join(tmp, DELTAFILE)
+            with open(manifestfile, 'wb') as f:
+                json.dump(info, f)
+            delta.add(manifestfile, arcname=DELTAFILE)
+            for payload, arcname in payloads:
+                delta.add(payload, arcname=arcname)
+        return info
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def manifest(delta):
+    with tarfile.open(delta) as objtarget:
+        f = objtarget.extractfile(DELTAFILE)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+
+def apply(base, delta, output, basemd5=None):
+    """用基础包与差分包重建目标程序文件, 格式与目标程序文件一致"""
+    tmp = tempfile.mkdtemp(prefix='gdelta-', dir=os.path.dirname(output))
+    try:
+        basedir = os.path.join(tmp, 'base')
+        deltadir = os.path.join(tmp, 'delta')
+        targetdir = os.path.join(tmp, 'target')
+        with tarfile.open(delta) as objtarget:
+            _extract_tar(objtarget, deltadir)
+        with open(os.path.join(deltadir, DELTAFILE), 'rb') as f:
+            info = json.load(f)
+        # 成员名称会拼接到解压目录中, 使用前全部检查
+        for member in info['members']:
+            _checkname(member['name'])
+        if (basemd5 or filemd5(base)) != info['base']:
+            raise DeltaError('Base file md5 not match delta')
+        _extract(base, basedir)
+        executable = None
+        for member in info['members']:
+            name = member['name']
+            path = os.path.join(targetdir, name)
+            if member.get('dir'):
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                continue
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            op = member['op']
+            if op == KEEP:
+                shutil.copy2(os.path.join(basedir, name), path)
+            elif op == ADD:
+                shutil.copy2(os.path.join(deltadir, ADD, name), path)
+            elif op == PATCH:
+                executable = executable or xdelta3()
+                if not executable:
+                    raise DeltaError('xdelta3 not found')
+                _run([executable, '-d', '-f', '-s', os.path.join(basedir, name),
+                      os.path.join(deltadir, PATCH, name), path])
+            else:
+                raise DeltaError('Delta member op %s unknown' % op)
+            os.chmod(path, member['mode'])
+            if filemd5(path) != member['md5']:
+                raise DeltaError('Rebuild %s md5 not match' % name)
+        tmpout = os.path.join(tmp, os.path.basename(output))
+        if info['format'] == 'zip':
+            with zipfile.ZipFile(tmpout, 'w', zipfile.ZIP_DEFLATED) as objtarget:
+                for member in info['members']:
+                    objtarget.write(os.path.join(targetdir, member['name']), arcname=member['name'])
+        else:
+            with tarfile.open(tmpout, 'w:gz') as objtarget:
+                for member in info['members']:
+                    objtarget.add(os.path.join(targetdir, member['name']),
+                                  arcname=member['name'], recursive=False)
+        os.rename(tmpout, output)
+        return info
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
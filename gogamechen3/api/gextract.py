@@ -0,0 +1,267 @@
+# -*- coding:utf-8 -*-
+"""
+多进程解压程序文件
+
+zip按成员大小平均分配给多个fork出的子进程并行解压
+tar.gz由子进程用pigz多线程解码后流式解压, 没有pigz时用gzip模块
+子进程执行prefunc(降权)后再写文件, 与zlibutils.async_extract语义一致
+excluder只支持非shell模式, shell模式的excluder由调用方回退到zlibutils
+"""
+import os
+import json
+import time
+import errno
+import shutil
+import signal
+import tarfile
+import zipfile
+import eventlet
+
+from distutils.spawn import find_executable
+
+from eventlet import patcher
+
+from simpleutil.log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+# 成员太少时不值得fork多个进程
+MINMEMBERS = 64
+BLOCK = 1048576
+
+subprocess = patcher.original('subprocess')
+
+
+class ExtractError(Exception):
+    """Parallel extract fail"""
+
+
+def supported(src, exclude=None):
+    """能否用多进程解压, shell模式的excluder不支持"""
+    compretype = 'zip' if os.path.splitext(src)[1][1:] == 'zip' else 'gz'
+    if exclude is None:
+        return True
+    try:
+        exclude(compretype)
+    except (TypeError, NotImplementedError):
+        return False
+    return True
+
+
+def _safe(name):
+    return not os.path.isabs(name) and not os.path.normpath(name).startswith('..')
+
+
+def _split(infos, workers):
+    """按解压后大小平均分配成员, 大文件优先"""
+    bins = [[0, []] for _ in range(workers)]
+    for info in sorted(infos, key=lambda i: i.file_size, reverse=True):
+        _bin = min(bins, key=lambda b: b[0])
+        _bin[0] += info.file_size
+        _bin[1].append(info.filename)
+    return [names for size, names in bins if names]
+
+
+def _zip_dirs(src, dst, excluder):
+    """先创建所有目录, 避免并行解压时创建上级目录冲突"""
+    dirs = set()
+    with zipfile.ZipFile(src) as objtarget:
+        for info in objtarget.infolist():
+            if excluder and excluder(info):
+                continue
+            if not _safe(info.filename):
+                raise ExtractError('Member %s out of archive' % info.filename)
+            name = info.filename.rstrip('/')
+            path = name if info.filename.endswith('/') else os.path.dirname(name)
+            while path and path not in dirs:
+                dirs.add(path)
+                path = os.path.dirname(path)
+    for path in sorted(dirs):
+        path = os.path.join(dst, path)
+        if not os.path.exists(path):
+            os.mkdir(path, 0o755)
+    return dict(files=0, size=0)
+
+
+def _zip_files(src, dst, names):
+    files = size = 0
+    with zipfile.ZipFile(src) as objtarget:
+        for name in names:
+            info = objtarget.getinfo(name)
+            path = os.path.join(dst, name)
+            mode = (info.external_attr >> 16)
+            if mode and (mode & 0o170000) == 0o120000:
+                # 符号链接
+                if os.path.lexists(path):
+                    os.remove(path)
+                os.symlink(objtarget.read(info), path)
+                continue
+            source = objtarget.open(info)
+            try:
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(source, f, BLOCK)
+            finally:
+                source.close()
+            if mode & 0o7777:
+                os.chmod(path, mode & 0o7777)
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            os.utime(path, (mtime, mtime))
+            files += 1
+            size += info.file_size
+    return dict(files=files, size=size)
+
+
+def _tar_stream(src, dst, excluder):
+    files = size = 0
+    pigz = find_executable('pigz')
+    sub = None
+    if pigz:
+        sub = subprocess.Popen([pigz, '-dc', src], close_fds=True, stdout=subprocess.PIPE)
+        objtarget = tarfile.open(fileobj=sub.stdout, mode='r|')
+    else:
+        objtarget = tarfile.open(src, mode='r|gz')
+    try:
+        for tarinfo in objtarget:
+            if excluder and excluder(tarinfo):
+                continue
+            if not _safe(tarinfo.name):
+                raise ExtractError('Member %s out of archive' % tarinfo.name)
+            objtarget.extract(tarinfo, dst)
+            if tarinfo.isfile():
+                files += 1
+                size += tarinfo.size
+    finally:
+        objtarget.close()
+        if sub:
+            sub.stdout.close()
+            if sub.wait():
+                raise ExtractError('pigz exit with code %d' % sub.returncode)
+    return dict(files=files, size=size)
+
+
+class ParallelExtractWaiter(object):
+    """
+    与zlibutils解压waiter接口一致
+    stats记录解压文件数量, 解压后大小, 进程数与耗时
+    """
+
+    def __init__(self, src, dst, exclude=None, timeout=None, prefunc=None, workers=4,
+                 callback=None):
+        self.src = src
+        self.dst = dst
+        self.compretype = 'zip' if os.path.splitext(src)[1][1:] == 'zip' else 'gz'
+        self.excluder = exclude(self.compretype) if exclude else None
+        self.timeout = timeout
+        self.prefunc = prefunc
+        self.workers = max(1, workers)
+        self.callback = callback
+        self.pids = set()
+        self.stats = dict(files=0, size=0, workers=0, elapsed=0)
+        self.thread = eventlet.spawn(self._run)
+
+    @property
+    def finished(self):
+        return self.thread.dead
+
+    def wait(self):
+        return self.thread.wait()
+
+    def stop(self):
+        self._kill()
+        self.thread.kill()
+
+    def _kill(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _fork(self, func, *args):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            code = 0
+            try:
+                if self.prefunc:
+                    self.prefunc()
+                result = func(*args)
+            except Exception as e:
+                code = 1
+                result = dict(error='%s: %s' % (e.__class__.__name__, str(e)[:1024]))
+            try:
+                os.write(w, json.dumps(result))
+            finally:
+                os._exit(code)
+        os.close(w)
+        self.pids.add(pid)
+        return pid, r
+
+    def _join(self, children, overtime):
+        """等待子进程结束, 汇总统计, 任意子进程失败或超时时杀死全部子进程"""
+        errors = []
+        try:
+            while children:
+                for pid, r in children.items():
+                    _pid, status = os.waitpid(pid, os.WNOHANG)
+                    if not _pid:
+                        continue
+                    children.pop(pid)
+                    self.pids.discard(pid)
+                    try:
+                        result = json.loads(os.read(r, 65536) or '{}')
+                    except ValueError:
+                        result = {}
+                    finally:
+                        os.close(r)
+                    if status or 'error' in result:
+                        errors.append(result.get('error') or 'worker exit with status %d' % status)
+                        raise ExtractError('Extract %s fail, %s' % (self.src, errors[0]))
+                    self.stats['files'] += result.get('files', 0)
+                    self.stats['size'] += result.get('size', 0)
+                if children:
+                    if overtime and time.time() > overtime:
+                        raise ExtractError('Extract %s overtime' % self.src)
+                    eventlet.sleep(0.05)
+        except BaseException:
+            # stop时green线程被kill抛出GreenletExit, 同样需要回收子进程与关闭管道
+            self._kill()
+            for pid, r in children.items():
+                os.waitpid(pid, 0)
+                os.close(r)
+            self.pids.clear()
+            raise
+
+    def _run(self):
+        start = time.time()
+        overtime = start + self.timeout if self.timeout else None
+        if self.compretype == 'zip':
+            self._join(dict([self._fork(_zip_dirs, self.src, self.dst, self.excluder)]), overtime)
+            with zipfile.ZipFile(self.src) as objtarget:
+                infos = [info for info in objtarget.infolist()
+                         if not info.filename.endswith('/')
+                         and not (self.excluder and self.excluder(info))]
+            workers = self.workers if len(infos) >= MINMEMBERS else 1
+            groups = _split(infos, workers)
+            self.stats['workers'] = len(groups)
+            self._join(dict(self._fork(_zip_files, self.src, self.dst, names)
+                            for names in groups), overtime)
+        else:
+            self.stats['workers'] = 1
+            self._join(dict([self._fork(_tar_stream, self.src, self.dst, self.excluder)]), overtime)
+        self.stats['elapsed'] = round(time.time() - start, 3)
+        LOG.info('Extract %s to %s, %d files, %d bytes, %d workers, %.2fs, %.2f MB/s' %
+                 (self.src, self.dst, self.stats['files'], self.stats['size'],
+                  self.stats['workers'], self.stats['elapsed'],
+                  self.stats['size'] / 1048576.0 / max(self.stats['elapsed'], 0.001)))
+        if self.callback:
+            self.callback(self.stats)
+        return self.stats
+
+
+def async_extract(src, dst, exclude=None, timeout=None, prefunc=None, workers=4, callback=None):
+    return ParallelExtractWaiter(src, dst, exclude=exclude, timeout=timeout, prefunc=prefunc,
+                                 workers=workers, callback=callback)
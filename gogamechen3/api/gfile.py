@@ -1,5 +1,9 @@
 import os
 import re
+import json
+import stat
+import shutil
+import hashlib
 import eventlet
 import zipfile
 import tarfile
@@ -78,13 +82,171 @@ def nameiter(filepath):
                 yield tarinfo.name
 
 
-def check(objtype, filepath):
-    count = 0
+def _check(objtype, names):
+    for name in names:
+        objtype_checker(objtype, name)
+
+
+def check(objtype, filepath, md5=None):
+    """
+    检查压缩包成员是否符合objtype
+    有md5并且设置了索引目录时用索引中的成员列表检查, 同一个文件只读取一次
+    只缓存成员列表不缓存检查结果, 检查规则变化后结果随之变化
+    读取压缩包不会让出, agent中通过offload在系统线程中调用, 所以不打日志
+    返回索引是否损坏后重建, 由调用者记录日志
+    """
     if objtype not in common.ALLTYPES:
         raise ValueError('objtype value error')
-    for name in nameiter(filepath):
-        objtype_checker(objtype, name)
+    if not md5 or not _indexpath:
+        _check(objtype, nameiter(filepath))
+        return False
+    info = index(filepath, md5)
+    _check(objtype, [member[0] for member in info['members']])
+    return info.get('broken', False)
+
+
+# 压缩包索引缓存目录, agent启动时设置
+_indexpath = None
+
+
+def set_indexpath(path):
+    global _indexpath
+    if not os.path.exists(path):
+        os.makedirs(path, mode=0o755)
+    _indexpath = path
+
+
+def _indexfile(md5):
+    return os.path.join(_indexpath, '%s.json' % md5)
+
+
+def _save_index(md5, info):
+    path = _indexfile(md5)
+    with open(path + '.tmp', 'wb') as f:
+        json.dump(info, f)
+    os.rename(path + '.tmp', path)
+
+
+def _index(filepath):
+    members = []
+    ext = os.path.splitext(filepath)[1][1:]
+    with open(filepath, 'rb') as f:
+        if ext == 'zip':
+            objtarget = zipfile.ZipFile(file=f)
+            for info in objtarget.infolist():
+                members.append([info.filename, info.file_size])
+        else:
+            objtarget = tarfile.TarFile.open(fileobj=f)
+            for tarinfo in objtarget:
+                members.append([tarinfo.name, tarinfo.size if tarinfo.isfile() else 0])
+    return members
+
+
+def index(filepath, md5=None):
+    """
+    压缩包成员索引, members为[名称, 大小]
+    有md5并且设置了索引目录时持久化, 后续直接读取索引
+    索引文件损坏时重建, 返回的info中broken为True(不保存)
+    """
+    broken = False
+    if md5 and _indexpath:
+        path = _indexfile(md5)
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    info = json.load(f)
+            except ValueError:
+                broken = True
+            else:
+                # 更新时间, 过期清理依据
+                os.utime(path, None)
+                return info
+    info = dict(md5=md5, members=_index(filepath))
+    if md5 and _indexpath:
+        _save_index(md5, info)
+    if broken:
+        info['broken'] = True
+    return info
+
+
+def check_manifest(objtype, manifest):
+    """用程序文件清单检查, 上传程序文件时使用"""
+    if objtype not in common.ALLTYPES:
+        raise ValueError('objtype value error')
+    _check(objtype, manifest.get('dirs', []))
+    _check(objtype, manifest.get('files', {}).keys())
+
+
+def _members(filepath):
+    """遍历压缩包成员, 返回(名称, 是否目录, 权限, 打开函数)"""
+    ext = os.path.splitext(filepath)[1][1:]
+    if ext == 'zip':
+        with zipfile.ZipFile(filepath) as objtarget:
+            for info in objtarget.infolist():
+                isdir = info.filename.endswith('/')
+                mode = (info.external_attr >> 16) & 0o7777 or (0o755 if isdir else 0o644)
+                yield (info.filename.rstrip('/'), isdir, mode,
+                       lambda info=info: objtarget.open(info))
+    else:
+        with tarfile.open(filepath) as objtarget:
+            for tarinfo in objtarget:
+                if not tarinfo.isdir() and not tarinfo.isfile():
+                    continue
+                yield (tarinfo.name.rstrip('/'), tarinfo.isdir(), tarinfo.mode,
+                       lambda tarinfo=tarinfo: objtarget.extractfile(tarinfo))
+
+
+def manifest(filepath):
+    """压缩包文件清单, files为{路径: [大小, md5]}"""
+    files = {}
+    dirs = []
+    for name, isdir, mode, fopen in _members(filepath):
+        if isdir:
+            dirs.append(name)
+            continue
+        md5 = hashlib.md5()
+        size = 0
+        f = fopen()
+        try:
+            while True:
+                buf = f.read(1048576)
+                if not buf:
+                    break
+                size += len(buf)
+                md5.update(buf)
+                eventlet.sleep(0)
+        finally:
+            f.close()
+        files[name] = [size, md5.hexdigest()]
+    dirs.sort()
+    return dict(files=files, dirs=dirs)
+
+
+def extract_members(filepath, dst, names, chown=None):
+    """
+    只解压names中的文件, 先写临时文件再覆盖, chown修改新文件属主
+    不会让出, agent中通过offload在系统线程中调用
+    """
+    count = 0
+    for name, isdir, mode, fopen in _members(filepath):
+        if isdir or name not in names:
+            continue
+        path = os.path.join(dst, name)
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            os.makedirs(parent, mode=0o755)
+            if chown:
+                chown(parent)
+        tmp = path + '.extract-tmp'
+        f = fopen()
+        try:
+            with open(tmp, 'wb') as out:
+                shutil.copyfileobj(f, out, 1048576)
+        finally:
+            f.close()
+        os.chmod(tmp, stat.S_IMODE(mode))
+        if chown:
+            chown(tmp)
+        os.rename(tmp, path)
         count += 1
-        if count >= 100:
-            count = 0
-            eventlet.sleep(0)
+    return count
@@ -7,6 +7,7 @@ import shutil
 import json
 import re
 import contextlib
+import subprocess
 import eventlet
 import psutil
 
@@ -41,6 +42,7 @@ from gogamechen3 import utils
 
 from gogamechen3.api import gconfig
 from gogamechen3.api import gfile
+from gogamechen3.api import gextract
 from gogamechen3.api.exceptions import MergeException
 from gogamechen3.api.client import Gogamechen3DBClient
 from gogamechen3.api.rpc.config import gameserver_group
@@ -48,7 +50,16 @@ from gogamechen3.api.rpc.config import crossserver_group
 from gogamechen3.api.rpc.config import gmserver_group
 from gogamechen3.api.rpc.config import register_opts
 from gogamechen3.api.rpc.config import agent_opts
-
+from gogamechen3.api.rpc import supervisor
+from gogamechen3.api.rpc import metrics
+from gogamechen3.api.rpc import offload
+from gogamechen3.api.rpc import profile
+from gogamechen3.api.rpc.peer import PeerFiles
+from gogamechen3.api.rpc.appstore import AppStore
+from gogamechen3.api.rpc.appstore import AssembleWaiter
+
+from gogamechen3.api.rpc.taskflow import AppStage
+from gogamechen3.api.rpc.taskflow import GogameAppFile
 from gogamechen3.api.rpc.taskflow import create as taskcreate
 from gogamechen3.api.rpc.taskflow import upgrade as taskupgrade
 from gogamechen3.api.rpc.taskflow import hotfix as taskhotfix
@@ -123,6 +134,38 @@ class CreateResult(resultutils.AgentRpcResult):
         return ret_dict
 
 
+def _dump_config(cfile, confobj):
+    with open(cfile, 'wb') as f:
+        json.dump(confobj, f, indent=4, ensure_ascii=False)
+        f.write('\n')
+
+
+class MetricsResult(resultutils.AgentRpcResult):
+    def __init__(self, agent_id, ctxt,
+                 resultcode, result,
+                 records):
+        super(MetricsResult, self).__init__(agent_id, ctxt, resultcode, result)
+        self.records = records
+
+    def to_dict(self):
+        ret_dict = super(MetricsResult, self).to_dict()
+        ret_dict.setdefault('records', self.records)
+        return ret_dict
+
+
+class ProfileResult(resultutils.AgentRpcResult):
+    def __init__(self, agent_id, ctxt,
+                 resultcode, result,
+                 profile):
+        super(ProfileResult, self).__init__(agent_id, ctxt, resultcode, result)
+        self.profile = profile
+
+    def to_dict(self):
+        ret_dict = super(ProfileResult, self).to_dict()
+        ret_dict.setdefault('profile', self.profile)
+        return ret_dict
+
+
 class EntityProcessCheckTasker(IntervalLoopinTask):
     """
     周期性entity进程检查
@@ -132,6 +175,8 @@ class EntityProcessCheckTasker(IntervalLoopinTask):
         self.endpoint = endpoint
         # 有死过进程的entity列表
         self.deads = dict()
+        # 正在自动重启的entity
+        self.restarting = set()
         conf = CONF[common.NAME]
         self.pop_from_deads = conf.pop_from_deads
         self.auto_restart_times = conf.auto_restart_times
@@ -148,38 +193,9 @@ class EntityProcessCheckTasker(IntervalLoopinTask):
             else:
                 self.deads.pop(entity, None)
         if entitys:
-            proc_snapshot = utils.find_process()
+            proc_snapshot = self.endpoint.procindex.refresh()
             for entity in entitys:
-                if not self.endpoint.konwn_appentitys[entity]['started']:
-                    self.deads.pop(entity, None)
-                    continue
-                status = self.endpoint.konwn_appentitys[entity].get('status')
-                if status != common.OK:
-                    with self.endpoint.lock(entity):
-                        self.endpoint.konwn_appentitys[entity]['started'] = False
-                    self.deads.pop(entity, None)
-                    continue
-                if self.endpoint._entity_process(entity, proc_snapshot):
-                    info = self.deads.pop(entity, None)
-                    if info and (now - info.get('time') < self.pop_from_deads):
-                        self.deads.setdefault(entity, info)
-                    continue
-                info = self.deads.pop(entity, None)
-                if not info:
-                    info = dict(time=now, times=1)
-                else:
-                    info['times'] += 1
-                    info['time'] = now
-                if info.get('times') > self.auto_restart_times:
-                    LOG.warning('Entity process dead over auto restart max times')
-                    self.endpoint.notify(entity, 'dead')
-                    with self.endpoint.lock(entity):
-                        self.endpoint.konwn_appentitys[entity]['started'] = False
-                    continue
-                self.deads.setdefault(entity, info)
-                LOG.info('Try restart entity process %d times when it is dead' % info.get('times'))
-                eventlet.spawn_n(self.endpoint.start_entity, entity)
-                # eventlet.sleep(0)
+                self.check(entity, now, proc_snapshot)
         else:
             for entity in self.deads.keys():
                 info = self.deads[entity]
@@ -187,6 +203,55 @@ class EntityProcessCheckTasker(IntervalLoopinTask):
                 if now - info.get('time') >= self.pop_from_deads:
                     self.deads.pop(entity, None)
 
+    def check(self, entity, now=None, proc_snapshot=None):
+        """检查单个entity进程, 进程不存在时按死亡次数自动重启"""
+        now = now or int(time.time())
+        if entity not in self.endpoint.konwn_appentitys \
+                or not self.endpoint.konwn_appentitys[entity]['started']:
+            self.deads.pop(entity, None)
+            return
+        # 正在重启
+        if entity in self.restarting:
+            return
+        status = self.endpoint.konwn_appentitys[entity].get('status')
+        if status != common.OK:
+            with self.endpoint.lock(entity):
+                self.endpoint.konwn_appentitys[entity]['started'] = False
+            self.deads.pop(entity, None)
+            return
+        if self.endpoint._entity_process(entity, proc_snapshot):
+            info = self.deads.pop(entity, None)
+            if info and (now - info.get('time') < self.pop_from_deads):
+                self.deads.setdefault(entity, info)
+            return
+        info = self.deads.pop(entity, None)
+        if not info:
+            info = dict(time=now, times=1)
+        else:
+            info['times'] += 1
+            info['time'] = now
+        if info.get('times') > self.auto_restart_times:
+            LOG.warning('Entity process dead over auto restart max times')
+            self.endpoint.notify(entity, 'dead')
+            with self.endpoint.lock(entity):
+                self.endpoint.konwn_appentitys[entity]['started'] = False
+            return
+        self.deads.setdefault(entity, info)
+        LOG.info('Try restart entity process %d times when it is dead' % info.get('times'))
+        self.restarting.add(entity)
+        eventlet.spawn_n(self.restart, entity)
+
+    def restart(self, entity):
+        try:
+            self.endpoint.start_entity(entity)
+            eventlet.sleep(1.0)
+            # 重新获取进程, 进程监控在获取进程时注册
+            self.endpoint._entity_process(entity)
+        except Exception:
+            LOG.exception('Restart entity %d fail' % entity)
+        finally:
+            self.restarting.discard(entity)
+
 
 @singleton.singleton
 class Application(AppEndpointBase):
@@ -198,13 +263,38 @@ class Application(AppEndpointBase):
         self.client = Gogamechen3DBClient(get_http())
         self.delete_tokens = {}
         self.konwn_appentitys = {}
+        # entity进程索引
+        self.procindex = utils.ProcessIndex()
+        # entity进程退出监控
+        self.pwatcher = None
+        self.checker = None
         # Merger lock
         self.mlock = Semaphore(1)
+        # 共享版本目录 lock
+        self.rlock = Semaphore(1)
+        # taskflow执行记录
+        self.metrics = metrics.MetricsStore(os.path.join(self.endpoint_backup, 'metrics.dat'),
+                                            CONF[common.NAME].metrics_size * 1024 * 1024)
+        # agent之间分发文件
+        self.peerfiles = None
+        # 程序文件存储
+        self.appstore = None
+        if systemutils.POSIX and CONF[common.NAME].app_store:
+            self.appstore = AppStore(os.path.join(self.endpoint_backup, 'store'))
 
     @property
     def apppathname(self):
         return 'gogame'
 
+    def lock(self, *args, **kwargs):
+        """记录实体锁等待时间"""
+        entity = args[0] if args else kwargs.get('entity')
+        return profile.profiler.timed_lock(super(Application, self).lock(*args, **kwargs), [entity])
+
+    def locks(self, *args, **kwargs):
+        entitys = args[0] if args else kwargs.get('entitys', [])
+        return profile.profiler.timed_lock(super(Application, self).locks(*args, **kwargs), entitys)
+
     def entity_user(self, entity):
         return 'gogamechen3-%d' % entity
 
@@ -214,6 +304,14 @@ class Application(AppEndpointBase):
     def logbakup(self, entity):
         return os.path.join(self.bakpath(entity), 'logbak-%d' % entity)
 
+    @property
+    def stagepath(self):
+        return os.path.join(self.endpoint_backup, 'stage')
+
+    @property
+    def indexpath(self):
+        return os.path.join(self.endpoint_backup, 'index')
+
     def clean_expired(self):
         """
         重写清理函数
@@ -221,6 +319,26 @@ class Application(AppEndpointBase):
         """
         super(Application, self).clean_expired()
         eventlet.sleep(0)
+        AppStage.clean(self.stagepath, 86400)
+        eventlet.sleep(0)
+        if self.appstore:
+            self.appstore.gc(864000)
+            eventlet.sleep(0)
+        if self.peerfiles:
+            self.peerfiles.clean(864000)
+            eventlet.sleep(0)
+        if os.path.exists(self.manifestpath):
+            self.clean(self.manifestpath, 864000)
+            eventlet.sleep(0)
+        if os.path.exists(self.indexpath):
+            self.clean(self.indexpath, 864000)
+            eventlet.sleep(0)
+        if os.path.exists(os.path.join(self.endpoint_backup, 'profile')):
+            self.clean(os.path.join(self.endpoint_backup, 'profile'), 864000)
+        if os.path.exists(self.releasepath):
+            for objtype in os.listdir(self.releasepath):
+                self.prune_releases(objtype)
+                eventlet.sleep(0)
         for entity in self.entitys:
             backup = self.bakpath(entity)
             self.clean(backup, 864000)
@@ -230,12 +348,37 @@ class Application(AppEndpointBase):
         super(AppEndpointBase, self).pre_start(external_objects)
         conf = CONF[common.NAME]
         external_objects.update({'gogamechen3-aff': conf.agent_affinity})
+        offload.set_threads(conf.offload_threads)
+        if conf.hub_block_threshold:
+            profile.profiler.monitor_hub(conf.hub_block_threshold)
+        # 压缩包索引, 同一个程序文件只读取一次
+        gfile.set_indexpath(self.indexpath)
+        # peer文件与多连接下载共用文件缓存目录
+        if conf.peer_port or conf.download_connections > 1:
+            self.peerfiles = PeerFiles(os.path.join(self.endpoint_backup, 'peer'),
+                                       self.filemanager, conf.peer_rate * 1024,
+                                       client=self.client,
+                                       connections=conf.download_connections if
+                                       conf.download_connections > 1 else 0,
+                                       chunk=conf.download_chunk * 1024 * 1024,
+                                       download_rate=conf.download_rate * 1024)
+        if conf.peer_port:
+            external_objects.update({'gogamechen3-peer': conf.peer_port})
         if conf.auto_restart_times:
-            self.manager.periodic_tasks.append(EntityProcessCheckTasker(self))
+            self.checker = EntityProcessCheckTasker(self)
+            self.manager.periodic_tasks.append(self.checker)
+            if conf.process_supervise:
+                if supervisor.supported():
+                    self.pwatcher = supervisor.ProcessWatcher(self._entity_exit)
+                else:
+                    LOG.warning('pidfd not supported, entity process only checked by periodic task')
 
     def post_start(self):
         super(Application, self).post_start()
-        pids = utils.find_process()
+        if CONF[common.NAME].peer_port:
+            # 只监听内网地址
+            self.peerfiles.serve(self.manager.local_ip, CONF[common.NAME].peer_port)
+        pids = self.procindex.refresh()
         # reflect entity objtype
         if self.entitys:
             LOG.info('Try reflect entity objtype and group info')
@@ -276,12 +419,51 @@ class Application(AppEndpointBase):
                 LOG.info('App entity %d is running at %d' % (entity, _pid))
                 self.konwn_appentitys[entity]['pid'] = _pid
                 self.konwn_appentitys[entity]['started'] = True
+                self._supervise(entity, _pid)
+
+    def _supervise(self, entity, pid):
+        if self.pwatcher:
+            try:
+                self.pwatcher.watch(entity, pid)
+            except OSError as e:
+                LOG.error('Watch entity %d process %d fail, %s' % (entity, pid, e.strerror))
+
+    def _unsupervise(self, entity):
+        if self.pwatcher:
+            self.pwatcher.unwatch(entity)
+
+    def _entity_exit(self, entity, pid):
+        entityinfo = self.konwn_appentitys.get(entity)
+        # 主动停止或者pid已经变化
+        if not entityinfo or not entityinfo['started'] or entityinfo.get('pid') not in (pid, None):
+            return
+        self.checker.check(entity)
+
+    def _is_execfile(self, entity, objtype, exe):
+        """
+        进程执行文件是否属于实体
+        版本目录模式下切换版本不影响运行中的进程, 进程执行文件可能是任意版本目录或legacy中的文件
+        """
+        if not exe:
+            return False
+        if exe.endswith(' (deleted)'):
+            exe = exe[:-len(' (deleted)')]
+        # 程序目录可能是指向当前版本的软链
+        if exe == os.path.realpath(os.path.join(self.apppath(entity), 'bin', objtype)):
+            return True
+        if not self.entity_release(entity):
+            return False
+        if exe == os.path.join(self.entity_home(entity), 'legacy', 'bin', objtype):
+            return True
+        bindir, execname = os.path.split(exe)
+        release, folder = os.path.split(bindir)
+        return execname == objtype and folder == 'bin' and \
+            os.path.dirname(release) == self.release_root(objtype)
 
     def _esure(self, entity, objtype, proc):
         datadir = False
         runuser = False
-        _execfile = os.path.join(self.apppath(entity), 'bin', objtype)
-        if proc.get('exe') != _execfile:
+        if not self._is_execfile(entity, objtype, proc.get('exe')):
             return False
         if proc.get('username') == self.entity_user(entity):
             runuser = True
@@ -295,11 +477,21 @@ class Application(AppEndpointBase):
         return False
 
     def _find_from_pids(self, entity, objtype, pids=None):
-        if not pids:
-            pids = utils.find_process(objtype)
-        for proc in pids:
-            if self._esure(entity, objtype, proc):
-                return proc.get('pid')
+        if pids is None:
+            pids = self.procindex.refresh()
+        _execfile = os.path.realpath(os.path.join(self.apppath(entity), 'bin', objtype))
+        pwd = self.apppath(entity)
+        # 优先按运行用户查找, 找不到时查找同目录进程用于校验运行用户
+        proc = pids.lookup(_execfile, pwd, self.entity_user(entity)) or pids.lookup(_execfile, pwd)
+        if not proc and self.entity_release(entity):
+            # 运行中切换过版本, 进程执行文件不是当前版本, 按运行目录查找
+            for info in pids:
+                if info.get('pwd') == pwd and self._is_execfile(entity, objtype, info.get('exe')):
+                    proc = info
+                    if info.get('username') == self.entity_user(entity):
+                        break
+        if proc and self._esure(entity, objtype, proc):
+            return proc.get('pid')
 
     def _objtype(self, entity):
         return self.konwn_appentitys[entity].get('objtype')
@@ -356,41 +548,45 @@ class Application(AppEndpointBase):
         objtype = entityinfo.get('objtype')
         _pid = entityinfo.get('pid')
         if _pid:
-            try:
-                p = psutil.Process(pid=_pid)
-                info = dict(pid=p.pid, name=p.name(), exe=p.exe(), pwd=p.cwd(), username=p.username())
-                # pid正确
-                if self._esure(entity, objtype, info):
-                    setattr(p, 'info', info)
-                    return p
-                # pid错误
-                else:
-                    _pid = None
-            except psutil.NoSuchProcess:
-                _pid = None
-        if not _pid:
-            # 重新找pid
-            _pid = self._find_from_pids(entity, objtype, pids=pids)
+            p = self._verify_process(entity, objtype, _pid, pids)
+            # pid正确
+            if p:
+                self._supervise(entity, _pid)
+                return p
+        # 重新找pid
+        _pid = self._find_from_pids(entity, objtype, pids=pids)
         # 还是没有对应pid
         if not _pid:
             self.konwn_appentitys[entity]['pid'] = None
             # 程序不存在
             return None
+        # 再次验证pid
+        p = self._verify_process(entity, objtype, _pid, pids)
+        if p:
+            self.konwn_appentitys[entity]['pid'] = _pid
+            self._supervise(entity, _pid)
+            return p
+        # 还是验证错误
+        self.konwn_appentitys[entity]['pid'] = None
+        return None
+
+    def _verify_process(self, entity, objtype, pid, pids=None):
         try:
-            # 再次验证pid
-            p = psutil.Process(pid=_pid)
-            info = dict(pid=p.pid, name=p.name(), exe=p.exe(), pwd=p.cwd(), username=p.username())
+            p = psutil.Process(pid=pid)
+            # 僵尸进程pidfd已经可读, 视为已经退出
+            if p.status() == psutil.STATUS_ZOMBIE:
+                return None
+            # 索引未刷新也可以使用, 创建时间用于确认是同一进程
+            info = (pids if pids is not None else self.procindex).get(pid)
+            # 创建时间一致说明pid未被复用, 不需要再读取进程信息
+            if not info or info.get('create_time') != p.create_time():
+                info = dict(pid=p.pid, name=p.name(), exe=p.exe(), pwd=p.cwd(), username=p.username())
             if self._esure(entity, objtype, info):
                 setattr(p, 'info', info)
-                self.konwn_appentitys[entity]['pid'] = _pid
                 return p
-            else:
-                # 还是验证错误
-                self.konwn_appentitys[entity]['pid'] = None
-                return None
         except psutil.NoSuchProcess:
-            self.konwn_appentitys[entity]['pid'] = None
-            return None
+            pass
+        return None
 
     def flush_config(self, entity, databases=None,
                      opentime=None, chiefs=None):
@@ -425,14 +621,12 @@ class Application(AppEndpointBase):
         except Exception:
             LOG.exception('flush config fail')
             raise
-        with open(cfile, 'wb') as f:
-            json.dump(confobj, f, indent=4, ensure_ascii=False)
-            f.write('\n')
+        offload.execute('config', _dump_config, cfile, confobj)
         LOG.info('Make config for %s.%d success' % (objtype, entity))
         systemutils.chown(cfile, self.entity_user(entity), self.entity_group(entity))
 
     def _create_entity(self, entity, objtype, appfile, databases, timeout, ports=None):
-        self.filemanager.find(appfile)
+        self.find_file(appfile)
         with self.lock(entity):
             if entity in self.entitys:
                 raise RpcEntityError(endpoint=common.NAME, entity=entity, reason='Entity duplicate')
@@ -493,13 +687,23 @@ class Application(AppEndpointBase):
             LOG.error('delete %s fail' % home)
             raise
         else:
+            self._unsupervise(entity)
             self._free_ports(entity)
             self.entitys_map.pop(entity, None)
             self.konwn_appentitys.pop(entity, None)
             systemutils.drop_user(self.entity_user(entity))
 
-    def extract_entity_file(self, entity, objtype, appfile, timeout, exclude=None):
+    def extract_entity_file(self, entity, objtype, appfile, timeout, exclude=None, md5=None):
         dst = self.apppath(entity)
+        if self.appstore and md5 and not exclude:
+            # 用程序文件存储组装, 存储中已有相同版本时不需要解压
+            stage = AppStage(self.stagepath, md5, extractor=self.async_extract)
+
+            def _assemble():
+                tree = stage.tree(self.appstore, appfile, timeout)
+                self.appstore.assemble(tree, dst, self.entity_user(entity), self.entity_group(entity))
+
+            return AssembleWaiter(_assemble)
         # 异步解压
         if systemutils.POSIX:
             def prefunc():
@@ -507,15 +711,362 @@ class Application(AppEndpointBase):
                 umask()
         else:
             prefunc = None
-        waiter = zlibutils.async_extract(src=appfile, dst=dst,
-                                         exclude=exclude, timeout=timeout,
-                                         native=False, prefunc=prefunc)
+        waiter = self.async_extract(appfile, dst, timeout, exclude=exclude, prefunc=prefunc)
         # 解压完成速度过快, 检查是否有错, 没有报错说明解压完成
         if waiter.finished:
             waiter.wait()
         # 返回解压waiter对象
         return waiter
 
+    def async_extract(self, src, dst, timeout, exclude=None, prefunc=None):
+        """多核解压, 不支持时用zlibutils解压"""
+        workers = CONF[common.NAME].extract_workers or psutil.cpu_count()
+        if systemutils.POSIX and workers > 1 and gextract.supported(src, exclude):
+            def _record(stats):
+                self.metrics.record(kind='extract', flow='extract', outcome='success',
+                                    file=os.path.basename(src), **stats)
+
+            return gextract.async_extract(src, dst, exclude=exclude, timeout=timeout,
+                                          prefunc=prefunc, workers=workers, callback=_record)
+        return zlibutils.async_extract(src=src, dst=dst, exclude=exclude, timeout=timeout,
+                                       native=False, prefunc=prefunc)
+
+    def copy_entity_file(self, entity, src, timeout, dst=None):
+        """从解压目录复制程序文件, 以entity用户运行cp, 支持reflink的文件系统不复制数据"""
+        dst = dst or self.apppath(entity)
+
+        def prefunc():
+            systemutils.drop_privileges(self.entity_user(entity), self.entity_group(entity))
+            umask()
+
+        args = ['cp', '-rf', '--reflink=auto', '--remove-destination',
+                '--preserve=mode,timestamps', os.path.join(src, '.'), dst]
+        LOG.debug(' '.join(args))
+        sub = subprocess.Popen(args, close_fds=True, preexec_fn=prefunc)
+        code = systemutils.subwait(sub, timeout=timeout)
+        if code:
+            raise RpcEntityError(endpoint=common.NAME, entity=entity,
+                                 reason='Copy entity file from stage fail, code %s' % str(code))
+
+    def _snapshot_path(self, entity):
+        return os.path.join(self.entity_home(entity), 'upgrade-snapshot')
+
+    def snapshot_entity_file(self, entity, timeout):
+        """
+        更新前用硬链接复制程序目录作为回滚备份, 不复制文件数据
+        分阶段更新都用rename替换文件, 备份中的文件不受影响
+        """
+        path = self._snapshot_path(entity)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        sub = subprocess.Popen(['cp', '-al', self.apppath(entity), path], close_fds=True)
+        code = systemutils.subwait(sub, timeout=timeout)
+        if code:
+            shutil.rmtree(path, ignore_errors=True)
+            raise RpcEntityError(endpoint=common.NAME, entity=entity,
+                                 reason='Snapshot entity file fail, code %s' % str(code))
+
+    def restore_entity_file(self, entity):
+        """用更新前的备份替换程序目录, 没有备份返回False"""
+        path = self._snapshot_path(entity)
+        if not os.path.exists(path):
+            return False
+        apppath = self.apppath(entity)
+        failed = apppath + '.failed'
+        if os.path.exists(failed):
+            shutil.rmtree(failed)
+        os.rename(apppath, failed)
+        os.rename(path, apppath)
+        shutil.rmtree(failed, ignore_errors=True)
+        return True
+
+    @property
+    def manifestpath(self):
+        return os.path.join(self.endpoint_backup, 'manifests')
+
+    def appfile_manifest(self, md5):
+        """程序文件清单, 从服务器获取后本地缓存, 没有清单返回None"""
+        path = os.path.join(self.manifestpath, '%s.json' % md5)
+        if os.path.exists(path):
+            os.utime(path, None)
+            with open(path, 'rb') as f:
+                return json.load(f)
+        try:
+            manifest = self.client.objfile_manifest(md5)['data'][0]['manifest']
+        except Exception as e:
+            LOG.warning('Get manifest of %s fail, %s' % (md5, e.__class__.__name__))
+            return None
+        if not manifest:
+            return None
+        if not os.path.exists(self.manifestpath):
+            os.makedirs(self.manifestpath, mode=0o755)
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(manifest, f)
+        os.rename(path + '.tmp', path)
+        return manifest
+
+    def _manifest_file(self, entity):
+        return os.path.join(self.entity_home(entity), 'manifest.json')
+
+    def installed_manifest(self, entity):
+        """
+        实体已安装文件清单, 没有记录返回None
+        文件大小或修改时间与记录不一致的文件视为已修改, 不在返回结果中
+        """
+        path = self._manifest_file(entity)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                installed = json.load(f)
+        except ValueError:
+            return None
+        apppath = self.apppath(entity)
+        files = {}
+        for name, (size, md5, mtime) in installed.iteritems():
+            try:
+                st = os.stat(os.path.join(apppath, name))
+            except OSError:
+                continue
+            if st.st_size == size and int(st.st_mtime) == mtime:
+                files[name] = [size, md5]
+        return files
+
+    def record_manifest(self, entity, manifest):
+        """记录实体已安装文件清单, 附带文件修改时间"""
+        apppath = self.apppath(entity)
+        installed = {}
+        for name, (size, md5) in manifest['files'].iteritems():
+            if gfile.exclude_by_name(name):
+                continue
+            try:
+                st = os.stat(os.path.join(apppath, name))
+            except OSError:
+                continue
+            if st.st_size == size:
+                installed[name] = [size, md5, int(st.st_mtime)]
+        path = self._manifest_file(entity)
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(installed, f)
+        os.rename(path + '.tmp', path)
+
+    def increment_entity_file(self, entity, appfile, manifest):
+        """
+        按清单只更新变化与新增的文件, 删除新版本中不存在的文件
+        没有已安装清单时返回False, 由调用者完整解压
+        """
+        installed = self.installed_manifest(entity)
+        if installed is None:
+            return False
+        apppath = self.apppath(entity)
+        user = self.entity_user(entity)
+        group = self.entity_group(entity)
+        changes = set()
+        for name, value in manifest['files'].iteritems():
+            if gfile.exclude_by_name(name):
+                continue
+            if installed.get(name) != value:
+                changes.add(name)
+        removed = set(installed) - set(manifest['files'])
+        for name in manifest.get('dirs', []):
+            path = os.path.join(apppath, name)
+            if not gfile.exclude_by_name(name) and not os.path.exists(path):
+                os.makedirs(path, mode=0o755)
+                systemutils.chown(path, user, group)
+        count = offload.execute('extract', gfile.extract_members, appfile, apppath, changes,
+                                chown=lambda path: systemutils.chown(path, user, group))
+        if count != len(changes):
+            raise RpcEntityError(endpoint=common.NAME, entity=entity,
+                                 reason='Increment extract %d files, but %d changed' % (count, len(changes)))
+        for name in removed:
+            path = os.path.join(apppath, name)
+            if os.path.isfile(path):
+                os.remove(path)
+        self.record_manifest(entity, manifest)
+        LOG.info('Entity %d increment upgrade, %d changed, %d removed, %d unchanged' %
+                 (entity, len(changes), len(removed), len(manifest['files']) - len(changes)))
+        return True
+
+    @property
+    def releasepath(self):
+        return os.path.join(self.endpoint_backup, 'releases')
+
+    def release_root(self, objtype):
+        return os.path.join(self.releasepath, objtype)
+
+    def current_release(self, entity):
+        """当前版本软链"""
+        return os.path.join(self.entity_home(entity), 'current')
+
+    def previous_release(self, entity):
+        """上一个版本软链, 回滚用"""
+        return os.path.join(self.entity_home(entity), 'previous')
+
+    def entity_release(self, entity):
+        """实体当前使用的版本, 非版本目录模式返回None"""
+        current = self.current_release(entity)
+        if not os.path.islink(current):
+            return None
+        return os.path.basename(os.path.realpath(current))
+
+    def prepare_release(self, objtype, md5, appfile, timeout, stage):
+        """
+        解压程序文件到objtype共享的只读版本目录, 不影响正在运行的程序
+        """
+        path = os.path.join(self.release_root(objtype), md5)
+        with self.rlock:
+            if os.path.exists(path):
+                os.utime(path, None)
+                return path
+            tmp = path + '.tmp'
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(tmp, mode=0o755)
+            try:
+                if self.appstore:
+                    tree = stage.tree(self.appstore, appfile, timeout)
+                    self.appstore.assemble(tree, tmp, 'root', 'root')
+                else:
+                    # 解压目录与版本目录在同一个文件系统
+                    os.rmdir(tmp)
+                    os.rename(stage.extract(appfile, timeout), tmp)
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            os.rename(tmp, path)
+        return path
+
+    def hotfix_release(self, objtype, base, md5, appfile, timeout, stage):
+        """
+        热更新生成新版本, 硬链接复制基础版本后用热更文件覆盖
+        覆盖使用rename, 基础版本的文件不受影响
+        """
+        name = '%s+%s' % (base, md5)
+        root = self.release_root(objtype)
+        path = os.path.join(root, name)
+        with self.rlock:
+            if os.path.exists(path):
+                os.utime(path, None)
+                return name
+            tmp = path + '.tmp'
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            sub = subprocess.Popen(['cp', '-al', os.path.join(root, base), tmp], close_fds=True)
+            code = systemutils.subwait(sub, timeout=timeout)
+            if code:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise RpcEntityError(endpoint=common.NAME, entity=0,
+                                     reason='Copy release %s fail, code %s' % (base, str(code)))
+            try:
+                if self.appstore:
+                    tree = stage.tree(self.appstore, appfile, timeout)
+                    self.appstore.assemble(tree, tmp, 'root', 'root')
+                else:
+                    src = stage.extract(appfile, timeout)
+                    for _root, dirs, files in os.walk(src):
+                        dst = os.path.join(tmp, os.path.relpath(_root, src))
+                        if not os.path.exists(dst):
+                            os.makedirs(dst, mode=0o755)
+                        for _file in files:
+                            _tmp = os.path.join(dst, _file + '.hotfix-tmp')
+                            shutil.copy2(os.path.join(_root, _file), _tmp)
+                            os.rename(_tmp, os.path.join(dst, _file))
+                        eventlet.sleep(0)
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            os.rename(tmp, path)
+        return name
+
+    def switch_release(self, entity, name):
+        """
+        切换版本, 程序目录中的程序文件夹为指向current的软链, 切换current软链即切换版本
+        旧版程序文件夹第一次切换时移动到entity_home/legacy
+        """
+        objtype = self._objtype(entity)
+        release = os.path.join(self.release_root(objtype), name)
+        if not os.path.isdir(release):
+            raise RpcEntityError(endpoint=common.NAME, entity=entity,
+                                 reason='Release %s not prepared' % name)
+        current = self.current_release(entity)
+        previous = os.path.realpath(current) if os.path.islink(current) else None
+        if previous == release:
+            return
+        # 原子切换current
+        for link, target in ((current, release), (self.previous_release(entity), previous)):
+            if not target:
+                continue
+            tmp = link + '.tmp'
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(target, tmp)
+            os.rename(tmp, link)
+        apppath = self.apppath(entity)
+        legacy = os.path.join(self.entity_home(entity), 'legacy')
+        for folder in os.listdir(release):
+            # 配置与日志由实体自己保存
+            if gfile.exclude_by_name(folder):
+                continue
+            path = os.path.join(apppath, folder)
+            target = os.path.join(current, folder)
+            if os.path.islink(path):
+                if os.readlink(path) == target:
+                    continue
+                os.remove(path)
+            elif os.path.exists(path):
+                if not os.path.exists(legacy):
+                    os.makedirs(legacy, mode=0o755)
+                _legacy = os.path.join(legacy, folder)
+                if os.path.exists(_legacy):
+                    shutil.rmtree(_legacy)
+                os.rename(path, _legacy)
+            os.symlink(target, path)
+        # 已经有上一个版本可以回滚, 删除旧版程序文件夹
+        if previous and os.path.exists(legacy):
+            shutil.rmtree(legacy, ignore_errors=True)
+        LOG.info('Entity %d switch release to %s' % (entity, name))
+        self.prune_releases(objtype)
+
+    def rollback_release(self, entity):
+        """回滚到上一个版本, 只切换软链"""
+        previous = self.previous_release(entity)
+        if not os.path.islink(previous) or not os.path.isdir(previous):
+            raise RpcEntityError(endpoint=common.NAME, entity=entity,
+                                 reason='No previous release found')
+        self.switch_release(entity, os.path.basename(os.path.realpath(previous)))
+
+    def clear_release(self, entity):
+        """删除版本软链与旧版程序文件夹, 实体恢复为独立程序目录, 不是版本目录模式返回False"""
+        released = False
+        for link in (self.current_release(entity), self.previous_release(entity)):
+            if os.path.islink(link):
+                os.remove(link)
+                released = True
+        shutil.rmtree(os.path.join(self.entity_home(entity), 'legacy'), ignore_errors=True)
+        return released
+
+    def prune_releases(self, objtype):
+        """实体使用中的版本与最近的release_keep个版本保留, 其他删除"""
+        root = self.release_root(objtype)
+        if not os.path.exists(root):
+            return
+        used = set()
+        for entity in self.entitys:
+            if self._objtype(entity) != objtype:
+                continue
+            for link in (self.current_release(entity), self.previous_release(entity)):
+                if os.path.islink(link):
+                    used.add(os.path.basename(os.path.realpath(link)))
+        releases = [name for name in os.listdir(root) if not name.endswith('.tmp')]
+        releases.sort(key=lambda name: os.path.getmtime(os.path.join(root, name)), reverse=True)
+        keep = CONF[common.NAME].release_keep
+        with self.rlock:
+            for index, name in enumerate(releases):
+                if index < keep or name in used:
+                    continue
+                LOG.info('Remove old %s release %s' % (objtype, name))
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
     def start_entity(self, entity, **kwargs):
         pids = kwargs.get('pids')
         objtype = self._objtype(entity)
@@ -528,6 +1079,9 @@ class Application(AppEndpointBase):
         if not os.path.exists(EXEC):
             raise ValueError('Execute targe %s not exist' % EXEC)
         if not os.access(EXEC, os.X_OK):
+            # 版本目录中的文件由多个实体共享, 不修改共享文件的权限
+            if self.entity_release(entity):
+                raise ValueError('Execute targe %s not executable' % EXEC)
             os.chmod(EXEC, 0o744)
         args = [EXEC, ]
         with self.lock(entity):
@@ -594,6 +1148,8 @@ class Application(AppEndpointBase):
             p = self._entity_process(entity, pids)
             if not p:
                 return
+            # 主动停止不需要退出回调
+            self._unsupervise(entity)
             # 程序默认使用SIGINT停服兼容windows和linux
             sig = signal.SIGINT if not kill else signal.SIGKILL
             os.kill(p.pid, sig)
@@ -690,21 +1246,60 @@ class Application(AppEndpointBase):
         if kwargs.get('migrate'):
             self._placeholder(common.NAME, entity)
 
+    def find_file(self, md5):
+        """查找本地文件, 包括从其他agent获取的文件"""
+        if self.peerfiles:
+            return self.peerfiles.find(md5)
+        return self.filemanager.find(md5)
+
+    def rpc_peer_getfile(self, ctxt, md5, plan, peers, **kwargs):
+        """
+        agent之间分发文件, plan为{agent_id: 上级agent_id}
+        依次从上级链中的agent获取文件, 没有上级或者上级都失败时从源地址下载
+        """
+        timeout = count_timeout(ctxt, kwargs)
+        sources = []
+        parent = plan.get(str(self.manager.agent_id))
+        while parent is not None and len(sources) < 3:
+            url = peers.get(str(parent))
+            if url:
+                sources.append('%s/files/%s' % (url, md5))
+            parent = plan.get(str(parent))
+        _start = time.time()
+        try:
+            if self.peerfiles:
+                localfile, source = self.peerfiles.fetch(md5, sources, timeout,
+                                                         token=ctxt.get('peer_token'))
+            else:
+                localfile, source = self.filemanager.get(md5, download=True, timeout=timeout), None
+        except Exception as e:
+            LOG.error('Get file %s fail, %s' % (md5, e.__class__.__name__))
+            return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                              resultcode=manager_common.RESULT_ERROR,
+                                              ctxt=ctxt,
+                                              result='get file %s fail, %s' % (md5, e.__class__.__name__))
+        return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                          ctxt=ctxt,
+                                          result='get file %s from %s success, size %d, time %.2f' %
+                                                 (md5, source or 'origin', localfile.size,
+                                                  time.time() - _start))
+
     def rpc_check_file(self, ctxt, appfile, objtype, **kwargs):
         try:
-            localfile = self.filemanager.find(appfile)
+            localfile = self.find_file(appfile)
         except NoFileFound:
             return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
                                               resultcode=manager_common.RESULT_ERROR,
                                               ctxt=ctxt,
                                               result='check %s file fail, appfile not find' % objtype)
         try:
-            gfile.check(objtype, localfile.path)
+            if offload.execute('check', gfile.check, objtype, localfile.path, appfile):
+                LOG.warning('Archive index of %s broken, rebuilt' % appfile)
         except ValueError as e:
             return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
                                               resultcode=manager_common.RESULT_ERROR,
                                               ctxt=ctxt,
-                                              result='check %s file fail, %s' % e.message)
+                                              result='check %s file fail, %s' % (objtype, e.message))
         return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
                                           ctxt=ctxt,
                                           resultcode=manager_common.RESULT_SUCCESS,
@@ -723,15 +1318,17 @@ class Application(AppEndpointBase):
                                                   result='entity is running, can not reset')
             objtype = self.konwn_appentitys[entity].get('objtype')
             if appfile:
+                md5 = appfile
                 try:
-                    localfile = self.filemanager.find(appfile)
+                    localfile = self.find_file(appfile)
                 except NoFileFound:
                     return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
                                                       resultcode=manager_common.RESULT_ERROR,
                                                       ctxt=ctxt,
                                                       result='reset %s.%d fail, appfile not find' % (objtype, entity))
+                if offload.execute('check', gfile.check, objtype, localfile.path, appfile):
+                    LOG.warning('Archive index of %s broken, rebuilt' % appfile)
                 appfile = localfile.path
-                gfile.check(objtype, appfile)
                 if not os.path.exists(self.entity_home(entity)):
                     LOG.warning('Entity is full reset!')
                     with self._prepare_entity_path(entity):
@@ -749,6 +1346,10 @@ class Application(AppEndpointBase):
                 LOG.info('Remove path %s' % apppath)
                 if os.path.exists(apppath):
                     shutil.rmtree(apppath)
+                # 程序目录重新解压, 不再使用版本目录
+                if self.clear_release(entity):
+                    LOG.info('Entity %d release links removed' % entity)
+                    self.prune_releases(objtype)
                 os.makedirs(apppath, 0o755)
                 systemutils.chown(apppath, self.entity_user(entity), self.entity_group(entity))
                 if not os.path.exists(confdir):
@@ -763,7 +1364,7 @@ class Application(AppEndpointBase):
                         f.write('\n')
                 used = time.time() - _start
                 timeout -= used
-                waiter = self.extract_entity_file(entity, objtype, appfile, timeout)
+                waiter = self.extract_entity_file(entity, objtype, appfile, timeout, md5=md5)
                 waiter.wait()
             self.flush_config(entity, databases=databases,
                               opentime=kwargs.get('opentime'), chiefs=chiefs)
@@ -881,7 +1482,7 @@ class Application(AppEndpointBase):
                                               result='start entitys fail, no entitys found')
         details = []
         # 启动前进程快照
-        proc_snapshot_before = utils.find_process()
+        proc_snapshot_before = self.procindex.refresh()
         formater = AsyncActionResult('start', self.konwn_appentitys)
 
         def safe_wapper(__entity):
@@ -914,7 +1515,7 @@ class Application(AppEndpointBase):
         LOG.info('Bluck start entity end, time user %1.2f' % (time.time() - start))
         responsed_entitys = set()
         # 启动后进程快照
-        proc_snapshot_after = utils.find_process()
+        proc_snapshot_after = self.procindex.refresh()
         # 确认启动成功
         for detail in details:
             entity = detail.get('detail_id')
@@ -963,7 +1564,7 @@ class Application(AppEndpointBase):
             eventlet.sleep(min(delay, 65))
         details = []
         # 停止前进程快照
-        proc_snapshot_before = utils.find_process()
+        proc_snapshot_before = self.procindex.refresh()
         formater = AsyncActionResult('stop', self.konwn_appentitys)
 
         def safe_wapper(__entity):
@@ -996,7 +1597,7 @@ class Application(AppEndpointBase):
 
         responsed_entitys = set()
         # 停止后进程快照
-        proc_snapshot_after = utils.find_process()
+        proc_snapshot_after = self.procindex.refresh()
         for detail in details:
             entity = detail.get('detail_id')
             # 确认entity进程
@@ -1017,6 +1618,37 @@ class Application(AppEndpointBase):
                                           ctxt=ctxt,
                                           result='Stop entitys end', details=details)
 
+    def rpc_metrics(self, ctxt, since=None, flow=None, kind=None, limit=None, **kwargs):
+        """返回本地taskflow执行记录"""
+        records = self.metrics.query(since=since, flow=flow, kind=kind, limit=limit)
+        if kind in (None, 'offload') and not flow:
+            # 系统线程执行统计, 当前快照
+            records.extend(offload.stats())
+        return MetricsResult(agent_id=self.manager.agent_id, ctxt=ctxt,
+                             resultcode=manager_common.RESULT_SUCCESS,
+                             result='Get metrics success', records=records)
+
+    def rpc_profile(self, ctxt, dump=False, reset=False, **kwargs):
+        """
+        返回rpc耗时直方图, 实体锁等待时间, hub阻塞记录与系统线程执行统计
+        dump为True时同时写入本地文件, reset为True时返回后清空统计
+        """
+        snapshot = profile.profiler.snapshot()
+        snapshot['offload'] = offload.stats()
+        result = 'Get profile success'
+        if dump:
+            path = os.path.join(self.endpoint_backup, 'profile')
+            if not os.path.exists(path):
+                os.makedirs(path, mode=0o755)
+            path = profile.profiler.dump(os.path.join(path, 'profile-%d.json' % int(time.time())),
+                                         offload=snapshot['offload'])
+            result = 'Get profile success, dump to %s' % path
+        if reset:
+            profile.profiler.reset()
+        return ProfileResult(agent_id=self.manager.agent_id, ctxt=ctxt,
+                             resultcode=manager_common.RESULT_SUCCESS,
+                             result=result, profile=snapshot)
+
     def rpc_status_entitys(self, ctxt, entitys, **kwargs):
         entitys = argutils.map_to_int(entitys) & set(self.entitys)
         if not entitys:
@@ -1025,7 +1657,7 @@ class Application(AppEndpointBase):
                                               ctxt=ctxt,
                                               result='status entitys fail, no entitys found')
         details = []
-        proc_snapshot = utils.find_process()
+        proc_snapshot = self.procindex.refresh()
         formater = AsyncActionResult('status', self.konwn_appentitys)
         for entity in entitys:
             if self._entity_process(entity, proc_snapshot) and not self.konwn_appentitys[entity]['started']:
@@ -1061,7 +1693,7 @@ class Application(AppEndpointBase):
         formater = AsyncActionResult('upgrade', self.konwn_appentitys)
         with self.locks(entitys):
             # 启动前进程快照
-            proc_snapshot_before = utils.find_process()
+            proc_snapshot_before = self.procindex.refresh()
             for entity in entitys:
                 if self._entity_process(entity, proc_snapshot_before):
                     for __entity in entitys:
@@ -1121,6 +1753,157 @@ class Application(AppEndpointBase):
                                           details=details,
                                           result=result)
 
+    def rpc_prepare_entitys(self, ctxt, entitys, **kwargs):
+        """
+        两阶段更新的准备阶段, 程序运行中下载校验并解压到版本目录
+        """
+        entitys = argutils.map_to_int(entitys) & set(self.entitys)
+        if not entitys:
+            return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                              resultcode=manager_common.RESULT_ERROR,
+                                              ctxt=ctxt,
+                                              result='prepare entity fail, no entitys found')
+        appfile = kwargs.get('appfile')
+        objtype = kwargs.get('objtype')
+        md5 = appfile.get('md5')
+        timeout = appfile.get('timeout')
+        for entity in entitys:
+            if self._objtype(entity) != objtype:
+                return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                                  resultcode=manager_common.RESULT_ERROR,
+                                                  ctxt=ctxt,
+                                                  result='prepare entity %d not %s' % (entity, objtype))
+        upgradefile = GogameAppFile(md5, objtype, deltas=appfile.get('deltas'))
+        try:
+            upgradefile.prepare(self, timeout)
+            localfile = upgradefile.localfile
+        except Exception as e:
+            LOG.error('Prepare %s file %s fail, %s' % (objtype, md5, e.__class__.__name__))
+            return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                              resultcode=manager_common.RESULT_ERROR,
+                                              ctxt=ctxt,
+                                              result='prepare %s fail, get appfile fail' % objtype)
+        details = []
+        formater = AsyncActionResult('prepare', self.konwn_appentitys)
+        stage = AppStage(self.stagepath, md5, extractor=self.async_extract)
+        # 同objtype的实体共享一个版本目录, 只需准备一次
+        try:
+            self.prepare_release(objtype, md5, localfile.path, timeout, stage)
+        except Exception as e:
+            LOG.exception('Prepare %s release %s fail' % (objtype, md5))
+            for entity in entitys:
+                details.append(formater(entity, manager_common.RESULT_ERROR,
+                                        'prepare entity %d fail: %s' % (entity, e.__class__.__name__)))
+        else:
+            for entity in entitys:
+                details.append(formater(entity, manager_common.RESULT_SUCCESS))
+        finally:
+            upgradefile.clean()
+        return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                          ctxt=ctxt,
+                                          result='Prepare %s entitys end' % objtype, details=details)
+
+    def _switch_entitys(self, ctxt, action, entitys, switch, overtime):
+        """停止程序, 切换版本软链, 原来运行中的程序重新启动"""
+        details = []
+        formater = AsyncActionResult(action, self.konwn_appentitys)
+        proc_snapshot_before = self.procindex.refresh()
+
+        def safe_wapper(__entity):
+            running = self._entity_process(__entity, proc_snapshot_before)
+            try:
+                if running:
+                    self.konwn_appentitys[__entity]['started'] = False
+                    self.stop_entity(__entity, pids=proc_snapshot_before)
+                    while self._entity_process(__entity):
+                        if time.time() > overtime:
+                            raise RpcEntityError(endpoint=common.NAME, entity=__entity,
+                                                 reason='Stop entity overtime')
+                        eventlet.sleep(0.5)
+                with self.lock(__entity):
+                    switch(__entity)
+                if running:
+                    self.start_entity(__entity)
+                    eventlet.sleep(1.0)
+                    if not self._entity_process(__entity):
+                        raise RpcEntityError(endpoint=common.NAME, entity=__entity,
+                                             reason='Process not exist after start')
+                    self.konwn_appentitys[__entity]['started'] = True
+            except Exception as e:
+                LOG.exception('%s release of entity %d fail' % (action, __entity))
+                details.append(formater(__entity, manager_common.RESULT_ERROR,
+                                        '%s entity %d fail: %s' % (action, __entity, e.__class__.__name__)))
+            else:
+                details.append(formater(__entity, manager_common.RESULT_SUCCESS))
+
+        for entity in entitys:
+            eventlet.spawn_n(safe_wapper, entity)
+        while len(details) < len(entitys):
+            eventlet.sleep(0.1)
+            if time.time() > overtime + 5:
+                LOG.error('%s get details overtime' % action)
+                break
+        responsed_entitys = set([detail.get('detail_id') for detail in details])
+        for no_response_entity in (entitys - responsed_entitys):
+            details.append(formater(no_response_entity, manager_common.RESULT_ERROR,
+                                    '%s entity %d overtime, result unkonwn' % (action, no_response_entity)))
+        return details
+
+    def rpc_commit_entitys(self, ctxt, entitys, **kwargs):
+        """
+        两阶段更新的提交阶段, 停止程序, 切换版本软链, 原来运行中的程序重新启动
+        """
+        timeout = count_timeout(ctxt, kwargs)
+        overtime = timeout + time.time()
+        entitys = argutils.map_to_int(entitys) & set(self.entitys)
+        if not entitys:
+            return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                              resultcode=manager_common.RESULT_ERROR,
+                                              ctxt=ctxt,
+                                              result='commit entity fail, no entitys found')
+        appfile = kwargs.get('appfile')
+        objtype = kwargs.get('objtype')
+        md5 = appfile.get('md5')
+        for entity in entitys:
+            if self._objtype(entity) != objtype:
+                return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                                  resultcode=manager_common.RESULT_ERROR,
+                                                  ctxt=ctxt,
+                                                  result='commit entity %d not %s' % (entity, objtype))
+        if not os.path.isdir(os.path.join(self.release_root(objtype), md5)):
+            return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                              resultcode=manager_common.RESULT_ERROR,
+                                              ctxt=ctxt,
+                                              result='commit %s fail, release not prepared' % objtype)
+        details = self._switch_entitys(ctxt, 'commit', entitys,
+                                       lambda entity: self.switch_release(entity, md5), overtime)
+        return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                          ctxt=ctxt,
+                                          result='Commit %s entitys end' % objtype, details=details)
+
+    def rpc_rollback_entitys(self, ctxt, entitys, **kwargs):
+        """
+        版本目录模式回滚, 切换到上一个版本
+        """
+        timeout = count_timeout(ctxt, kwargs)
+        overtime = timeout + time.time()
+        entitys = argutils.map_to_int(entitys) & set(self.entitys)
+        if not entitys:
+            return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                              resultcode=manager_common.RESULT_ERROR,
+                                              ctxt=ctxt,
+                                              result='rollback entity fail, no entitys found')
+        for entity in entitys:
+            if not os.path.isdir(self.previous_release(entity)):
+                return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                                  resultcode=manager_common.RESULT_ERROR,
+                                                  ctxt=ctxt,
+                                                  result='rollback entity %d fail, no previous release' % entity)
+        details = self._switch_entitys(ctxt, 'rollback', entitys, self.rollback_release, overtime)
+        return resultutils.AgentRpcResult(agent_id=self.manager.agent_id,
+                                          ctxt=ctxt,
+                                          result='Rollback entitys end', details=details)
+
     def rpc_flushconfig_entitys(self, ctxt, entitys, **kwargs):
         entitys = argutils.map_to_int(entitys) & set(self.entitys)
         force = kwargs.pop('force', False)
@@ -1132,7 +1915,7 @@ class Application(AppEndpointBase):
         details = []
         formater = AsyncActionResult('flushconfig', self.konwn_appentitys)
         # 启动前进程快照
-        proc_snapshot_before = utils.find_process()
+        proc_snapshot_before = self.procindex.refresh()
         with self.locks(entitys):
             for entity in entitys:
                 if not force and self._entity_process(entity, proc_snapshot_before):
@@ -1368,3 +2151,7 @@ class Application(AppEndpointBase):
                                           resultcode=manager_common.RESULT_SUCCESS,
                                           ctxt=ctxt,
                                           result='continue merge task %s spawned' % uuid)
+
+
+# rpc方法耗时统计
+profile.instrument(Application)
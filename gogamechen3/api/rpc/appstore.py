@@ -0,0 +1,233 @@
+# -*- coding:utf-8 -*-
+import os
+import stat
+import time
+import json
+import errno
+import shutil
+import hashlib
+import fcntl
+import eventlet
+
+from eventlet.semaphore import Semaphore
+
+from simpleutil.log import log as logging
+from simpleutil.utils import systemutils
+
+from gogamechen3.api import gfile
+from gogamechen3.api.rpc import offload
+
+
+LOG = logging.getLogger(__name__)
+
+# linux FICLONE ioctl, btrfs/xfs上共享数据块的写时复制
+FICLONE = 0x40049409
+
+
+def _md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(1048576)
+            if not buf:
+                break
+            md5.update(buf)
+    return md5.hexdigest()
+
+
+def _clone(src, dst):
+    """优先reflink复制文件, 文件系统不支持时普通复制"""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                shutil.copyfileobj(fsrc, fdst, 1048576)
+    shutil.copystat(src, dst)
+
+
+class AppStore(object):
+    """
+    程序文件内容寻址存储
+    objects/<md5前两位>/<md5>-<权限> 保存文件内容, 相同内容只保存一份
+    trees/<name>.json 记录程序文件目录结构
+    属主为agent用户并且组与其他用户不可写的文件硬链接到实体程序目录, 实体用户无法修改
+    配置与日志等实体可写的文件是独立的副本(支持时用reflink), 属主为实体用户
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.trees = os.path.join(root, 'trees')
+        self.lock = Semaphore(1)
+        for path in (self.objects, self.trees):
+            if not os.path.exists(path):
+                os.makedirs(path, mode=0o755)
+
+    def _treefile(self, name):
+        return os.path.join(self.trees, '%s.json' % name)
+
+    def _object(self, key):
+        return os.path.join(self.objects, key[:2], key)
+
+    def tree(self, name):
+        treefile = self._treefile(name)
+        if not os.path.exists(treefile):
+            return None
+        with open(treefile, 'rb') as f:
+            tree = json.load(f)
+        # 更新时间, 过期清理依据
+        os.utime(treefile, None)
+        return tree
+
+    def ingest(self, name, path):
+        """将解压目录中的文件加入存储, 返回目录结构"""
+        tree = dict(dirs=[], files={}, links={})
+        count = 0
+        with self.lock:
+            for root, dirs, files in os.walk(path):
+                relroot = os.path.relpath(root, path)
+                for _dir in dirs:
+                    _path = os.path.join(root, _dir)
+                    relpath = os.path.normpath(os.path.join(relroot, _dir))
+                    if os.path.islink(_path):
+                        tree['links'][relpath] = os.readlink(_path)
+                    else:
+                        tree['dirs'].append(relpath)
+                for _file in files:
+                    _path = os.path.join(root, _file)
+                    relpath = os.path.normpath(os.path.join(relroot, _file))
+                    if os.path.islink(_path):
+                        tree['links'][relpath] = os.readlink(_path)
+                        continue
+                    mode = stat.S_IMODE(os.stat(_path).st_mode)
+                    key = '%s-%o' % (offload.execute('md5', _md5, _path), mode)
+                    obj = self._object(key)
+                    if not os.path.exists(obj):
+                        objdir = os.path.dirname(obj)
+                        if not os.path.exists(objdir):
+                            os.makedirs(objdir, mode=0o755)
+                        try:
+                            os.link(_path, obj)
+                        except OSError as e:
+                            if e.errno != errno.EXDEV:
+                                raise
+                            shutil.copy2(_path, obj)
+                    tree['files'][relpath] = key
+                    count += 1
+            tree['dirs'].sort()
+            treefile = self._treefile(name)
+            with open(treefile + '.tmp', 'wb') as f:
+                json.dump(tree, f)
+            os.rename(treefile + '.tmp', treefile)
+        LOG.info('Ingest %d files into app store as %s' % (count, name))
+        return tree
+
+    def assemble(self, tree, dst, user, group, exclude=gfile.exclude_by_name):
+        """
+        组装实体程序目录, 先链接或复制到临时文件再覆盖, 替换过程中不存在半个文件
+        不可修改的文件与存储共享inode, exclude匹配的文件复制并修改属主
+        已经是同一inode或者大小与修改时间相同的副本跳过
+        """
+        for relpath in tree['dirs']:
+            path = os.path.join(dst, relpath)
+            if not os.path.exists(path):
+                os.makedirs(path, mode=0o755)
+                systemutils.chown(path, user, group)
+        files = [(self._object(key), os.path.join(dst, relpath), bool(exclude and exclude(relpath)))
+                 for relpath, key in tree['files'].iteritems()]
+        count = offload.execute('assemble', self._assemble, files, user, group)
+        for relpath, target in tree['links'].iteritems():
+            path = os.path.join(dst, relpath)
+            if os.path.lexists(path):
+                if os.path.islink(path) and os.readlink(path) == target:
+                    continue
+                os.remove(path)
+            os.symlink(target, path)
+        LOG.debug('Assemble %d files to %s' % (count, dst))
+
+    @staticmethod
+    def _shareable(src):
+        """属主为agent用户并且组与其他用户不可写"""
+        return src.st_uid == os.geteuid() and not stat.S_IMODE(src.st_mode) & 0o022
+
+    @staticmethod
+    def _assemble(files, user, group):
+        """在线程中执行, 不打日志"""
+        count = 0
+        for obj, path, writable in files:
+            src = os.stat(obj)
+            share = not writable and AppStore._shareable(src)
+            try:
+                st = os.lstat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                if share:
+                    if st.st_ino == src.st_ino and st.st_dev == src.st_dev:
+                        continue
+                elif stat.S_ISREG(st.st_mode) and st.st_nlink == 1 \
+                        and st.st_size == src.st_size and int(st.st_mtime) == int(src.st_mtime) \
+                        and stat.S_IMODE(st.st_mode) == stat.S_IMODE(src.st_mode):
+                    continue
+            tmp = path + '.store-tmp'
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            if share:
+                try:
+                    os.link(obj, tmp)
+                except OSError as e:
+                    # 跨文件系统时复制
+                    if e.errno != errno.EXDEV:
+                        raise
+                    share = False
+            if not share:
+                _clone(obj, tmp)
+                systemutils.chown(tmp, user, group)
+            os.rename(tmp, path)
+            count += 1
+        return count
+
+    def gc(self, expire):
+        """清理过期的目录结构与没有被引用的文件"""
+        overtime = time.time() - expire
+        keys = set()
+        with self.lock:
+            for name in os.listdir(self.trees):
+                treefile = os.path.join(self.trees, name)
+                if os.path.getmtime(treefile) < overtime:
+                    LOG.info('Remove expired app tree %s' % name)
+                    os.remove(treefile)
+                    continue
+                with open(treefile, 'rb') as f:
+                    keys.update(json.load(f)['files'].itervalues())
+            count = 0
+            for prefix in os.listdir(self.objects):
+                objdir = os.path.join(self.objects, prefix)
+                for key in os.listdir(objdir):
+                    obj = os.path.join(objdir, key)
+                    # 没有目录结构引用并且解压目录与实体程序目录都不再链接
+                    if key not in keys and os.stat(obj).st_nlink <= 1:
+                        os.remove(obj)
+                        count += 1
+                eventlet.sleep(0)
+        if count:
+            LOG.info('Remove %d unused objects from app store' % count)
+
+
+class AssembleWaiter(object):
+    """与解压waiter接口一致的组装waiter"""
+
+    def __init__(self, func, *args, **kwargs):
+        self.thread = eventlet.spawn(func, *args, **kwargs)
+
+    @property
+    def finished(self):
+        return self.thread.dead
+
+    def wait(self):
+        return self.thread.wait()
+
+    def stop(self):
+        self.thread.kill()
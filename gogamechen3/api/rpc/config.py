@@ -29,7 +29,80 @@ agent_opts = [
     cfg.IntOpt('pop_from_deads',
                default=180,
                min=30, max=600,
-               help='Entity will remove from auto restart periodic task dead process list after seconds')
+               help='Entity will remove from auto restart periodic task dead process list after seconds'),
+    cfg.BoolOpt('process_supervise',
+                default=False,
+                help='Watch entity process exit by pidfd, dead entity process will be '
+                     'restarted immediately, fall back to periodic check when pidfd not supported'),
+    cfg.IntOpt('merge_workers',
+               default=4,
+               min=1, max=32,
+               help='Merge database dump and load worker count, tables dump/load in parallel'),
+    cfg.BoolOpt('merge_stream',
+                default=False,
+                help='Merge database stream mysqldump output into target database directly, '
+                     'without sql file, source and target database must be reachable'),
+    cfg.StrOpt('merge_codec',
+               default='auto',
+               choices=['auto', 'zstd', 'lz4', 'gzip', 'none'],
+               help='Merge database dump file compress codec, auto means try zstd, lz4, gzip in order, '
+                    'gzip use python stdlib when gzip command not found'),
+    cfg.IntOpt('merge_insert_batch',
+               default=1024,
+               min=16, max=16384,
+               help='Merge database multi-row insert statement max size by KB, '
+                    'must less then max_allowed_packet of target database'),
+    cfg.BoolOpt('upgrade_stage',
+                default=False,
+                help='Upgrade file extract once to stage path, then copy to each entity'),
+    cfg.BoolOpt('app_store',
+                default=False,
+                help='Assemble entity app files by hardlink from a content-addressed store, '
+                     'same file of all entitys saved only once'),
+    cfg.IntOpt('metrics_size',
+               default=16,
+               min=1, max=1024,
+               help='Taskflow metrics file max size by MB, rotate when over size'),
+    cfg.BoolOpt('upgrade_increment',
+                default=False,
+                help='Upgrade entity write changed files only by appfile manifest'),
+    cfg.PortOpt('peer_port',
+                default=0,
+                help='Serve files to other agents on this port of local ip, 0 means disabled'),
+    cfg.IntOpt('peer_rate',
+               default=20480,
+               min=0,
+               help='Peer file server upload rate limit by KB/s, 0 means no limit'),
+    cfg.IntOpt('download_connections',
+               default=0,
+               min=0, max=32,
+               help='Download appfile by multiple range connections with resume, '
+                    '0 or 1 means download by file manager'),
+    cfg.IntOpt('download_chunk',
+               default=8,
+               min=1, max=256,
+               help='Multiple connections download chunk size by MB'),
+    cfg.IntOpt('download_rate',
+               default=0,
+               min=0,
+               help='Multiple connections download rate limit by KB/s, 0 means no limit'),
+    cfg.IntOpt('extract_workers',
+               default=1,
+               min=0, max=64,
+               help='Processes to extract appfile, 1 means extract by single process, '
+                    '0 means cpu count'),
+    cfg.IntOpt('offload_threads',
+               default=8,
+               min=1, max=64,
+               help='System threads to run cpu or disk heavy work out of eventlet hub'),
+    cfg.FloatOpt('hub_block_threshold',
+                 default=0.0,
+                 min=0,
+                 help='Record stack when eventlet hub blocked over this seconds, 0 means disabled'),
+    cfg.IntOpt('release_keep',
+               default=3,
+               min=1, max=20,
+               help='Keep newest releases of each objtype, releases used by entitys always keep'),
 ]
 
 sources_opts = [
@@ -0,0 +1,229 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import errno
+import hashlib
+import eventlet
+
+from eventlet.green import urllib2
+
+from simpleutil.log import log as logging
+
+from gogamechen3.api.rpc import offload
+
+
+LOG = logging.getLogger(__name__)
+
+BLOCK = 65536
+
+
+class DownloadError(Exception):
+    """Download file fail"""
+
+
+class Downloader(object):
+    """
+    多连接可断点续传下载
+    文件按chunk分段用range请求并发下载, 已完成的分段记录在<path>.state, 失败后重新下载时跳过
+    已完成的连续分段即时计算md5, 下载结束时只剩少量数据需要计算
+    分段失败时换下一个地址重试, bucket为共享的限速令牌桶
+    """
+
+    def __init__(self, sources, path, md5, connections=4, chunk=8388608, bucket=None, headers=None):
+        self.sources = list(sources)
+        # 附加请求头, peer文件服务认证用
+        self.headers = headers or {}
+        self.path = path
+        self.md5 = md5
+        self.connections = connections
+        self.chunk = chunk
+        self.bucket = bucket
+        self.part = path + '.part'
+        self.statefile = path + '.state'
+        self.size = None
+        self.done = set()
+        self.checksum = hashlib.md5()
+        self.hashed = 0
+        self.hashing = False
+        # 统计
+        self.received = 0
+        self.resumed = 0
+
+    def _probe(self, deadline):
+        """获取文件大小与是否支持range"""
+        for url in self.sources:
+            request = urllib2.Request(url, headers=self.headers)
+            request.get_method = lambda: 'HEAD'
+            try:
+                response = urllib2.urlopen(request, timeout=max(1, min(10, deadline - time.time())))
+            except Exception as e:
+                LOG.warning('Probe %s fail, %s' % (url, e.__class__.__name__))
+                continue
+            try:
+                size = response.info().getheader('Content-Length')
+                ranged = response.info().getheader('Accept-Ranges') == 'bytes'
+            finally:
+                response.close()
+            # 支持range的地址优先
+            self.sources.remove(url)
+            self.sources.insert(0, url)
+            return int(size) if size else None, ranged
+        raise DownloadError('No source available')
+
+    def _load(self):
+        if not os.path.exists(self.statefile) or not os.path.exists(self.part):
+            return
+        try:
+            with open(self.statefile, 'rb') as f:
+                state = json.load(f)
+        except ValueError:
+            return
+        if (state.get('md5'), state.get('size'), state.get('chunk')) == (self.md5, self.size, self.chunk):
+            self.done = set(state.get('done', []))
+            self.resumed = len(self.done)
+
+    def _save(self):
+        with open(self.statefile + '.tmp', 'wb') as f:
+            json.dump(dict(md5=self.md5, size=self.size, chunk=self.chunk,
+                           done=sorted(self.done)), f)
+        os.rename(self.statefile + '.tmp', self.statefile)
+
+    def _advance(self):
+        """计算已完成的连续分段md5, 正在计算时新完成的分段由正在计算的线程继续"""
+        index = self.hashed // self.chunk
+        if self.hashing or index not in self.done:
+            return
+        self.hashing = True
+        try:
+            while index in self.done:
+                offload.execute('md5', self._hash, index)
+                self.hashed = min(self.size, (index + 1) * self.chunk)
+                index += 1
+        finally:
+            self.hashing = False
+
+    def _hash(self, index):
+        """在系统线程中计算一个分段的md5"""
+        with open(self.part, 'rb') as f:
+            f.seek(index * self.chunk)
+            left = min(self.chunk, self.size - index * self.chunk)
+            while left > 0:
+                buf = f.read(min(BLOCK, left))
+                if not buf:
+                    raise DownloadError('Part file truncated')
+                left -= len(buf)
+                self.checksum.update(buf)
+
+    def _read(self, response, f, deadline, length=None):
+        count = 0
+        while length is None or count < length:
+            if time.time() > deadline:
+                raise DownloadError('Download overtime')
+            buf = response.read(BLOCK if length is None else min(BLOCK, length - count))
+            if not buf:
+                break
+            if self.bucket:
+                self.bucket.consume(len(buf))
+            f.write(buf)
+            count += len(buf)
+            self.received += len(buf)
+            yield buf
+        if length is not None and count != length:
+            raise DownloadError('Range response size %d not match %d' % (count, length))
+
+    def _fetch(self, index, deadline):
+        start = index * self.chunk
+        end = min(self.size, start + self.chunk) - 1
+        error = None
+        for url in self.sources:
+            headers = dict(self.headers)
+            headers['Range'] = 'bytes=%d-%d' % (start, end)
+            request = urllib2.Request(url, headers=headers)
+            try:
+                response = urllib2.urlopen(request, timeout=max(1, min(30, deadline - time.time())))
+                try:
+                    if response.getcode() != 206:
+                        raise DownloadError('Source not support range')
+                    with open(self.part, 'r+b') as f:
+                        f.seek(start)
+                        for buf in self._read(response, f, deadline, end - start + 1):
+                            pass
+                finally:
+                    response.close()
+            except Exception as e:
+                LOG.debug('Fetch chunk %d from %s fail, %s' % (index, url, e.__class__.__name__))
+                error = e
+                continue
+            self.done.add(index)
+            self._save()
+            self._advance()
+            return
+        raise DownloadError('Fetch chunk %d fail, %s' % (index, error.__class__.__name__))
+
+    def _stream(self, deadline):
+        """不支持range的地址, 单连接下载"""
+        error = None
+        for url in self.sources:
+            self.checksum = hashlib.md5()
+            try:
+                response = urllib2.urlopen(urllib2.Request(url, headers=self.headers),
+                                           timeout=max(1, min(30, deadline - time.time())))
+                try:
+                    with open(self.part, 'wb') as f:
+                        for buf in self._read(response, f, deadline):
+                            self.checksum.update(buf)
+                finally:
+                    response.close()
+            except Exception as e:
+                LOG.warning('Download from %s fail, %s' % (url, e.__class__.__name__))
+                error = e
+                continue
+            return
+        raise DownloadError('Download fail, %s' % error.__class__.__name__)
+
+    def _clean(self):
+        for path in (self.part, self.statefile):
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def run(self, timeout):
+        deadline = time.time() + timeout
+        self.size, ranged = self._probe(deadline)
+        if not ranged or not self.size:
+            self._stream(deadline)
+        else:
+            self._load()
+            if not self.done:
+                with open(self.part, 'wb') as f:
+                    f.truncate(self.size)
+            self._advance()
+            count = (self.size + self.chunk - 1) // self.chunk
+            pending = [index for index in range(count) if index not in self.done]
+            errors = []
+
+            def _safe_fetch(index):
+                try:
+                    self._fetch(index, deadline)
+                except Exception as e:
+                    errors.append(e)
+
+            pool = eventlet.GreenPool(max(1, self.connections))
+            for index in pending:
+                pool.spawn_n(_safe_fetch, index)
+            pool.waitall()
+            if errors:
+                # 已完成的分段已经记录, 下次下载时续传
+                raise errors[0]
+            self._advance()
+        if self.checksum.hexdigest() != self.md5:
+            self._clean()
+            raise DownloadError('File md5 not match')
+        os.rename(self.part, self.path)
+        self._clean()
+        LOG.info('Download %s success, received %d, resumed %d chunks' % (self.md5, self.received,
+                                                                          self.resumed))
+        return self.path
@@ -0,0 +1,162 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import json
+
+from eventlet.semaphore import Semaphore
+
+from simpleutil.log import log as logging
+
+from simpleflow import states
+from simpleflow.types import notifier
+
+from gogamechen3.api.rpc import offload
+
+
+LOG = logging.getLogger(__name__)
+
+OUTCOMES = frozenset([states.SUCCESS, states.FAILURE, states.REVERTED])
+
+BLOCK = 65536
+
+
+def _reversed_lines(path):
+    """从文件尾部按块倒序读取行"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remain = ''
+        while position > 0:
+            size = min(BLOCK, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remain).split('\n')
+            # 第一段可能是不完整的行, 与前一块合并
+            remain = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line
+        if remain:
+            yield remain
+
+
+class MetricsStore(object):
+    """
+    taskflow执行记录, 每行一个json记录
+    文件超过大小后轮转一次, 只保留一个旧文件
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.lock = Semaphore(1)
+
+    def record(self, **kwargs):
+        kwargs.setdefault('time', int(time.time()))
+        line = json.dumps(kwargs, separators=(',', ':')) + '\n'
+        with self.lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.maxsize:
+                    os.rename(self.path, self.path + '.1')
+                with open(self.path, 'ab') as f:
+                    f.write(line)
+            except (OSError, IOError) as e:
+                LOG.error('Write metrics record fail, %s' % e.strerror)
+
+    def _reversed(self):
+        """从新到旧遍历记录"""
+        for path in (self.path, self.path + '.1'):
+            if not os.path.exists(path):
+                continue
+            for line in _reversed_lines(path):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # 写入中断的行
+                    continue
+
+    def _query(self, since=None, flow=None, kind=None, limit=None):
+        """在系统线程中执行, 记录按时间追加, 从尾部读到since或者limit条后停止"""
+        records = []
+        for record in self._reversed():
+            if since and record.get('time', 0) < since:
+                break
+            if flow and record.get('flow') != flow:
+                continue
+            if kind and record.get('kind') != kind:
+                continue
+            records.append(record)
+            if limit and len(records) >= limit:
+                break
+        records.reverse()
+        return records
+
+    def query(self, since=None, flow=None, kind=None, limit=None):
+        """
+        读取文件不持有写入锁, 写入中的不完整行被跳过
+        轮转发生在读取过程中时可能漏读少量记录
+        """
+        return offload.execute('metrics', self._query, since=since, flow=flow, kind=kind, limit=limit)
+
+
+class FlowRecorder(object):
+    """
+    通过engine的atom_notifier记录每个task耗时与结果
+    task的processed/rows属性作为处理的字节数与行数, host属性为数据库地址
+    """
+
+    def __init__(self, store, flow, **labels):
+        self.store = store
+        self.flow = flow
+        self.labels = labels
+        self.tasks = {}
+        self.starts = {}
+        self.start = time.time()
+
+    def track(self, task, **labels):
+        """记录task对象, 完成后读取处理量"""
+        self.tasks[task.name] = (task, labels)
+        return task
+
+    def attach(self, engine):
+        self.start = time.time()
+        try:
+            engine.atom_notifier.register(notifier.Notifier.ANY, self._notify)
+        except AttributeError:
+            LOG.warning('Engine has no atom notifier, task metrics not recorded')
+
+    def _notify(self, state, details):
+        name = details.get('task_name')
+        if not name:
+            return
+        if state == states.RUNNING:
+            self.starts[name] = time.time()
+            return
+        if state not in OUTCOMES:
+            return
+        start = self.starts.pop(name, None)
+        if start is None:
+            return
+        task, labels = self.tasks.get(name, (None, {}))
+        record = dict(self.labels)
+        record.update(labels)
+        record.update(kind='task', flow=self.flow, task=name, outcome=state,
+                      elapsed=round(time.time() - start, 3),
+                      size=getattr(task, 'processed', 0),
+                      rows=getattr(task, 'rows', 0))
+        if getattr(task, 'host', None):
+            record['host'] = task.host
+        self.store.record(**record)
+
+    def finish(self, error=None, size=None, **labels):
+        if size is None:
+            size = sum(getattr(task, 'processed', 0) for task, _ in self.tasks.values())
+        record = dict(self.labels)
+        record.update(labels)
+        record.update(kind='flow', flow=self.flow,
+                      outcome=states.FAILURE if error else states.SUCCESS,
+                      elapsed=round(time.time() - self.start, 3),
+                      size=size)
+        if error:
+            record['error'] = '%s: %s' % (error.__class__.__name__, str(error)[:256])
+        self.store.record(**record)
@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+"""
+耗cpu与阻塞磁盘的操作放到tpool系统线程中执行, 避免阻塞eventlet hub
+按名称统计调用次数, 排队时间, 执行时间与当前排队数量
+"""
+import time
+
+from eventlet import tpool
+
+from simpleutil.log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+# 执行时间超过时打印日志
+SLOW = 5.0
+
+_stats = {}
+_pending = [0, 0]
+
+
+def set_threads(threads):
+    tpool.set_num_threads(threads)
+
+
+def _record(name, wait, run, error):
+    stat = _stats.get(name)
+    if stat is None:
+        stat = _stats.setdefault(name, dict(calls=0, errors=0, wait=0.0, run=0.0,
+                                            max_wait=0.0, max_run=0.0))
+    stat['calls'] += 1
+    stat['errors'] += 1 if error else 0
+    stat['wait'] += wait
+    stat['run'] += run
+    stat['max_wait'] = max(stat['max_wait'], wait)
+    stat['max_run'] = max(stat['max_run'], run)
+    if run > SLOW:
+        LOG.warning('Offload %s run %.2fs, wait %.2fs' % (name, run, wait))
+
+
+def execute(name, func, *args, **kwargs):
+    """在系统线程中执行func, name为统计名称"""
+    submit = time.time()
+    times = []
+
+    def _run():
+        times.append(time.time())
+        return func(*args, **kwargs)
+
+    _pending[0] += 1
+    _pending[1] = max(_pending[1], _pending[0])
+    error = False
+    try:
+        return tpool.execute(_run)
+    except Exception:
+        error = True
+        raise
+    finally:
+        _pending[0] -= 1
+        end = time.time()
+        start = times[0] if times else end
+        _record(name, start - submit, end - start, error)
+
+
+def stats():
+    """统计快照, 时间单位秒"""
+    records = []
+    for name, stat in _stats.items():
+        record = dict(kind='offload', task=name, pending=_pending[0], max_pending=_pending[1])
+        record.update(stat)
+        for key in ('wait', 'run', 'max_wait', 'max_run'):
+            record[key] = round(record[key], 3)
+        records.append(record)
+    return records
@@ -0,0 +1,268 @@
+# -*- coding:utf-8 -*-
+import os
+import re
+import time
+import errno
+import eventlet
+
+from eventlet import wsgi
+from eventlet.green import urllib2
+from eventlet.semaphore import Semaphore
+
+from simpleutil.log import log as logging
+
+from goperation.filemanager import LocalFile
+from goperation.filemanager.exceptions import NoFileFound
+
+from gogamechen3.api.rpc.download import Downloader
+
+
+LOG = logging.getLogger(__name__)
+
+FILEPATH = re.compile('^/files/([0-9a-f]{32})$')
+RANGE = re.compile('^bytes=(\d+)-(\d*)$')
+
+BLOCK = 65536
+
+TOKENHEADER = 'X-Peer-Token'
+
+# agent上的peer文件缓存, GogameAppFile查找本地文件时使用
+_peerfiles = None
+
+
+def find(md5):
+    if _peerfiles is None:
+        raise NoFileFound('Peer files not enabled')
+    return _peerfiles.find(md5)
+
+
+def download(md5, timeout):
+    """多连接下载, 没有启用时返回None"""
+    if _peerfiles is None or not _peerfiles.connections:
+        return None
+    return _peerfiles.download(md5, timeout)
+
+
+class TokenBucket(object):
+    """令牌桶限速, rate为每秒字节数, 0为不限速"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.lock = Semaphore(1)
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            eventlet.sleep(wait)
+
+
+class PeerFiles(object):
+    """
+    agent之间分发文件
+    已有文件的agent通过http(支持range)向其他agent提供文件, 上传速度受rate限制
+    http服务只监听内网地址, 请求必须带有本次分发的token
+    从peer或者源地址多连接下载的文件保存在root中, 以md5校验
+    """
+
+    def __init__(self, root, filemanager, rate=0, client=None,
+                 connections=0, chunk=8388608, download_rate=0):
+        global _peerfiles
+        self.root = root
+        self.filemanager = filemanager
+        self.bucket = TokenBucket(rate)
+        # 多连接下载
+        self.client = client
+        self.connections = connections
+        self.chunk = chunk
+        self.download_bucket = TokenBucket(download_rate) if download_rate else None
+        self.locks = {}
+        # md5: {token: 过期时间}
+        self.tokens = {}
+        self.server = None
+        if not os.path.exists(root):
+            os.makedirs(root, mode=0o755)
+        _peerfiles = self
+
+    def _path(self, md5):
+        return os.path.join(self.root, md5)
+
+    def find(self, md5):
+        try:
+            return self.filemanager.find(md5)
+        except NoFileFound:
+            path = self._path(md5)
+            if not os.path.exists(path):
+                raise
+            return LocalFile(path, md5, os.path.getsize(path))
+
+    def _lock(self, md5):
+        return self.locks.setdefault(md5, Semaphore(1))
+
+    def allow(self, md5, token, overtime):
+        """
+        允许持有token的agent在overtime前获取文件
+        同一个文件可能同时有多次分发, 每个md5保存所有未过期的token
+        """
+        now = time.time()
+        for key in list(self.tokens):
+            tokens = self.tokens[key]
+            for _token in [_token for _token, _overtime in tokens.items() if _overtime < now]:
+                tokens.pop(_token)
+            if not tokens:
+                self.tokens.pop(key)
+        if token:
+            tokens = self.tokens.setdefault(md5, {})
+            tokens[token] = max(overtime, tokens.get(token, 0))
+
+    def _authorized(self, md5, token):
+        if not token:
+            return False
+        overtime = self.tokens.get(md5, {}).get(token)
+        return overtime is not None and overtime >= time.time()
+
+    def fetch(self, md5, sources, timeout, token=None):
+        """
+        按顺序从sources下载文件, 上级还没有文件时等待
+        所有peer失败后从源地址下载
+        """
+        overtime = time.time() + timeout
+        self.allow(md5, token, overtime)
+        headers = {TOKENHEADER: token} if token else None
+        with self._lock(md5):
+            try:
+                return self.find(md5), None
+            except NoFileFound:
+                pass
+            for url in sources:
+                # 每个peer最多等待剩余时间的一半
+                deadline = time.time() + (overtime - time.time()) / 2
+                try:
+                    self._wait(url, deadline, headers)
+                    self._download(md5, url, deadline, headers)
+                except Exception as e:
+                    LOG.warning('Get file %s from peer %s fail, %s: %s' % (md5, url, e.__class__.__name__,
+                                                                           str(e)))
+                    continue
+                return self.find(md5), url
+            timeout = max(1, int(overtime - time.time()))
+            if self.connections:
+                try:
+                    return self._download(md5, self._address(md5), time.time() + timeout), None
+                except Exception as e:
+                    LOG.warning('Download %s fail, %s: %s' % (md5, e.__class__.__name__, str(e)))
+            return self.filemanager.get(md5, download=True, timeout=timeout), None
+
+    def _address(self, md5):
+        """文件源地址"""
+        address = self.client.objfile_show(md5)['data'][0].get('address')
+        if not address or not address.startswith('http'):
+            raise ValueError('File address %s not http' % address)
+        return address
+
+    def download(self, md5, timeout):
+        """从源地址多连接下载"""
+        overtime = time.time() + (timeout or 3600)
+        with self._lock(md5):
+            try:
+                return self.find(md5)
+            except NoFileFound:
+                return self._download(md5, self._address(md5), overtime)
+
+    @staticmethod
+    def _wait(url, deadline, headers=None):
+        """等待上级peer完成下载"""
+        while True:
+            request = urllib2.Request(url, headers=headers or {})
+            request.get_method = lambda: 'HEAD'
+            try:
+                urllib2.urlopen(request, timeout=5).close()
+                return
+            except urllib2.HTTPError as e:
+                if e.code != 404:
+                    raise
+            if time.time() > deadline:
+                raise IOError(errno.ETIMEDOUT, 'Wait peer file overtime')
+            eventlet.sleep(1)
+
+    def _download(self, md5, url, deadline, headers=None):
+        downloader = Downloader([url], self._path(md5), md5,
+                                connections=max(1, self.connections), chunk=self.chunk,
+                                bucket=self.download_bucket, headers=headers)
+        downloader.run(max(1, deadline - time.time()))
+        return self.find(md5)
+
+    def clean(self, expire):
+        overtime = time.time() - expire
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            # 未完成的下载保留一段时间用于续传
+            if os.path.getmtime(path) < overtime:
+                LOG.info('Remove expired peer file %s' % name)
+                os.remove(path)
+
+    def __call__(self, environ, start_response):
+        match = re.match(FILEPATH, environ.get('PATH_INFO', ''))
+        method = environ.get('REQUEST_METHOD')
+        if not match or method not in ('GET', 'HEAD'):
+            start_response('400 Bad Request', [('Content-Length', '0')])
+            return []
+        md5 = match.group(1)
+        if not self._authorized(md5, environ.get('HTTP_X_PEER_TOKEN')):
+            start_response('403 Forbidden', [('Content-Length', '0')])
+            return []
+        try:
+            localfile = self.find(md5)
+        except NoFileFound:
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return []
+        size = os.path.getsize(localfile.path)
+        start, end = 0, size - 1
+        status = '200 OK'
+        headers = [('Accept-Ranges', 'bytes'), ('Content-Type', 'application/octet-stream')]
+        match = re.match(RANGE, environ.get('HTTP_RANGE', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            if start > end:
+                start_response('416 Requested Range Not Satisfiable',
+                               [('Content-Range', 'bytes */%d' % size), ('Content-Length', '0')])
+                return []
+            status = '206 Partial Content'
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+        headers.append(('Content-Length', str(end - start + 1)))
+        start_response(status, headers)
+        if method == 'HEAD':
+            return []
+        return self._read(localfile.path, start, end)
+
+    def _read(self, path, start, end):
+        with open(path, 'rb') as f:
+            f.seek(start)
+            left = end - start + 1
+            while left > 0:
+                buf = f.read(min(BLOCK, left))
+                if not buf:
+                    break
+                left -= len(buf)
+                self.bucket.consume(len(buf))
+                yield buf
+
+    def serve(self, host, port):
+        sock = eventlet.listen((host, port))
+        LOG.info('Peer file server listen on %s:%d' % (host, port))
+        self.server = eventlet.spawn(wsgi.server, sock, self, log_output=False, max_size=64)
+
+    def stop(self):
+        if self.server:
+            self.server.kill()
+            self.server = None
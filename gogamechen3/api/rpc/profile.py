@@ -0,0 +1,206 @@
+# -*- coding:utf-8 -*-
+"""
+agent性能分析
+
+HubMonitor: 系统线程检查hub心跳, 心跳超时说明有green线程长时间占用hub, 记录主线程当前堆栈
+Profiler: rpc方法耗时直方图, 实体锁等待时间
+"""
+import os
+import sys
+import time
+import json
+import functools
+import traceback
+import collections
+
+import eventlet
+from eventlet import patcher
+
+from simpleutil.log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+threading = patcher.original('threading')
+thread = patcher.original('thread')
+
+# 直方图区间上限, 秒
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        for index, bucket in enumerate(BUCKETS):
+            if value <= bucket:
+                break
+        else:
+            index = len(BUCKETS)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        buckets = dict(('<=%s' % bucket, self.counts[index]) for index, bucket in enumerate(BUCKETS))
+        buckets['>%s' % BUCKETS[-1]] = self.counts[-1]
+        return dict(count=self.count, total=round(self.total, 3), max=round(self.max, 3),
+                    avg=round(self.total / self.count, 3) if self.count else 0,
+                    buckets=buckets)
+
+
+class HubMonitor(object):
+    """
+    green线程每interval秒更新心跳, 系统线程发现心跳超过threshold秒没有更新时
+    记录主线程堆栈, 同一次阻塞只记录一次, 阻塞结束后green线程补充阻塞时长并打日志
+    """
+
+    def __init__(self, threshold, interval=0.1, keep=50):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = collections.deque(maxlen=keep)
+        self.beat = time.time()
+        self.ident = thread.get_ident()
+        self.heartbeat = None
+        self.watcher = None
+        self.running = False
+
+    def _heartbeat(self):
+        while self.running:
+            now = time.time()
+            if self.stalls and self.stalls[-1].get('blocked') is None:
+                # 上一次阻塞结束, 系统线程不能使用green锁, 日志在这里记录
+                stall = self.stalls[-1]
+                stall['blocked'] = round(now - self.beat, 3)
+                LOG.warning('Eventlet hub blocked %.2fs, stack:\n%s' % (stall['blocked'], stall['stack']))
+            self.beat = now
+            eventlet.sleep(self.interval)
+
+    def _watch(self):
+        while self.running:
+            time.sleep(self.interval)
+            beat = self.beat
+            blocked = time.time() - beat
+            if blocked < self.threshold:
+                continue
+            if self.stalls and self.stalls[-1]['beat'] == beat:
+                continue
+            frame = sys._current_frames().get(self.ident)
+            stack = traceback.format_stack(frame) if frame else []
+            self.stalls.append(dict(time=int(time.time()), beat=beat, blocked=None,
+                                    stack=''.join(stack[-20:])))
+
+    def start(self):
+        self.running = True
+        self.beat = time.time()
+        self.heartbeat = eventlet.spawn(self._heartbeat)
+        self.watcher = threading.Thread(target=self._watch, name='hub-monitor')
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def stop(self):
+        self.running = False
+        if self.heartbeat:
+            self.heartbeat.kill()
+            self.heartbeat = None
+
+    def records(self):
+        return [dict(stall, beat=int(stall['beat'])) for stall in list(self.stalls)]
+
+
+class _TimedLock(object):
+    """记录获取锁的等待时间"""
+
+    def __init__(self, profiler, lock, entitys):
+        self.profiler = profiler
+        self.lock = lock
+        self.entitys = entitys
+
+    def __enter__(self):
+        start = time.time()
+        try:
+            return self.lock.__enter__()
+        finally:
+            wait = time.time() - start
+            for entity in self.entitys:
+                self.profiler.lock_wait(entity, wait)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.lock.__exit__(exc_type, exc_val, exc_tb)
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.rpcs = collections.defaultdict(Histogram)
+        self.locks = collections.defaultdict(Histogram)
+        self.monitor = None
+
+    def reset(self):
+        self.start = time.time()
+        self.rpcs.clear()
+        self.locks.clear()
+        if self.monitor:
+            self.monitor.stalls.clear()
+
+    def rpc(self, name, elapsed):
+        self.rpcs[name].add(elapsed)
+
+    def lock_wait(self, entity, wait):
+        self.locks[entity].add(wait)
+
+    def timed_lock(self, lock, entitys):
+        return _TimedLock(self, lock, entitys)
+
+    def monitor_hub(self, threshold):
+        self.monitor = HubMonitor(threshold)
+        self.monitor.start()
+
+    def stop(self):
+        if self.monitor:
+            self.monitor.stop()
+
+    def snapshot(self):
+        return dict(since=int(self.start),
+                    rpcs=dict((name, histogram.to_dict()) for name, histogram in self.rpcs.items()),
+                    locks=dict((str(entity), histogram.to_dict())
+                               for entity, histogram in self.locks.items()),
+                    stalls=self.monitor.records() if self.monitor else [])
+
+    def dump(self, path, **kwargs):
+        snapshot = self.snapshot()
+        snapshot.update(kwargs)
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(snapshot, f, indent=1)
+        os.rename(path + '.tmp', path)
+        return path
+
+
+profiler = Profiler()
+
+
+def _wrap(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.rpc(name, time.time() - start)
+
+    return wrapper
+
+
+def instrument(cls, prefix='rpc_'):
+    """为cls中prefix开头的方法记录耗时"""
+    for name, func in cls.__dict__.items():
+        if name.startswith(prefix) and callable(func):
+            setattr(cls, name, _wrap(name[len(prefix):], func))
+    return cls
@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+import os
+import errno
+import ctypes
+import eventlet
+
+from eventlet import hubs
+
+from simpleutil.log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+# linux 5.3+, 所有架构统一的系统调用号
+NR_PIDFD_OPEN = 434
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _syscall = _libc.syscall
+except (OSError, AttributeError):
+    _syscall = None
+
+
+def pidfd_open(pid):
+    if _syscall is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    fd = _syscall(NR_PIDFD_OPEN, ctypes.c_int(pid), ctypes.c_uint(0))
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return fd
+
+
+def supported():
+    try:
+        os.close(pidfd_open(os.getpid()))
+    except OSError:
+        return False
+    return True
+
+
+class ProcessWatcher(object):
+    """
+    通过pidfd监控entity进程退出
+    每个entity进程一个绿色线程等待pidfd可读, 进程退出后立即回调
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.watchs = {}
+
+    def watch(self, entity, pid):
+        watching = self.watchs.get(entity)
+        if watching and watching[0] == pid:
+            return
+        try:
+            fd = pidfd_open(pid)
+        except OSError as e:
+            # 进程已经退出
+            if e.errno == errno.ESRCH:
+                return
+            raise
+        self.watchs[entity] = (pid, fd)
+        LOG.debug('Watch entity %d process %d exit' % (entity, pid))
+        eventlet.spawn_n(self._wait, entity, pid, fd)
+
+    def unwatch(self, entity):
+        self.watchs.pop(entity, None)
+
+    def _wait(self, entity, pid, fd):
+        try:
+            hubs.trampoline(fd, read=True)
+        except Exception:
+            LOG.exception('Wait entity %d process %d exit fail' % (entity, pid))
+            if self.watchs.get(entity) == (pid, fd):
+                self.watchs.pop(entity, None)
+            return
+        finally:
+            os.close(fd)
+        # pid已经更换或者已经取消监控
+        if self.watchs.get(entity) != (pid, fd):
+            return
+        self.watchs.pop(entity, None)
+        LOG.info('Entity %d process %d exit' % (entity, pid))
+        try:
+            self.callback(entity, pid)
+        except Exception:
+            LOG.exception('Entity %d process exit callback fail' % entity)
@@ -1,15 +1,32 @@
 import os
+import time
+import shutil
 import base64
 
+from eventlet.semaphore import Semaphore
+
+from simpleutil.log import log as logging
 from simpleutil.utils import digestutils
+from simpleutil.utils import zlibutils
+
+from simpleflow.types import failure
 
+from goperation.taskflow import common as task_common
 from goperation.filemanager import LocalFile
+from goperation.filemanager.exceptions import NoFileFound
 from goperation.manager.rpc.agent.application.taskflow.middleware import EntityMiddleware
 from goperation.manager.rpc.agent.application.taskflow.database import Database
 from goperation.manager.rpc.agent.application.taskflow.application import AppUpgradeFile
 from goperation.manager.rpc.agent.application.taskflow.application import AppLocalBackupFile
+from goperation.manager.rpc.agent.application.taskflow.application import AppFileUpgradeByFile
 
 from gogamechen3.api import gfile
+from gogamechen3.api import gdelta
+from gogamechen3.api.rpc import peer
+from gogamechen3.api.rpc import offload
+
+
+LOG = logging.getLogger(__name__)
 
 
 class GogameMiddle(EntityMiddleware):
@@ -35,17 +52,63 @@ class GogameDatabase(Database):
 class GogameAppFile(AppUpgradeFile):
 
     def __init__(self, source, objtype, revertable=False, rollback=False,
-                 stream=None):
+                 stream=None, deltas=None):
         super(GogameAppFile, self).__init__(source, revertable, rollback)
         self.objtype = objtype
         self.stream = stream
+        # 差分包列表, 本地有基础文件时下载差分包重建
+        self.deltas = deltas or []
+        self.rebuilt = None
+        # 文件大小, 用于统计下载解压量
+        self.processed = 0
 
     def post_check(self):
-        gfile.check(self.objtype, self.file)
+        # 重建文件的md5与source不同, 不使用md5索引
+        md5 = None if self.rebuilt else self.source
+        if offload.execute('check', gfile.check, self.objtype, self.file, md5):
+            LOG.warning('Archive index of %s broken, rebuilt' % self.source)
 
     def clean(self):
-        if self.stream:
-            os.remove(self.file)
+        if self.stream and self.localfile and os.path.exists(self.localfile.path):
+            os.remove(self.localfile.path)
+        if self.rebuilt and os.path.exists(self.rebuilt):
+            os.remove(self.rebuilt)
+            self.rebuilt = None
+
+    def _rebuild(self, filemanager, timeout):
+        """
+        用本地基础文件与差分包重建程序文件, 失败返回None下载完整文件
+        md5只保证每个成员文件与目标程序文件一致, 重新压缩的文件本身md5与source不同
+        重建文件记录在rebuilt中, 不登记到文件管理与peer缓存, 检查时不写md5索引, 使用完删除
+        """
+        for delta in self.deltas:
+            try:
+                basefile = filemanager.find(delta['base'])
+            except NoFileFound:
+                continue
+            try:
+                deltafile = filemanager.get(delta['md5'], download=True, timeout=timeout)
+                size = os.path.getsize(deltafile.path)
+            except Exception as e:
+                LOG.warning('Get delta %s fail, %s' % (delta['md5'], e.__class__.__name__))
+                continue
+            try:
+                info = gdelta.manifest(deltafile.path)
+                ext = 'zip' if info['format'] == 'zip' else 'tar.gz'
+                output = os.path.join(os.path.dirname(basefile.path), '%s.delta.%s' % (self.source, ext))
+                offload.execute('delta', gdelta.apply, basefile.path, deltafile.path, output, delta['base'])
+            except Exception as e:
+                LOG.warning('Rebuild %s from delta %s fail, %s: %s' % (self.source, delta['md5'],
+                                                                      e.__class__.__name__, str(e)))
+                continue
+            finally:
+                filemanager.delete(delta['md5'])
+            LOG.info('Rebuild %s from base %s with delta %s, %d/%d' %
+                     (self.source, delta['base'], delta['md5'],
+                      size, os.path.getsize(output)))
+            self.rebuilt = output
+            return LocalFile(output, self.source, os.path.getsize(output))
+        return None
 
     def prepare(self, middleware=None, timeout=None):
         if self.stream:
@@ -60,14 +123,38 @@ class GogameAppFile(AppUpgradeFile):
                 f.write(data)
             self.localfile = LocalFile(file_path, self.source, len(data))
         else:
-            self.localfile = middleware.filemanager.get(self.source, download=True, timeout=timeout)
+            try:
+                # 已经从其他agent获取的文件
+                localfile = peer.find(self.source)
+            except NoFileFound:
+                localfile = None
+            if not localfile:
+                try:
+                    # 本地已经存在完整文件, 不需要差分重建
+                    localfile = middleware.filemanager.find(self.source)
+                except NoFileFound:
+                    localfile = None
+            if not localfile and self.deltas:
+                localfile = self._rebuild(middleware.filemanager, timeout)
+            if not localfile:
+                try:
+                    # 多连接断点续传下载
+                    localfile = peer.download(self.source, timeout)
+                except Exception as e:
+                    LOG.warning('Download %s fail, %s: %s, try file manager' %
+                                (self.source, e.__class__.__name__, str(e)))
+            if not localfile:
+                localfile = middleware.filemanager.get(self.source, download=True, timeout=timeout)
+            self.localfile = localfile
+        self.processed = os.path.getsize(self.localfile.path)
         try:
             self.post_check()
         except Exception:
             localfile = self.localfile
             self.localfile = None
-            if self.stream:
+            if self.stream or self.rebuilt:
                 os.remove(localfile.path)
+                self.rebuilt = None
             else:
                 middleware.filemanager.delete(self.source)
             raise
@@ -83,4 +170,159 @@ class GogameAppBackupFile(AppLocalBackupFile):
         self.objtype = objtype
 
     def post_check(self):
-        gfile.check(self.objtype, self.file)
+        offload.execute('check', gfile.check, self.objtype, self.file)
+
+
+class AppStage(object):
+    """
+    同一个程序文件只解压一次到endpoint_backup/stage/<md5>
+    各实体从解压目录复制文件
+    """
+
+    def __init__(self, root, md5, exclude=None, postfix=None, extractor=None):
+        self.root = root
+        self.name = md5 if not postfix else '%s-%s' % (md5, postfix)
+        self.path = os.path.join(root, self.name)
+        self.exclude = exclude
+        self.extractor = extractor
+        self.lock = Semaphore(1)
+
+    def extract(self, src, timeout):
+        with self.lock:
+            return self._extract(src, timeout)
+
+    def tree(self, appstore, src, timeout):
+        """存储中已经有目录结构时不需要解压, 解压加入存储后删除解压目录"""
+        with self.lock:
+            tree = appstore.tree(self.name)
+            if tree is None:
+                tree = appstore.ingest(self.name, self._extract(src, timeout))
+                shutil.rmtree(self.path, ignore_errors=True)
+            return tree
+
+    def _extract(self, src, timeout):
+        if os.path.exists(self.path):
+            # 更新时间, 过期清理依据
+            os.utime(self.path, None)
+            return self.path
+        tmp = self.path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp, mode=0o755)
+        LOG.info('Extract %s to stage %s' % (src, self.name))
+        try:
+            if self.extractor:
+                waiter = self.extractor(src, tmp, timeout, exclude=self.exclude)
+            else:
+                waiter = zlibutils.async_extract(src=src, dst=tmp, exclude=self.exclude,
+                                                 timeout=timeout, native=False)
+            waiter.wait()
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        os.rename(tmp, self.path)
+        return self.path
+
+    @staticmethod
+    def clean(root, expire):
+        """清理过期的解压目录"""
+        if not os.path.exists(root):
+            return
+        overtime = time.time() - expire
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < overtime:
+                LOG.info('Remove expired stage %s' % name)
+                shutil.rmtree(path, ignore_errors=True)
+
+
+class GogameAppFileUpgrade(AppFileUpgradeByFile):
+    """
+    程序文件只解压一次, 按实体复制, 启用程序文件存储时用程序文件存储组装
+    有程序文件清单时只更新变化的文件
+    可回滚时更新前用硬链接备份程序目录, 回滚时换回
+    """
+
+    def __init__(self, middleware, stage=None, manifest=None, revertable=False, rebind=None):
+        super(GogameAppFileUpgrade, self).__init__(middleware, native=False,
+                                                   exclude=stage.exclude if stage else None,
+                                                   rebind=rebind)
+        self.stage = stage
+        self.manifest = manifest
+        self.revertable = revertable
+
+    def execute(self, upgradefile, timeout=None):
+        if self.middleware.is_success(self.taskname):
+            return
+        appendpoint = self.middleware.reflection()
+        entity = self.middleware.entity
+        if self.revertable:
+            appendpoint.snapshot_entity_file(entity, timeout)
+        if self.manifest and appendpoint.increment_entity_file(entity, upgradefile, self.manifest):
+            pass
+        elif appendpoint.appstore:
+            tree = self.stage.tree(appendpoint.appstore, upgradefile, timeout)
+            appendpoint.appstore.assemble(tree, appendpoint.apppath(entity),
+                                          appendpoint.entity_user(entity), appendpoint.entity_group(entity))
+        elif self.stage:
+            src = self.stage.extract(upgradefile, timeout)
+            appendpoint.copy_entity_file(entity, src, timeout)
+        else:
+            super(GogameAppFileUpgrade, self).execute(upgradefile, timeout)
+        if self.manifest:
+            appendpoint.record_manifest(entity, self.manifest)
+        self.middleware.set_return(self.taskname, task_common.EXECUTE_SUCCESS)
+
+    def revert(self, result, *args, **kwargs):
+        if isinstance(result, failure.Failure):
+            LOG.debug(result.pformat(traceback=True))
+        if not self.revertable:
+            return
+        appendpoint = self.middleware.reflection()
+        entity = self.middleware.entity
+        if appendpoint.restore_entity_file(entity):
+            LOG.info('Entity %d app file restore from snapshot' % entity)
+        self.middleware.set_return(self.taskname, task_common.REVERTED)
+
+
+class GogameReleaseUpgrade(AppFileUpgradeByFile):
+    """
+    版本目录模式更新, 准备共享版本后切换软链, 不需要打包备份
+    hotfix为True时以实体当前版本为基础生成热更新版本
+    回滚时切换回上一个版本
+    """
+
+    def __init__(self, middleware, stage, hotfix=False, revertable=True, rebind=None):
+        super(GogameReleaseUpgrade, self).__init__(middleware, native=False,
+                                                   exclude=stage.exclude, rebind=rebind)
+        self.stage = stage
+        self.hotfix = hotfix
+        self.revertable = revertable
+        self.previous = None
+
+    def execute(self, upgradefile, timeout=None):
+        if self.middleware.is_success(self.taskname):
+            return
+        appendpoint = self.middleware.reflection()
+        entity = self.middleware.entity
+        objtype = self.middleware.objtype
+        self.previous = appendpoint.entity_release(entity)
+        if self.hotfix:
+            name = appendpoint.hotfix_release(objtype, self.previous, self.stage.name,
+                                              upgradefile, timeout, self.stage)
+        else:
+            appendpoint.prepare_release(objtype, self.stage.name, upgradefile, timeout, self.stage)
+            name = self.stage.name
+        appendpoint.switch_release(entity, name)
+
+    def revert(self, result, *args, **kwargs):
+        if isinstance(result, failure.Failure):
+            LOG.debug(result.pformat(traceback=True))
+        if not self.revertable or not self.previous:
+            return
+        appendpoint = self.middleware.reflection()
+        entity = self.middleware.entity
+        if appendpoint.entity_release(entity) != self.previous:
+            appendpoint.switch_release(entity, self.previous)
+            LOG.info('Entity %d switch back to release %s' % (entity, self.previous))
+        self.middleware.set_return(self.taskname, task_common.REVERTED)
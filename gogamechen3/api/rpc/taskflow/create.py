@@ -16,6 +16,7 @@ from goperation.manager.rpc.agent.application.taskflow import pipe
 from goperation.taskflow import common as task_common
 
 from gogamechen3 import common
+from gogamechen3.api.rpc.metrics import FlowRecorder
 from gogamechen3.api.rpc.taskflow import GogameMiddle
 from gogamechen3.api.rpc.taskflow import GogameDatabase
 from gogamechen3.api.rpc.taskflow import GogameAppFile
@@ -84,9 +85,10 @@ class GogameDatabaseCreateTask(MysqlCreate):
 
 class GogameAppCreate(application.AppCreateBase):
 
-    def __init__(self, middleware, timeout):
+    def __init__(self, middleware, timeout, md5=None):
         super(GogameAppCreate, self).__init__(middleware)
         self.timeout = timeout
+        self.md5 = md5
 
     def execute(self, upgradefile):
         if self.middleware.is_success(self.taskname):
@@ -95,7 +97,8 @@ class GogameAppCreate(application.AppCreateBase):
         # 创建实体程序文件
         self.middleware.waiter = appendpoint.extract_entity_file(self.middleware.entity,
                                                                  self.middleware.objtype,
-                                                                 upgradefile, self.timeout)
+                                                                 upgradefile, self.timeout,
+                                                                 md5=self.md5)
 
     def revert(self, result, **kwargs):
         if isinstance(result, failure.Failure):
@@ -130,21 +133,24 @@ def create_entity(appendpoint, entity, objtype, databases, appfile, timeout):
                                         host=None, port=None, **auth))
 
     app = application.Application(middleware,
-                                  createtask=GogameAppCreate(middleware, timeout),
+                                  createtask=GogameAppCreate(middleware, timeout, md5=appfile),
                                   databases=_database)
 
     book = LogBook(name='create_%s_%d' % (appendpoint.namespace, entity))
     store = dict(download_timeout=timeout)
     taskflow_session = sqlite.get_taskflow_session()
+    upgradefile = GogameAppFile(source=appfile, objtype=objtype)
     create_flow = pipe.flow_factory(taskflow_session, book,
                                     applications=[app, ],
-                                    upgradefile=GogameAppFile(source=appfile, objtype=objtype),
+                                    upgradefile=upgradefile,
                                     store=store,
                                     create_cls=GogameDatabaseCreateTask)
     connection = Connection(taskflow_session)
     engine = load(connection, create_flow, store=store,
                   book=book, engine_cls=ParallelActionEngine)
-
+    recorder = FlowRecorder(appendpoint.metrics, 'create', objtype=objtype, entitys=[entity])
+    recorder.attach(engine)
+    e = None
     try:
         engine.run()
     except Exception as e:
@@ -154,6 +160,7 @@ def create_entity(appendpoint, entity, objtype, databases, appfile, timeout):
             LOG.error('Create task execute fail, %s %s' % (e.__class__.__name__, str(e)))
     finally:
         connection.destroy_logbook(book.uuid)
+        recorder.finish(e, size=upgradefile.processed)
         for dberror in middleware.dberrors:
             LOG.error(str(dberror))
     return middleware
@@ -15,9 +15,13 @@ from goperation.manager.rpc.agent.application.taskflow.application import AppFil
 from goperation.manager.rpc.agent.application.taskflow.application import Application
 from goperation.manager.rpc.agent.application.taskflow import pipe
 from gogamechen3 import common
+from gogamechen3.api.rpc.metrics import FlowRecorder
 from gogamechen3.api.rpc.taskflow import GogameMiddle
 from gogamechen3.api.rpc.taskflow import GogameAppFile
 from gogamechen3.api.rpc.taskflow import GogameAppBackupFile
+from gogamechen3.api.rpc.taskflow import GogameAppFileUpgrade
+from gogamechen3.api.rpc.taskflow import GogameReleaseUpgrade
+from gogamechen3.api.rpc.taskflow import AppStage
 
 CONF = cfg.CONF
 
@@ -73,7 +77,19 @@ def hotfix_entitys(appendpoint,
     # 程序更新文件
     upgradefile = GogameAppFile(md5, objtype, rollback=rollback,
                                 revertable=revertable, stream=stream)
-    if backup:
+    stage = None
+    # 所有实体都是版本目录模式时以当前版本为基础生成热更版本
+    releases = set(bool(appendpoint.entity_release(entity)) for entity in entitys)
+    if len(releases) > 1:
+        # 旧程序目录方式写入会通过软链修改共享版本
+        raise ValueError('Entitys mixed release and legacy app path')
+    release = systemutils.POSIX and releases == set([True])
+    if (len(entitys) > 1 and systemutils.POSIX and CONF[common.NAME].upgrade_stage) \
+            or appendpoint.appstore or release:
+        # 多个实体只解压一次, 热更解压目录与完整解压目录区分
+        stage = AppStage(appendpoint.stagepath, md5, exclude=hofixexcluer, postfix='hotfix',
+                         extractor=appendpoint.async_extract)
+    if backup and not release:
         # 备份entity在flow_factory随机抽取
         outfile = os.path.join(appendpoint.endpoint_backup,
                                '%s.%s.%d.gz' % (objtype, common.APPFILE, timeline))
@@ -89,8 +105,15 @@ def hotfix_entitys(appendpoint,
         middleware = GogameMiddle(endpoint=appendpoint, entity=entity, objtype=objtype)
         middlewares.append(middleware)
         _updates.clear()
-        upgradetask = AppFileUpgradeByFile(middleware, native=False, exclude=hofixexcluer,
-                                           rebind=['upgradefile', 'upzip_timeout'])
+        if release:
+            upgradetask = GogameReleaseUpgrade(middleware, stage, hotfix=True, revertable=revertable,
+                                               rebind=['upgradefile', 'upzip_timeout'])
+        elif stage:
+            upgradetask = GogameAppFileUpgrade(middleware, stage, revertable=revertable,
+                                               rebind=['upgradefile', 'upzip_timeout'])
+        else:
+            upgradetask = AppFileUpgradeByFile(middleware, native=False, exclude=hofixexcluer,
+                                               rebind=['upgradefile', 'upzip_timeout'])
         app = Application(middleware, upgradetask=upgradetask)
         applications.append(app)
 
@@ -106,6 +129,8 @@ def hotfix_entitys(appendpoint,
     engine = load(connection, upgrade_flow, store=store,
                   book=book, engine_cls=ParallelActionEngine,
                   max_workers=4)
+    recorder = FlowRecorder(appendpoint.metrics, 'hotfix', objtype=objtype, entitys=sorted(entitys))
+    recorder.attach(engine)
     e = None
     try:
         engine.run()
@@ -116,6 +141,7 @@ def hotfix_entitys(appendpoint,
             LOG.error('Hotfix task execute fail, %s %s' % (e.__class__.__name__, str(e)))
     finally:
         connection.destroy_logbook(book.uuid)
-    if stream:
+        recorder.finish(e, size=upgradefile.processed if upgradefile else 0)
+        # 删除stream临时文件与差分重建的程序文件
         upgradefile.clean()
     return middlewares, e
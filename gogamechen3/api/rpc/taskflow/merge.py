@@ -2,10 +2,19 @@
 import os
 import time
 import six
+import gzip
+import json
+import hashlib
 import eventlet
 import cPickle
 import contextlib
 
+from collections import OrderedDict
+from distutils.spawn import find_executable
+
+from eventlet.semaphore import Semaphore
+from eventlet.green import subprocess as greensubprocess
+
 import mysql
 import mysql.connector
 
@@ -33,6 +42,7 @@ from goperation.manager import common as manager_common
 
 from gogamechen3 import common
 from gogamechen3.api import exceptions
+from gogamechen3.api.rpc.metrics import FlowRecorder
 
 CONF = cfg.CONF
 
@@ -44,11 +54,357 @@ SWALLOWED = 'SWALLOWED'
 INSERT = 'INSERT'
 FINISHED = 'FINISHED'
 
+# 单表状态
+PENDING = 'PENDING'
+DUMPED = 'DUMPED'
+LOADING = 'LOADING'
+LOADED = 'LOADED'
+
+# 二级索引状态
+DEFERRED = 'DEFERRED'
+REBUILT = 'REBUILT'
+
+# 导入时关闭外键检查, 非唯一二级索引在导入完成后重建
+# 唯一索引保留并检查, 重复数据在导入该表时失败, 不会提交
+LOADARGS = ['--init-command=SET SESSION foreign_key_checks=0']
+
+
+def dumpargs(batch):
+    """
+    单表数据导出参数
+    每张表的插入语句在一个事务中, 导入失败时整表回滚
+    多行insert语句按batch(KB)合并
+    """
+    return ['-t', '-c', '--no-autocommit', '--extended-insert',
+            '--net-buffer-length=%d' % (batch * 1024)]
+
 
 def sqlfile(entity):
     return '%s-db-%d.sql' % (common.GAMESERVER, entity)
 
 
+def sqlpath(entity):
+    return '%s-db-%d' % (common.GAMESERVER, entity)
+
+
+def tablefile(root, entity, table, ext=''):
+    return os.path.join(root, sqlpath(entity), '%s.sql%s' % (table, ext))
+
+
+def manifestfile(root, entity):
+    return os.path.join(root, sqlpath(entity), 'manifest.json')
+
+
+def load_manifest(root, entity):
+    """实体导出文件清单, 记录每张表的文件、压缩格式、大小和md5"""
+    _file = manifestfile(root, entity)
+    if not os.path.exists(_file):
+        return {}
+    with open(_file, 'rb') as f:
+        return json.load(f)
+
+
+def save_manifest(root, entity, manifest):
+    _file = manifestfile(root, entity)
+    tmp = _file + '.tmp'
+    with open(tmp, 'wb') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(tmp, _file)
+
+
+def filemd5(path, blocksize=1048576):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), ''):
+            md5.update(block)
+            eventlet.sleep(0)
+    return md5.hexdigest()
+
+
+class Codec(object):
+    """合服导出文件压缩格式, 使用本地命令压缩解压"""
+
+    def __init__(self, name, ext, compress, decompress, stdlib=False):
+        self.name = name
+        self.ext = ext
+        self.compress = compress
+        self.decompress = decompress
+        # 本地命令不存在时可以用python标准库处理
+        self.stdlib = stdlib
+
+    @property
+    def binary(self):
+        return self.compress is not None and find_executable(self.compress[0]) is not None
+
+    @property
+    def available(self):
+        return self.compress is None or self.stdlib or self.binary
+
+
+CODECS = OrderedDict([
+    ('zstd', Codec('zstd', '.zst', ['zstd', '-q', '-1', '-c'], ['zstd', '-q', '-d', '-c'])),
+    ('lz4', Codec('lz4', '.lz4', ['lz4', '-q', '-1', '-c'], ['lz4', '-q', '-d', '-c'])),
+    ('gzip', Codec('gzip', '.gz', ['gzip', '-1', '-c'], ['gzip', '-d', '-c'], stdlib=True)),
+    ('none', Codec('none', '', None, None)),
+])
+
+
+def find_codec(name='auto'):
+    if name != 'auto':
+        codec = CODECS[name]
+        if not codec.available:
+            raise exceptions.MergeException('Codec %s not available, %s not found' % (name, codec.compress[0]))
+        return codec
+    for codec in six.itervalues(CODECS):
+        if codec.available:
+            return codec
+
+
+class Command(list):
+    """命令参数, env为命令额外的环境变量"""
+
+    def __init__(self, args, env=None):
+        super(Command, self).__init__(args)
+        self.env = env
+
+
+def _environ(cmd):
+    env = getattr(cmd, 'env', None)
+    if not env:
+        return None
+    environ = dict(os.environ)
+    environ.update(env)
+    return environ
+
+
+def mysqlargs(database):
+    return ['-h%s' % database.get('host'), '-P%d' % database.get('port'),
+            '-u%s' % database.get('user')]
+
+
+def mysqlenv(database):
+    """密码通过环境变量传递, 不出现在ps中"""
+    return dict(MYSQL_PWD=database.get('passwd') or '')
+
+
+def dumpcmd(database, table, extargs=None):
+    return Command(['mysqldump'] + mysqlargs(database) + (extargs or []) + [database.get('schema'), table],
+                   env=mysqlenv(database))
+
+
+def loadcmd(database, extargs=None):
+    return Command(['mysql'] + mysqlargs(database) + (extargs or []) + [database.get('schema')],
+                   env=mysqlenv(database))
+
+
+def pipeline(cmds, stdin=None, stdout=None, logfile=None, timeout=None):
+    """执行管道命令, 等同于 cmd1 | cmd2 | ..., 任一命令失败则全部终止"""
+    subs = []
+    with open(logfile or os.devnull, 'ab') as errf, open(os.devnull, 'wb') as null:
+        _stdin = stdin
+        try:
+            for index, cmd in enumerate(cmds):
+                last = index == len(cmds) - 1
+                # 没有指定输出时丢弃, 不写入agent的标准输出
+                sub = greensubprocess.Popen(cmd, stdin=_stdin,
+                                            stdout=(stdout or null) if last else greensubprocess.PIPE,
+                                            stderr=errf, close_fds=True, env=_environ(cmd))
+                # 关闭父进程持有的管道, 保证前一个命令退出后后续命令能读到EOF
+                if subs:
+                    _stdin.close()
+                _stdin = sub.stdout
+                subs.append(sub)
+            with eventlet.Timeout(timeout or 3600):
+                for sub in subs:
+                    sub.wait()
+                    if sub.returncode != 0:
+                        raise exceptions.MergeException('Command %s exit with code %s' %
+                                                        (os.path.basename(cmds[subs.index(sub)][0]),
+                                                         str(sub.returncode)))
+        except (Exception, eventlet.Timeout):
+            for sub in subs:
+                if sub.poll() is None:
+                    try:
+                        sub.kill()
+                        sub.wait()
+                    except OSError:
+                        pass
+            raise
+
+
+def _stdlib_compress(cmd, f, logfile=None, timeout=None):
+    """命令输出通过gzip标准库压缩写入文件"""
+    with open(logfile or os.devnull, 'ab') as errf:
+        sub = greensubprocess.Popen(cmd, stdout=greensubprocess.PIPE, stderr=errf, close_fds=True,
+                                    env=_environ(cmd))
+        try:
+            with eventlet.Timeout(timeout or 3600):
+                gz = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1)
+                for block in iter(lambda: sub.stdout.read(65536), ''):
+                    gz.write(block)
+                gz.close()
+                sub.wait()
+        except (Exception, eventlet.Timeout):
+            if sub.poll() is None:
+                sub.kill()
+                sub.wait()
+            raise
+    if sub.returncode != 0:
+        raise exceptions.MergeException('Command %s exit with code %s' % (cmd[0], str(sub.returncode)))
+
+
+def _stdlib_decompress(path, cmd, logfile=None, timeout=None):
+    """gzip标准库解压文件写入命令的标准输入"""
+    with open(logfile or os.devnull, 'ab') as errf:
+        sub = greensubprocess.Popen(cmd, stdin=greensubprocess.PIPE, stderr=errf, close_fds=True,
+                                    env=_environ(cmd))
+        try:
+            with eventlet.Timeout(timeout or 3600):
+                with gzip.open(path, 'rb') as gz:
+                    for block in iter(lambda: gz.read(65536), ''):
+                        sub.stdin.write(block)
+                sub.stdin.close()
+                sub.wait()
+        except (Exception, eventlet.Timeout):
+            if sub.poll() is None:
+                sub.kill()
+                sub.wait()
+            raise
+    if sub.returncode != 0:
+        raise exceptions.MergeException('Command %s exit with code %s' % (cmd[0], str(sub.returncode)))
+
+
+def dump_artifact(cmd, path, codec, logfile=None, timeout=None):
+    """导出命令输出压缩后写入文件, 返回文件大小与md5"""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        if codec.compress is None:
+            pipeline([cmd], stdout=f, logfile=logfile, timeout=timeout)
+        elif codec.binary:
+            pipeline([cmd, codec.compress], stdout=f, logfile=logfile, timeout=timeout)
+        else:
+            _stdlib_compress(cmd, f, logfile=logfile, timeout=timeout)
+    os.rename(tmp, path)
+    return os.path.getsize(path), filemd5(path)
+
+
+def load_artifact(path, codec, cmd, logfile=None, timeout=None):
+    """解压文件通过管道导入, 不落地解压后的sql文件"""
+    if codec.decompress is None:
+        with open(path, 'rb') as f:
+            pipeline([cmd], stdin=f, logfile=logfile, timeout=timeout)
+    elif codec.binary:
+        pipeline([codec.decompress + [path], cmd], logfile=logfile, timeout=timeout)
+    elif codec.stdlib:
+        _stdlib_decompress(path, cmd, logfile=logfile, timeout=timeout)
+    else:
+        raise exceptions.MergeException('Codec %s not available, %s not found' % (codec.name,
+                                                                                 codec.decompress[0]))
+
+
+def gather(pool, func, iterable):
+    """在协程池中执行, 返回所有异常"""
+    def wrapper(arg):
+        try:
+            func(arg)
+        except Exception as e:
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.exception('Execute %s with %s fail' % (func.__name__, str(arg)))
+            return e
+    return [e for e in pool.imap(wrapper, iterable) if e is not None]
+
+
+class MergeCheckpoint(object):
+    """steps.dat读写, 单表状态也记录在其中"""
+
+    def __init__(self, stepsfile, data):
+        self.stepsfile = stepsfile
+        self.data = data
+        # entity -> {table: state}
+        self.data.setdefault('tables', {})
+        # entity -> 源数据库, 流式导入时使用
+        self.data.setdefault('sources', {})
+        # table -> 初始化后的行数, 用于计算导入前行数
+        self.data.setdefault('initial', {})
+
+    @classmethod
+    def load(cls, stepsfile):
+        with open(stepsfile, 'rb') as f:
+            return cls(stepsfile, cPickle.load(f))
+
+    @property
+    def steps(self):
+        return self.data['steps']
+
+    @property
+    def tables(self):
+        return self.data['tables']
+
+    @property
+    def sources(self):
+        return self.data['sources']
+
+    @property
+    def initial(self):
+        return self.data['initial']
+
+    def base(self, table):
+        """
+        表在下一个实体导入前应有的行数, 同一张表同时只有一个实体导入
+        初始行数加上已经导入完成的实体导出行数, 不需要count目标表
+        没有记录初始行数(旧版本steps.dat)时返回None
+        """
+        if table not in self.initial:
+            return None
+        rows = self.initial[table]
+        for tables in six.itervalues(self.tables):
+            info = tables.get(table)
+            if info and info['state'] == LOADED:
+                rows += info['rows']
+        return rows
+
+    @property
+    def stream(self):
+        return self.data.get('stream', False)
+
+    def streaming(self, entity):
+        """实体是否从源库流式导入, 源库不可访问的实体导出文件"""
+        if not self.stream:
+            return False
+        return entity in self.data.get('streamed', self.sources)
+
+    @property
+    def timing(self):
+        """各阶段累计耗时, 合服完成后上报用于预测合服时间"""
+        return self.data.setdefault('timing', dict(dumptime=0, loadtime=0))
+
+    @property
+    def resumable(self):
+        """数据库已经初始化并且所有实体都按表记录状态, 可以跳过清库和初始化"""
+        if not self.data.get('initialized'):
+            return False
+        for entity in self.steps:
+            if entity not in self.tables:
+                return False
+        return True
+
+    def reset(self):
+        """重新清库前重置所有表的导入状态"""
+        self.data['initialized'] = False
+        self.data.pop('indexes', None)
+        self.data['initial'] = {}
+        for entity, tables in six.iteritems(self.tables):
+            for info in six.itervalues(tables):
+                if info['state'] in (LOADING, LOADED):
+                    info.update(state=PENDING if self.streaming(entity) else DUMPED, base=None)
+
+    def save(self):
+        tmp = self.stepsfile + '.tmp'
+        with open(tmp, 'wb') as f:
+            cPickle.dump(self.data, f)
+        os.rename(tmp, self.stepsfile)
+
+
 @contextlib.contextmanager
 def dbconnect(host, port, user, passwd, schema,
               raise_on_warnings=True):
@@ -65,6 +421,97 @@ def dbconnect(host, port, user, passwd, schema,
         conn.close()
 
 
+def dbtables(database):
+    with dbconnect(host=database.get('host'), port=database.get('port'),
+                   user=database.get('user'), passwd=database.get('passwd'),
+                   schema=database.get('schema')) as conn:
+        cursor = conn.cursor()
+        cursor.execute('show tables')
+        tables = [table[0] for table in cursor.fetchall()]
+        cursor.close()
+    return tables
+
+
+def tablerows(database, table):
+    with dbconnect(host=database.get('host'), port=database.get('port'),
+                   user=database.get('user'), passwd=database.get('passwd'),
+                   schema=database.get('schema')) as conn:
+        cursor = conn.cursor()
+        cursor.execute('select count(*) from `%s`' % table)
+        rows = cursor.fetchone()[0]
+        cursor.close()
+    return rows
+
+
+def secondary_indexes(database, tables):
+    """读取非唯一二级索引定义, 有外键关联的表不处理"""
+    schema = database.get('schema')
+    indexes = {}
+    with dbconnect(host=database.get('host'), port=database.get('port'),
+                   user=database.get('user'), passwd=database.get('passwd'),
+                   schema=schema) as conn:
+        cursor = conn.cursor()
+        cursor.execute('select TABLE_NAME, REFERENCED_TABLE_NAME from information_schema.KEY_COLUMN_USAGE '
+                       'where TABLE_SCHEMA = %s and REFERENCED_TABLE_NAME is not null', (schema, ))
+        fktables = set()
+        for table, referenced in cursor.fetchall():
+            fktables.add(table)
+            fktables.add(referenced)
+        cursor.execute('select TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME, SUB_PART, INDEX_TYPE '
+                       'from information_schema.STATISTICS '
+                       'where TABLE_SCHEMA = %s and INDEX_NAME != \'PRIMARY\' '
+                       'order by TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX', (schema, ))
+        for table, name, non_unique, column, sub_part, index_type in cursor.fetchall():
+            if table not in tables or table in fktables or not non_unique:
+                continue
+            index = indexes.setdefault(table, OrderedDict()).setdefault(name, dict(name=name,
+                                                                                   unique=not non_unique,
+                                                                                   type=index_type,
+                                                                                   columns=[]))
+            index['columns'].append('`%s`(%d)' % (column, sub_part) if sub_part else '`%s`' % column)
+        cursor.close()
+    return dict((table, list(six.itervalues(_indexes))) for table, _indexes in six.iteritems(indexes))
+
+
+def index_define(index):
+    if index['type'] in ('FULLTEXT', 'SPATIAL'):
+        prefix = '%s INDEX' % index['type']
+    elif index['unique']:
+        prefix = 'UNIQUE INDEX'
+    else:
+        prefix = 'INDEX'
+    return '%s `%s` (%s)' % (prefix, index['name'], ', '.join(index['columns']))
+
+
+def alter_table(database, table, clauses):
+    with dbconnect(host=database.get('host'), port=database.get('port'),
+                   user=database.get('user'), passwd=database.get('passwd'),
+                   schema=database.get('schema'), raise_on_warnings=False) as conn:
+        cursor = conn.cursor()
+        cursor.execute('show index from `%s`' % table)
+        exists = set(row[2] for row in cursor.fetchall())
+        sqls = []
+        for action, index in clauses:
+            if action == 'drop' and index['name'] in exists:
+                sqls.append('DROP INDEX `%s`' % index['name'])
+            elif action == 'add' and index['name'] not in exists:
+                sqls.append('ADD %s' % index_define(index))
+        # 一次alter处理全部索引, 只重建一次表
+        if sqls:
+            cursor.execute('alter table `%s` %s' % (table, ', '.join(sqls)))
+        cursor.close()
+
+
+def reachable(database):
+    try:
+        with dbconnect(host=database.get('host'), port=database.get('port'),
+                       user=database.get('user'), passwd=database.get('passwd'),
+                       schema=database.get('schema')):
+            return True
+    except mysql.connector.Error:
+        return False
+
+
 def cleandb(host, port, user, passwd, schema):
     """drop 所有表"""
     with dbconnect(host=host, port=port,
@@ -108,78 +555,92 @@ class Swallow(Task):
 
 class DumpData(Task):
 
-    NODUMPTABLES = [
-        'battlefield_log_lowfight',
-        'limit_level',
-        'mining_area',
-        'pay_censoring',
-        'player_censoring',
-        'quick_report',
-        'pvp_arena_pet_rank',
-        'var_world',
-        'pvp_cupmatch_fight_log',
-        'oper_record_plot',
-        'timer_boss',
-        'pvp_arena_rank',
-        'pve_campaign_log',
-    ]
-
-    DUMPONLYONE = [
-        'var_world'
-    ]
-
-    def __init__(self, uuid, steps, entity,
+    NODUMPTABLES = common.MERGE_NODUMPTABLES
+
+    DUMPONLYONE = common.MERGE_DUMPONLYONE
+
+    def __init__(self, uuid, checkpoint, entity,
                  endpoint=None,
-                 skip_only_one=True):
+                 skip_only_one=True,
+                 workers=4, codec='auto', batch=1024):
         self.entity = entity
-        self.stpes = steps
+        self.checkpoint = checkpoint
+        self.stpes = checkpoint.steps
         self.uuid = uuid
         self.endpoint = endpoint
         self.skip_only_one = skip_only_one
+        self.workers = workers
+        self.codec = codec
+        self.batch = batch
+        # 导出统计
+        self.host = None
+        self.processed = 0
+        self.rows = 0
         super(DumpData, self).__init__(name='dump_%d' % entity,
                                        rebind=['mergeroot', 'dtimeout', 'db_%d' % entity])
 
-    def _ext_args(self, schema):
-        extargs = ['-t', '-c']
-        nodumps = (self.NODUMPTABLES + self.DUMPONLYONE) if self.skip_only_one else self.NODUMPTABLES
-        for table in nodumps:
-            extargs.append('--ignore-table=%s.%s' % (schema, table))
-        return extargs
+    def _nodumps(self):
+        return (self.NODUMPTABLES + self.DUMPONLYONE) if self.skip_only_one else self.NODUMPTABLES
 
     @staticmethod
     def _prepare_database(databases):
         return databases[common.DATADB]
 
+    def _dump_table(self, root, database, table, timeout, codec, manifest):
+        _file = tablefile(root, self.entity, table, codec.ext)
+        logfile = os.path.join(root, 'dump-%d-%s.err.log' % (self.entity, table))
+        # 被合并实体已经停止, 导出前的行数用于导入后校验
+        rows = tablerows(database, table)
+        size, md5 = dump_artifact(dumpcmd(database, table, dumpargs(self.batch)), _file, codec,
+                                  logfile=logfile, timeout=timeout)
+        os.remove(logfile)
+        self.processed += size
+        self.rows += rows
+        manifest[table] = dict(file=os.path.basename(_file), codec=codec.name,
+                               size=size, md5=md5, rows=rows)
+        save_manifest(root, self.entity, manifest)
+        self.checkpoint.tables[self.entity][table].update(state=DUMPED, rows=rows)
+        self.checkpoint.save()
+
     def execute(self, root, timeout, databases):
         """
-        导出需要合并的实体数据库
+        按表并行导出需要合并的实体数据库
+        流式导入模式只记录表, 插入时直接从源库导入
         如果init.sql文件不存在,导出一份init.sql文件
         """
         step = self.stpes[self.entity]
         if step == DUMPING:
-            _file = os.path.join(root, sqlfile(self.entity))
-            if os.path.exists(_file):
-                return
             database = DumpData._prepare_database(databases)
-            try:
-                mysqldump(_file,
-                          database.get('host'), database.get('port'),
-                          database.get('user'), database.get('passwd'),
-                          database.get('schema'),
-                          character_set=None,
-                          extargs=self._ext_args(database.get('schema')),
-                          logfile=None, callable=safe_fork,
-                          timeout=timeout)
-            except (ExitBySIG, UnExceptExit):
-                LOG.error('Dump database of entity %d fail' % self.entity)
-                if os.path.exists(_file):
-                    try:
-                        os.remove(_file)
-                    except (OSError, OSError):
-                        LOG.error('Try remove file %d fail!' % _file)
-                        raise exceptions.MergeException('Remove error file %s fail' % _file)
-            else:
-                self.stpes[self.entity] = SWALLOWED
+            self.host = database.get('host')
+            tables = self.checkpoint.tables.get(self.entity)
+            if tables is None:
+                nodumps = set(self._nodumps())
+                tables = dict((table, dict(state=PENDING, rows=None, base=None))
+                              for table in dbtables(database) if table not in nodumps)
+                self.checkpoint.tables[self.entity] = tables
+                streamed = self.checkpoint.data.setdefault('streamed', [])
+                # 目标库所在agent访问不到源库时导出文件
+                if self.checkpoint.stream and reachable(database):
+                    self.checkpoint.sources[self.entity] = database
+                    streamed.append(self.entity)
+                self.checkpoint.save()
+            if not self.checkpoint.streaming(self.entity):
+                path = os.path.join(root, sqlpath(self.entity))
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                pendings = [table for table in sorted(tables) if tables[table]['state'] == PENDING]
+                codec = find_codec(self.codec)
+                manifest = load_manifest(root, self.entity)
+                LOG.info('Dump %d tables of entity %d, workers %d, codec %s' % (len(pendings), self.entity,
+                                                                                self.workers, codec.name))
+                pool = eventlet.GreenPool(self.workers)
+                errors = gather(pool, lambda table: self._dump_table(root, database, table, timeout,
+                                                                     codec, manifest), pendings)
+                if errors:
+                    LOG.error('Dump database of entity %d fail, %d tables error' % (self.entity, len(errors)))
+                    raise exceptions.MergeException('Dump database of entity %d fail' % self.entity)
+            self.stpes[self.entity] = SWALLOWED
+            self.checkpoint.save()
             # create init file
             initfile = os.path.join(root, 'init.sql')
             if not os.path.exists(initfile):
@@ -203,17 +664,23 @@ class DumpData(Task):
 
 
 class Swallowed(Task):
+    """
+    通知服务器被合并实体已经合并, 服务器随后释放被合并实体的数据库
+    流式导入的实体在导入完成后再通知, stream标记当前任务处理哪一类实体
+    """
 
-    def __init__(self, uuid, steps, entity, endpoint):
+    def __init__(self, uuid, checkpoint, entity, endpoint, stream=False):
         self.endpoint = endpoint
         self.entity = entity
-        self.stpes = steps
+        self.checkpoint = checkpoint
+        self.stpes = checkpoint.steps
         self.uuid = uuid
+        self.stream = stream
         super(Swallowed, self).__init__(name='swallowed_%d' % entity)
 
     def execute(self, entity, timeout):
         step = self.stpes[self.entity]
-        if step == SWALLOWED:
+        if step == SWALLOWED and self.checkpoint.streaming(self.entity) == self.stream:
             with self.endpoint.mlock:
                 result = self.endpoint.client.swallowed_entity(self.entity, self.uuid, entity)
             try:
@@ -228,6 +695,7 @@ class Swallowed(Task):
                 LOG.error('Get areas fail %s' % e.message)
             else:
                 self.stpes[self.entity] = INSERT
+                self.checkpoint.save()
                 for i in range(5):
                     if entity not in self.endpoint.konwn_appentitys:
                         eventlet.sleep(3)
@@ -264,7 +732,8 @@ class SafeCleanDb(Task):
 
 class InitDb(Task):
 
-    def __init__(self):
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
         super(InitDb, self).__init__(name='initdb')
 
     @staticmethod
@@ -294,34 +763,206 @@ class InitDb(Task):
         LOG.debug('Init databases success, try call pre.sql')
         os.remove(logfile)
         self._predo(root, database)
+        # 刚初始化的表行数很少, count代价很小
+        tables = set()
+        for _tables in six.itervalues(self.checkpoint.tables):
+            tables.update(_tables)
+        for table in tables:
+            self.checkpoint.initial[table] = tablerows(database, table)
+        # 初始化完成后合服中断, 重新合服时不再清库
+        self.checkpoint.data['initialized'] = True
+        self.checkpoint.save()
+
+
+class DeferIndex(Task):
+    """导入前删除非唯一二级索引, 索引定义记录在steps.dat中"""
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        super(DeferIndex, self).__init__(name='deferindex')
+
+    def execute(self, database):
+        tables = set()
+        for _tables in six.itervalues(self.checkpoint.tables):
+            tables.update(_tables)
+        indexes = secondary_indexes(database, tables)
+        self.checkpoint.data['indexes'] = dict((table, dict(state=DEFERRED, indexes=_indexes))
+                                               for table, _indexes in six.iteritems(indexes))
+        self.checkpoint.save()
+        LOG.info('Drop secondary indexes of %d tables before insert' % len(indexes))
+        for table, _indexes in six.iteritems(indexes):
+            alter_table(database, table, [('drop', index) for index in _indexes])
+
+
+class RebuildIndex(Task):
+    """导入完成后并行重建二级索引"""
+
+    def __init__(self, checkpoint, workers=4):
+        self.checkpoint = checkpoint
+        self.workers = workers
+        super(RebuildIndex, self).__init__(name='rebuildindex')
+
+    def _rebuild(self, database, table):
+        info = self.checkpoint.data['indexes'][table]
+        alter_table(database, table, [('add', index) for index in info['indexes']])
+        info['state'] = REBUILT
+        self.checkpoint.save()
+
+    def execute(self, database):
+        indexes = self.checkpoint.data.get('indexes') or {}
+        pendings = [table for table in sorted(indexes) if indexes[table]['state'] != REBUILT]
+        if not pendings:
+            return
+        LOG.info('Rebuild secondary indexes of %d tables, workers %d' % (len(pendings), self.workers))
+        pool = eventlet.GreenPool(self.workers)
+        errors = gather(pool, lambda table: self._rebuild(database, table), pendings)
+        if errors:
+            LOG.error('Rebuild secondary indexes fail, %d tables error' % len(errors))
+            raise exceptions.MergeException('Rebuild secondary indexes fail, %s' % str(errors[0]))
+
+
+class VerifyRows(Task):
+    """全部实体导入后每张表count一次, 与初始行数加导出行数比较"""
+
+    def __init__(self, checkpoint, workers=4):
+        self.checkpoint = checkpoint
+        self.workers = workers
+        super(VerifyRows, self).__init__(name='verifyrows')
+
+    def _verify(self, database, table):
+        expected = self.checkpoint.base(table)
+        rows = tablerows(database, table)
+        if rows != expected:
+            raise exceptions.MergeException('Table %s has %d rows, but %d expected' % (table, rows, expected))
+
+    def execute(self, database):
+        tables = set()
+        for _tables in six.itervalues(self.checkpoint.tables):
+            tables.update(_tables)
+        # 旧版本steps.dat没有初始行数, 导入时已经逐表校验
+        tables = [table for table in sorted(tables) if table in self.checkpoint.initial]
+        if not tables:
+            return
+        pool = eventlet.GreenPool(self.workers)
+        errors = gather(pool, lambda table: self._verify(database, table), tables)
+        if errors:
+            LOG.error('Verify rows fail, %d tables error' % len(errors))
+            raise exceptions.MergeException('Verify rows fail, %s' % str(errors[0]))
+        LOG.info('Verify rows of %d tables success' % len(tables))
 
 
 class InserDb(Task):
-    """插入各个实体的数据库"""
+    """插入各个实体的数据库, 按表顺序导入"""
 
-    def __init__(self, entity, stoper):
+    def __init__(self, entity, stoper, checkpoint, tlocks, offset=0, batch=1024):
         self.entity = entity
+        self.batch = batch
         self.stoper = stoper
+        self.checkpoint = checkpoint
+        # 同一张表同时只有一个实体在导入
+        self.tlocks = tlocks
+        # 各实体从不同的表开始导入, 减少表锁等待
+        self.offset = offset
+        # 导入统计
+        self.host = None
+        self.processed = 0
+        self.rows = 0
         super(InserDb, self).__init__(name='insert-%d' % entity)
 
+    def _load_table(self, timeline, root, database, table, timeout, manifest):
+        info = self.checkpoint.tables[self.entity][table]
+        if info['state'] == LOADED:
+            return
+        # 同一张表同时只有一个实体在导入, 导入前行数由初始行数与已导入行数计算
+        # 只有中断恢复时count目标表, 完整校验在全部导入后由VerifyRows执行一次
+        base = self.checkpoint.base(table)
+        if info['state'] == LOADING:
+            # 上次导入已经提交, 但是没来得及记录状态
+            current = tablerows(database, table)
+            if info['rows'] is not None and current == info['base'] + info['rows']:
+                LOG.info('Table %s of entity %d has been loaded' % (table, self.entity))
+                info['state'] = LOADED
+                self.checkpoint.save()
+                return
+            if current != info['base']:
+                raise exceptions.MergeException('Table %s of entity %d rows count %d not match %d before load' %
+                                                (table, self.entity, current, info['base']))
+            base = current
+        elif base is None:
+            base = tablerows(database, table)
+        logfile = os.path.join(root, 'insert-%d-%s.err.%d.log' % (self.entity, table, timeline))
+        if self.checkpoint.streaming(self.entity):
+            source = self.checkpoint.sources[self.entity]
+            if info['state'] != LOADING:
+                info['rows'] = tablerows(source, table)
+            info.update(state=LOADING, base=base)
+            self.checkpoint.save()
+            pipeline([dumpcmd(source, table, dumpargs(self.batch)), loadcmd(database, LOADARGS)],
+                     logfile=logfile, timeout=timeout)
+        else:
+            artifact = manifest.get(table)
+            if artifact:
+                _file = os.path.join(root, sqlpath(self.entity), artifact['file'])
+                if filemd5(_file) != artifact['md5']:
+                    raise exceptions.MergeException('Table %s of entity %d checksum not match' % (table, self.entity))
+                codec = CODECS[artifact['codec']]
+            else:
+                _file = tablefile(root, self.entity, table)
+                codec = CODECS['none']
+            info.update(state=LOADING, base=base)
+            self.checkpoint.save()
+            load_artifact(_file, codec, loadcmd(database, LOADARGS),
+                          logfile=logfile, timeout=timeout)
+            self.processed += os.path.getsize(_file)
+        os.remove(logfile)
+        if table not in self.checkpoint.initial:
+            # 旧版本steps.dat没有初始行数, 导入后逐表校验
+            loaded = tablerows(database, table) - base
+            if loaded != info['rows']:
+                raise exceptions.MergeException('Table %s of entity %d loaded %d rows, but dumped %d rows' %
+                                                (table, self.entity, loaded, info['rows']))
+        # 进度使用导出行数
+        self.rows += info['rows']
+        info['state'] = LOADED
+        self.checkpoint.save()
+
     def execute(self, timeline, root, database, timeout):
         if self.stoper[0]:
             raise exceptions.MergeException('Stop mark is true')
-        _file = os.path.join(root, sqlfile(self.entity))
-        logfile = os.path.join(root, 'insert-%d.err.%d.log' % (self.entity, timeline))
-        LOG.info('Insert database of entity %d, sql file %s' % (self.entity, _file))
-        mysqlload(_file,
-                  database.get('host'), database.get('port'),
-                  database.get('user'), database.get('passwd'),
-                  database.get('schema'),
-                  character_set=None, extargs=None,
-                  logfile=logfile, callable=safe_fork,
-                  timeout=timeout)
+        self.host = database.get('host')
+        tables = self.checkpoint.tables.get(self.entity)
+        # 旧版本导出的单个sql文件
+        if tables is None:
+            _file = os.path.join(root, sqlfile(self.entity))
+            logfile = os.path.join(root, 'insert-%d.err.%d.log' % (self.entity, timeline))
+            LOG.info('Insert database of entity %d, sql file %s' % (self.entity, _file))
+            mysqlload(_file,
+                      database.get('host'), database.get('port'),
+                      database.get('user'), database.get('passwd'),
+                      database.get('schema'),
+                      character_set=None, extargs=None,
+                      logfile=logfile, callable=safe_fork,
+                      timeout=timeout)
+            self.processed += os.path.getsize(_file)
+            os.remove(logfile)
+        else:
+            loaded = len([table for table in tables if tables[table]['state'] == LOADED])
+            tables = sorted(tables)
+            if tables:
+                offset = self.offset % len(tables)
+                tables = tables[offset:] + tables[:offset]
+            LOG.info('Insert database of entity %d, %d tables, %d loaded, stream %s' %
+                     (self.entity, len(tables), loaded, self.checkpoint.streaming(self.entity)))
+            manifest = load_manifest(root, self.entity)
+            for table in tables:
+                if self.stoper[0]:
+                    raise exceptions.MergeException('Stop mark is true')
+                with self.tlocks[table]:
+                    self._load_table(timeline, root, database, table, timeout, manifest)
         LOG.info('Insert database of entity %d success' % self.entity)
-        os.remove(logfile)
 
     def revert(self, result, database, **kwargs):
-        """插入失败清空数据库"""
+        """插入失败通知其他实体停止, 已经导入的表在重新合服时跳过"""
         if isinstance(result, failure.Failure):
             if not self.stoper[0]:
                 LOG.warning('Insert database of entity %d fail' % self.entity)
@@ -391,9 +1032,14 @@ def merge_entitys(appendpoint, uuid, entity, databases):
     initfile = os.path.join(mergeroot, 'init.sql')
     if not os.path.exists(stepsfile):
         raise exceptions.MergeException('Steps file not exist')
-    with open(stepsfile, 'rb') as f:
-        data = cPickle.load(f)
-        steps = data['steps']
+    conf = CONF[common.NAME]
+    checkpoint = MergeCheckpoint.load(stepsfile)
+    data = checkpoint.data
+    steps = checkpoint.steps
+    if 'stream' not in data:
+        # 流式导入需要合服目标数据库可以访问, 确认后不再变更
+        data['stream'] = conf.merge_stream and reachable(datadb)
+        checkpoint.save()
     prepares = []
     for _entity, step in six.iteritems(steps):
         # 一些post sql执行错误对整体无影响情况下
@@ -402,15 +1048,16 @@ def merge_entitys(appendpoint, uuid, entity, databases):
             for _step in six.itervalues(steps):
                 if _step != FINISHED:
                     raise exceptions.MergeException('Steps is finish?')
-            appendpoint.client.finish_merge(uuid)
+            appendpoint.client.finish_merge(uuid, body=checkpoint.timing)
             appendpoint.flush_config(entity, databases,
                                      opentime=data['opentime'],
                                      chiefs=data['chiefs'])
             return
-        if step != INSERT:
+        # 流式导入的实体导入完成后才通知服务器
+        if step != INSERT and not (step == SWALLOWED and checkpoint.streaming(_entity)):
             prepares.append(_entity)
-    mini_entity = min(prepares)
     if prepares:
+        mini_entity = min(prepares)
         name = 'prepare-merge-at-%d' % int(time.time())
         book = LogBook(name=name)
         store = dict(timeout=5, dtimeout=600, mergeroot=mergeroot, entity=entity)
@@ -418,32 +1065,55 @@ def merge_entitys(appendpoint, uuid, entity, databases):
         connection = Connection(taskflow_session)
 
         prepare_uflow = uf.Flow(name)
+        recorder = FlowRecorder(appendpoint.metrics, 'merge-dump', uuid=uuid, entitys=sorted(prepares))
         for _entity in prepares:
             entity_flow = lf.Flow('prepare-%d' % _entity)
             entity_flow.add(Swallow(uuid, steps, _entity, appendpoint))
-            entity_flow.add(DumpData(uuid, steps, _entity, appendpoint, _entity != mini_entity))
-            entity_flow.add(Swallowed(uuid, steps, _entity, appendpoint))
+            entity_flow.add(recorder.track(DumpData(uuid, checkpoint, _entity, appendpoint, _entity != mini_entity,
+                                                    workers=conf.merge_workers, codec=conf.merge_codec,
+                                                    batch=conf.merge_insert_batch)))
+            entity_flow.add(Swallowed(uuid, checkpoint, _entity, appendpoint))
             prepare_uflow.add(entity_flow)
         engine = load(connection, prepare_uflow, store=store,
                       book=book, engine_cls=ParallelActionEngine,
-                      max_workers=4)
+                      max_workers=conf.merge_workers)
+        recorder.attach(engine)
+        start = time.time()
         try:
             engine.run()
         except Exception as e:
+            recorder.finish(e)
             if LOG.isEnabledFor(logging.DEBUG):
                 LOG.exception('Prepare merge task execute fail')
             raise exceptions.MergeException('Prepare merge task execute fail, %s %s' % (e.__class__.__name__, str(e)))
+        else:
+            recorder.finish()
         finally:
             connection.session = None
             taskflow_session.close()
-            with open(stepsfile, 'wb') as f:
-                cPickle.dump(data, f)
+            checkpoint.timing['dumptime'] += int(time.time() - start)
+            checkpoint.timing['workers'] = conf.merge_workers
+            checkpoint.save()
 
+    streams = []
     for _entity, step in six.iteritems(steps):
-        if step != INSERT:
+        if checkpoint.streaming(_entity) and step == SWALLOWED:
+            streams.append(_entity)
+        elif step != INSERT:
             raise exceptions.MergeException('Some step not on %s' % INSERT)
-        if not os.path.exists(os.path.join(mergeroot, sqlfile(_entity))):
-            raise exceptions.MergeException('Entity %d sql file not exist' % _entity)
+        tables = checkpoint.tables.get(_entity)
+        if tables is None:
+            if not os.path.exists(os.path.join(mergeroot, sqlfile(_entity))):
+                raise exceptions.MergeException('Entity %d sql file not exist' % _entity)
+        elif not checkpoint.streaming(_entity):
+            manifest = load_manifest(mergeroot, _entity)
+            for table in tables:
+                if table in manifest:
+                    _file = os.path.join(mergeroot, sqlpath(_entity), manifest[table]['file'])
+                else:
+                    _file = tablefile(mergeroot, _entity, table)
+                if not os.path.exists(_file):
+                    raise exceptions.MergeException('Entity %d table %s sql file not exist' % (_entity, table))
 
     if not os.path.exists(initfile):
         LOG.error('Init database file not exist')
@@ -453,35 +1123,65 @@ def merge_entitys(appendpoint, uuid, entity, databases):
     now = int(time.time())
     name = 'merge-at-%d' % now
     book = LogBook(name=name)
-    store = dict(timeout=1800, root=mergeroot, database=datadb, timeline=now)
+    store = dict(timeout=1800, root=mergeroot, database=datadb, timeline=now, entity=entity)
     taskflow_session = build_session('sqlite:///%s' % os.path.join(mergeroot, '%s.db' % name))
     connection = Connection(taskflow_session)
 
     merge_flow = lf.Flow('merge-to')
-    merge_flow.add(SafeCleanDb())
-    merge_flow.add(InitDb())
-    insert_lflow = lf.Flow('insert-db')
+    recorder = FlowRecorder(appendpoint.metrics, 'merge-load', uuid=uuid, entitys=[entity])
+    if checkpoint.resumable:
+        LOG.info('Database has been initialized, resume insert')
+    else:
+        checkpoint.reset()
+        checkpoint.save()
+        merge_flow.add(SafeCleanDb())
+        merge_flow.add(InitDb(checkpoint))
+        merge_flow.add(DeferIndex(checkpoint))
+    insert_uflow = uf.Flow('insert-db')
     stoper = [0]
-    for _entity in steps:
-        insert_lflow.add(InserDb(_entity, stoper))
-    merge_flow.add(insert_lflow)
+    tlocks = {}
+    for tables in six.itervalues(checkpoint.tables):
+        for table in tables:
+            tlocks.setdefault(table, Semaphore(1))
+    for index, _entity in enumerate(sorted(steps)):
+        insert_uflow.add(recorder.track(InserDb(_entity, stoper, checkpoint, tlocks, offset=index,
+                                                batch=conf.merge_insert_batch)))
+    merge_flow.add(insert_uflow)
+    if streams:
+        # 源库导入完成后才能释放
+        swallowed_uflow = uf.Flow('swallowed')
+        for _entity in streams:
+            swallowed_uflow.add(Swallowed(uuid, checkpoint, _entity, appendpoint, stream=True))
+        merge_flow.add(swallowed_uflow)
+    merge_flow.add(VerifyRows(checkpoint, workers=conf.merge_workers))
+    merge_flow.add(RebuildIndex(checkpoint, workers=conf.merge_workers))
     merge_flow.add(PostDo(uuid, appendpoint))
 
     engine = load(connection, merge_flow, store=store,
                   book=book, engine_cls=ParallelActionEngine,
-                  max_workers=4)
+                  max_workers=conf.merge_workers)
+    recorder.attach(engine)
+    start = time.time()
     try:
         engine.run()
     except Exception as e:
+        recorder.finish(e, host=datadb.get('host'))
+        checkpoint.timing['loadtime'] += int(time.time() - start)
+        checkpoint.save()
         if LOG.isEnabledFor(logging.DEBUG):
             LOG.exception('Merge database task execute fail')
         raise exceptions.MergeException('Merge database task execute fail, %s %s' % (e.__class__.__name__, str(e)))
     else:
+        recorder.finish(host=datadb.get('host'))
+        for _entity in streams:
+            if steps[_entity] != INSERT:
+                raise exceptions.MergeException('Notify swallowed of entity %d fail' % _entity)
         for _entity in steps:
             steps[_entity] = FINISHED
-        with open(stepsfile, 'wb') as f:
-            cPickle.dump(data, f)
-        appendpoint.client.finish_merge(uuid)
+        checkpoint.timing['loadtime'] += int(time.time() - start)
+        checkpoint.timing['workers'] = conf.merge_workers
+        checkpoint.save()
+        appendpoint.client.finish_merge(uuid, body=checkpoint.timing)
         appendpoint.flush_config(entity, databases,
                                  opentime=data['opentime'],
                                  chiefs=data['chiefs'])
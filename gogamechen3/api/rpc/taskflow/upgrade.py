@@ -2,6 +2,7 @@
 import os
 from simpleutil.config import cfg
 from simpleutil.log import log as logging
+from simpleutil.utils import systemutils
 
 from simpleflow.api import load
 from simpleflow.storage import Connection
@@ -15,10 +16,14 @@ from goperation.manager.rpc.agent.application.taskflow.database import DbUpdateF
 from goperation.manager.rpc.agent.application.taskflow.database import DbBackUpFile
 from goperation.manager.rpc.agent.application.taskflow import pipe
 from gogamechen3 import common
+from gogamechen3.api.rpc.metrics import FlowRecorder
 from gogamechen3.api.rpc.taskflow import GogameMiddle
 from gogamechen3.api.rpc.taskflow import GogameDatabase
 from gogamechen3.api.rpc.taskflow import GogameAppFile
 from gogamechen3.api.rpc.taskflow import GogameAppBackupFile
+from gogamechen3.api.rpc.taskflow import GogameAppFileUpgrade
+from gogamechen3.api.rpc.taskflow import GogameReleaseUpgrade
+from gogamechen3.api.rpc.taskflow import AppStage
 
 
 CONF = cfg.CONF
@@ -31,6 +36,14 @@ def upgrade_entitys(appendpoint,
                     entitys, timeline):
     upgradefile = None
     backupfile = None
+    stage = None
+    manifest = None
+    # 所有实体都是版本目录模式时切换版本软链更新
+    releases = set(bool(appendpoint.entity_release(entity)) for entity in entitys)
+    if len(releases) > 1:
+        # 旧程序目录方式写入会通过软链修改共享版本
+        raise ValueError('Entitys mixed release and legacy app path')
+    release = systemutils.POSIX and releases == set([True])
     download_time = 600
     upzip_timeout = 600
     if common.APPFILE in objfiles:
@@ -45,8 +58,17 @@ def upgrade_entitys(appendpoint,
         if timeout < upzip_timeout:
             upzip_timeout = timeout
         # 程序更新文件
-        upgradefile = GogameAppFile(md5, objtype, rollback=rollback, revertable=revertable)
-        if backup:
+        upgradefile = GogameAppFile(md5, objtype, rollback=rollback, revertable=revertable,
+                                    deltas=objfile.get('deltas'))
+        if (len(entitys) > 1 and systemutils.POSIX and CONF[common.NAME].upgrade_stage) \
+                or appendpoint.appstore or release:
+            # 多个实体或者启用程序文件存储时只解压一次
+            stage = AppStage(appendpoint.stagepath, md5, extractor=appendpoint.async_extract)
+        if not release and not appendpoint.appstore and CONF[common.NAME].upgrade_increment:
+            # 程序文件清单, 只更新变化的文件
+            manifest = appendpoint.appfile_manifest(md5)
+        if backup and not release:
+            # 版本目录模式上一个版本就是备份, 不需要打包
             # 备份entity在flow_factory随机抽取
             outfile = os.path.join(appendpoint.endpoint_backup,
                                    '%s.%s.%d.gz' % (objtype, common.APPFILE, timeline))
@@ -89,7 +111,15 @@ def upgrade_entitys(appendpoint,
                                                 timeout=timeout, **dbinfo))
         # 更新程序文件任务
         upgradetask = None
-        if common.APPFILE in objfiles:
+        if release and common.APPFILE in objfiles:
+            upgradetask = GogameReleaseUpgrade(middleware, stage,
+                                               revertable=objfiles[common.APPFILE].get('revertable', False),
+                                               rebind=['upgradefile', 'upzip_timeout'])
+        elif stage or manifest:
+            upgradetask = GogameAppFileUpgrade(middleware, stage, manifest=manifest,
+                                               revertable=objfiles[common.APPFILE].get('revertable', False),
+                                               rebind=['upgradefile', 'upzip_timeout'])
+        elif common.APPFILE in objfiles:
             upgradetask = AppFileUpgradeByFile(middleware, native=False,
                                                rebind=['upgradefile', 'upzip_timeout'])
         app = Application(middleware, upgradetask=upgradetask, databases=_database)
@@ -108,6 +138,8 @@ def upgrade_entitys(appendpoint,
     engine = load(connection, upgrade_flow, store=store,
                   book=book, engine_cls=ParallelActionEngine,
                   max_workers=4)
+    recorder = FlowRecorder(appendpoint.metrics, 'upgrade', objtype=objtype, entitys=sorted(entitys))
+    recorder.attach(engine)
     e = None
     try:
         engine.run()
@@ -118,4 +150,8 @@ def upgrade_entitys(appendpoint,
             LOG.error('Upgrade task execute fail, %s %s' % (e.__class__.__name__, str(e)))
     finally:
         connection.destroy_logbook(book.uuid)
+        recorder.finish(e, size=upgradefile.processed if upgradefile else 0)
+        if upgradefile:
+            # 删除差分重建的程序文件
+            upgradefile.clean()
     return middlewares, e
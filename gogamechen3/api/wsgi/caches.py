@@ -1,15 +1,47 @@
 # -*- coding:utf-8 -*-
+import os
 import time
+import json
+import socket
+import six
+import gzip
+import hashlib
+import cStringIO
+import webob
+import eventlet
+
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from simpleutil.log import log as logging
 from simpleutil.utils import cachetools
 from simpleutil.common.exceptions import InvalidArgument
+from simpleutil.config import cfg
 
-import goperation
 from goperation.manager.api import get_cache
+from goperation.manager.wsgi.contorller import BaseContorller
+from goperation.manager.wsgi.entity.controller import EntityReuest
 
 from gopcdn import common as cdncommon
 from gopcdn.api.wsgi.resource import CdnResourceReuest
 
+from gogamechen3 import common
+from gogamechen3.models import Package
+from gogamechen3.models import PackageFile
+from gogamechen3.models import PackageArea
+from gogamechen3.models import AppEntity
+from gogamechen3.models import GameArea
+from gogamechen3.models import Group
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
 cdnresource_controller = CdnResourceReuest()
+entity_controller = EntityReuest()
 
 
 class ResourceTTLCache(cachetools.TTLCache):
@@ -24,16 +56,155 @@ class ResourceTTLCache(cachetools.TTLCache):
 CDNRESOURCE = ResourceTTLCache(maxsize=1000, ttl=cdncommon.CACHETIME)
 
 
-def map_resources(resource_ids):
-    # 删除过期缓存
-    CDNRESOURCE.expire()
+def _resource_info(resource):
+    resource_id = resource.get('resource_id')
+    agent_id = resource.get('agent_id')
+    port = resource.get('port')
+    internal = resource.get('internal')
+    name = resource.get('name')
+    etype = resource.get('etype')
+    domains = resource.get('domains')
+    versions = resource.get('versions')
+    metadata = resource.get('metadata')
+    if internal:
+        if not metadata:
+            raise ValueError('Agent %d not online, get domain entity fail' % agent_id)
+        hostnames = [metadata.get('local_ip')]
+    else:
+        if not domains:
+            if not metadata:
+                raise ValueError('Agent %d not online get domain entity fail' % agent_id)
+            if metadata.get('external_ips'):
+                hostnames = metadata.get('external_ips')
+            else:
+                hostnames = [metadata.get('local_ip')]
+        else:
+            hostnames = domains
+    schema = 'http'
+    if port == 443:
+        schema = 'https'
+    netlocs = []
+    for host in hostnames:
+        if port in (80, 443):
+            netloc = '%s://%s' % (schema, host)
+        else:
+            netloc = '%s://%s:%d' % (schema, host, port)
+        netlocs.append(netloc)
+    return resource_id, dict(name=name, etype=etype, agent_id=agent_id,
+                             internal=internal, versions=versions,
+                             netlocs=netlocs, port=port,
+                             domains=domains)
 
-    need = set(resource_ids)
-    provides = set(CDNRESOURCE.keys())
-    notmiss = need & provides
 
-    # 有资源在进程缓存字典中
-    if notmiss:
+# 资源缓存失效通知频道
+RESOURCE_CHANNEL = 'gogamechen3-cdnresource-invalidate'
+RESOURCE_RECONCILE = 'gogamechen3-cdnresource-reconcile'
+# 订阅连接心跳, 半开连接收不到任何消息, 超时后重新订阅
+PUBSUB_PING = 10
+PUBSUB_TIMEOUT = 30
+
+
+class ResourceInvalidator(object):
+    """
+    订阅失效频道, 收到resource_id后弹出本地缓存
+    gopcdn只在CACHESETNAME有序集合中记录资源刷新时间, 不发通知
+    由抢到redis锁的一个进程定时扫描有序集合, 把变化的资源发布到频道
+    订阅断开期间无法确认本地缓存, map_resources回退为每次检查有序集合
+    订阅连接定时ping, 超过PUBSUB_TIMEOUT秒没有收到任何消息视为断开
+    """
+
+    def __init__(self):
+        self.subscribed = False
+        # 资源失效次数, 加载期间失效的结果不写入缓存
+        self.versions = {}
+        # 资源最近失效时间, 快照判断是否需要重建
+        self.changed = {}
+        self.ident = None
+        self.threads = []
+
+    def start(self):
+        if self.threads:
+            return
+        self.ident = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.threads = [eventlet.spawn(self._listen), eventlet.spawn(self._reconcile)]
+
+    def stop(self):
+        for thread in self.threads:
+            thread.kill()
+        self.threads = []
+        self.subscribed = False
+
+    def invalidate(self, resource_id):
+        self.versions[resource_id] = self.versions.get(resource_id, 0) + 1
+        self.changed[resource_id] = time.time()
+        CDNRESOURCE.pop(resource_id, None)
+
+    def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = get_cache().pubsub()
+                pubsub.subscribe(RESOURCE_CHANNEL)
+                # 订阅前的失效通知已经丢失
+                for resource_id in list(CDNRESOURCE.keys()):
+                    self.invalidate(resource_id)
+                self.subscribed = True
+                LOG.info('Subscribe %s success' % RESOURCE_CHANNEL)
+                received = pinged = time.time()
+                while True:
+                    message = pubsub.get_message(timeout=1)
+                    now = time.time()
+                    if message:
+                        received = now
+                        if message.get('type') == 'message':
+                            self.invalidate(int(message.get('data')))
+                        continue
+                    if now - received > PUBSUB_TIMEOUT:
+                        raise IOError('No message or pong over %ds' % PUBSUB_TIMEOUT)
+                    if now - pinged > PUBSUB_PING:
+                        pubsub.ping()
+                        pinged = now
+            except Exception as e:
+                LOG.error('Resource invalidate channel fail, %s' % e.__class__.__name__)
+            finally:
+                self.subscribed = False
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            eventlet.sleep(1)
+
+    def _reconcile(self):
+        interval = CONF[common.NAME].resource_reconcile_interval
+        # 已经发布过的资源刷新时间
+        published = {}
+        while True:
+            eventlet.sleep(interval)
+            try:
+                cache = get_cache()
+                if not cache.set(RESOURCE_RECONCILE, self.ident, nx=True, ex=interval * 3):
+                    if cache.get(RESOURCE_RECONCILE) != self.ident:
+                        published.clear()
+                        continue
+                    cache.expire(RESOURCE_RECONCILE, interval * 3)
+                # 与上一个扫描进程交接时可能重复发布, 重复失效只多一次加载
+                scores = cache.zrangebyscore(name=cdncommon.CACHESETNAME,
+                                             min=str(int(time.time()) - interval * 3 - 3), max='+inf',
+                                             withscores=True, score_cast_func=int)
+                for resource_id, cache_on in scores:
+                    resource_id = int(resource_id)
+                    if published.get(resource_id) != cache_on:
+                        published[resource_id] = cache_on
+                        cache.publish(RESOURCE_CHANNEL, resource_id)
+            except Exception as e:
+                LOG.error('Reconcile resource cache fail, %s' % e.__class__.__name__)
+
+    def probe(self, resource_ids):
+        """订阅断开时按有序集合检查本地缓存"""
+        notmiss = set(resource_ids) & set(CDNRESOURCE.keys())
+        if not notmiss:
+            return
         caches_time_dict = {}
         # 本地最旧缓存时间点
         time_point = int(time.time())
@@ -47,70 +218,329 @@ def map_resources(resource_ids):
         scores = cache.zrangebyscore(name=cdncommon.CACHESETNAME,
                                      min=str(time_point - 3), max='+inf',
                                      withscores=True, score_cast_func=int)
-        if scores:
-            for data in scores:
-                resource_id = int(data[0])
-                cache_on = int(data[1])
-                # redis中缓存时间点超过本地缓存时间点
-                # 弹出本地缓存
-                try:
-                    # 保险做法本地缓存时间回退3秒
-                    if cache_on > caches_time_dict[resource_id] - 3:
-                        CDNRESOURCE.pop(resource_id, None)
-                except KeyError:
-                    continue
-        caches_time_dict.clear()
-    # 没有本地缓存的资源数量
-    missed = need - set(CDNRESOURCE.keys())
-    if missed:
-        # 重新从数据库读取
-        with goperation.tlock('gogamechen3-cdnresource'):
-            resources = cdnresource_controller.list(resource_ids=missed,
-                                                    versions=True, domains=True, metadatas=True)
-            for resource in resources:
-                resource_id = resource.get('resource_id')
-                agent_id = resource.get('agent_id')
-                port = resource.get('port')
-                internal = resource.get('internal')
-                name = resource.get('name')
-                etype = resource.get('etype')
-                domains = resource.get('domains')
-                versions = resource.get('versions')
-                metadata = resource.get('metadata')
-                if internal:
-                    if not metadata:
-                        raise ValueError('Agent %d not online, get domain entity fail' % agent_id)
-                    hostnames = [metadata.get('local_ip')]
-                else:
-                    if not domains:
-                        if not metadata:
-                            raise ValueError('Agent %d not online get domain entity fail' % agent_id)
-                        if metadata.get('external_ips'):
-                            hostnames = metadata.get('external_ips')
-                        else:
-                            hostnames = [metadata.get('local_ip')]
-                    else:
-                        hostnames = domains
-                schema = 'http'
-                if port == 443:
-                    schema = 'https'
-                netlocs = []
-                for host in hostnames:
-                    if port in (80, 443):
-                        netloc = '%s://%s' % (schema, host)
-                    else:
-                        netloc = '%s://%s:%d' % (schema, host, port)
-                    netlocs.append(netloc)
-                CDNRESOURCE.setdefault(resource_id, dict(name=name, etype=etype, agent_id=agent_id,
-                                                         internal=internal, versions=versions,
-                                                         netlocs=netlocs, port=port,
-                                                         domains=domains))
+        for resource_id, cache_on in scores:
+            resource_id = int(resource_id)
+            # redis中缓存时间点超过本地缓存时间点(回退3秒), 弹出本地缓存
+            if resource_id in caches_time_dict and cache_on > caches_time_dict[resource_id] - 3:
+                self.invalidate(resource_id)
+
+
+invalidator = ResourceInvalidator()
+# 正在加载的资源, 同一资源同时只有一个加载
+_loading = {}
+
+
+def _load(resource_ids):
+    events = dict((resource_id, Event()) for resource_id in resource_ids)
+    versions = dict((resource_id, invalidator.versions.get(resource_id, 0))
+                    for resource_id in resource_ids)
+    _loading.update(events)
+    try:
+        resources = cdnresource_controller.list(resource_ids=resource_ids,
+                                                versions=True, domains=True, metadatas=True)
+        for resource in resources:
+            resource_id, info = _resource_info(resource)
+            # 加载期间收到失效通知, 结果可能是旧的
+            if invalidator.versions.get(resource_id, 0) == versions.get(resource_id):
+                CDNRESOURCE[resource_id] = info
+    except Exception as e:
+        for waiter in six.itervalues(events):
+            waiter.send_exception(e)
+        raise
+    else:
+        for waiter in six.itervalues(events):
+            waiter.send()
+    finally:
+        for resource_id in resource_ids:
+            _loading.pop(resource_id, None)
+
+
+def map_resources(resource_ids):
+    """
+    保证资源在本地缓存中, 订阅正常时命中缓存不需要网络请求
+    未命中的资源批量加载, 其他请求正在加载的资源等待其结果
+    """
+    invalidator.start()
+    # 删除过期缓存
+    CDNRESOURCE.expire()
+    need = set(resource_ids)
+    if not invalidator.subscribed:
+        invalidator.probe(need)
+    # 加载期间失效的资源重试
+    for _ in range(3):
+        missed = need - set(CDNRESOURCE.keys())
+        if not missed:
+            return
+        waits = [_loading[resource_id] for resource_id in missed if resource_id in _loading]
+        loads = [resource_id for resource_id in missed if resource_id not in _loading]
+        if loads:
+            _load(loads)
+        for waiter in waits:
+            waiter.wait()
 
 
 def resource_cache_map(resource_id, flush=True):
-    """cache  resource info"""
-    if flush:
+    """
+    cache  resource info
+    缓存随时可能被失效通知弹出, flush为False时本地没有缓存也会重新加载
+    """
+    if flush or resource_id not in CDNRESOURCE:
         map_resources(resource_ids=[resource_id, ])
-    if resource_id not in CDNRESOURCE:
+    try:
+        return CDNRESOURCE[resource_id]
+    except KeyError:
         raise InvalidArgument('Resource not exit')
-    return CDNRESOURCE[resource_id]
+
+
+# 包列表快照世代, 包, 包文件, 包区服, 实体, 区服, 组变更时增加
+PACKAGES_GENERATION = 'gogamechen3-packages-generation'
+PACKAGES_MODELS = (Package, PackageFile, PackageArea, AppEntity, GameArea, Group)
+_CHANGED = 'gogamechen3-packages-changed'
+
+
+def packages_generation():
+    cache = get_cache()
+    generation = cache.get(PACKAGES_GENERATION)
+    return int(generation) if generation else 0
+
+
+def bump_packages_generation():
+    cache = get_cache()
+    return cache.incr(PACKAGES_GENERATION)
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session, flush_context):
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, PACKAGES_MODELS):
+            session.info[_CHANGED] = True
+            return
+
+
+def _after_bulk(update_context):
+    if issubclass(update_context.mapper.class_, PACKAGES_MODELS):
+        update_context.session.info[_CHANGED] = True
+
+
+event.listen(Session, 'after_bulk_update', _after_bulk)
+event.listen(Session, 'after_bulk_delete', _after_bulk)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    if session.info.pop(_CHANGED, False):
+        try:
+            bump_packages_generation()
+        except Exception as e:
+            LOG.error('Bump packages generation fail, %s' % e.__class__.__name__)
+            return
+        # 延迟发布服务器列表静态文件
+        from gogamechen3.api.wsgi import serverlist
+        serverlist.schedule()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(_CHANGED, None)
+
+
+# 变更记录, 每个版本保存条目摘要, 按条目比较得到变更
+# 版本号每种记录独立增加, 与包列表世代无关
+CHANGELOG = 'gogamechen3-changelog-%s'
+CHANGELOG_REVISION = 'gogamechen3-changelog-%s-revision'
+CHANGELOG_DIGESTS = 'gogamechen3-changelog-%s-%d'
+# 空记录占位
+_PLACEHOLDER = '_'
+
+
+def _digests(items):
+    digests = dict((key, hashlib.md5(json.dumps(item, sort_keys=True)).hexdigest())
+                   for key, item in six.iteritems(items))
+    digests[_PLACEHOLDER] = ''
+    return digests
+
+
+def record_changelog(kind, items, size):
+    """
+    记录条目摘要, items为{key: 条目}, 只保留最近size个版本
+    与最近一次记录相同时返回原版本, 不同时(包括agent状态等不在数据库中的数据)增加kind的版本号
+    只在构建快照时调用, 不修改共享的包列表世代
+    """
+    cache = get_cache()
+    digests = _digests(items)
+    index = CHANGELOG % kind
+    last = cache.lindex(index, -1)
+    if last is not None and cache.hgetall(CHANGELOG_DIGESTS % (kind, int(last))) == digests:
+        return int(last)
+    revision = cache.incr(CHANGELOG_REVISION % kind)
+    cache.hmset(CHANGELOG_DIGESTS % (kind, revision), digests)
+    count = cache.rpush(index, revision)
+    if count > size:
+        expired = cache.lrange(index, 0, count - size - 1)
+        cache.ltrim(index, -size, -1)
+        if expired:
+            cache.delete(*[CHANGELOG_DIGESTS % (kind, int(_revision)) for _revision in expired])
+    return revision
+
+
+def changelog(kind, since, items):
+    """
+    与since版本比较, 返回(变化或新增的条目, 删除的key)
+    since版本已经不在记录中时返回None, 调用者返回完整数据
+    """
+    cache = get_cache()
+    old = cache.hgetall(CHANGELOG_DIGESTS % (kind, since))
+    if not old:
+        return None
+    digests = _digests(items)
+    changed = [items[key] for key, digest in six.iteritems(digests)
+               if key != _PLACEHOLDER and old.get(key) != digest]
+    removed = [key for key in old if key != _PLACEHOLDER and key not in digests]
+    return changed, removed
+
+
+class Snapshot(object):
+    """预先序列化并gzip的响应"""
+
+    def __init__(self, generation, body, resource_ids, items=None, revision=None):
+        # 构建时的包列表世代, 判断快照是否过期
+        self.generation = generation
+        # 条目变更记录版本, 返回给客户端用于获取变更
+        self.revision = generation if revision is None else revision
+        # 条目, 用于计算变更
+        self.items = items or {}
+        self.created = int(time.time())
+        self.body = body
+        self.etag = 'W/"%d-%s"' % (self.revision, hashlib.md5(body).hexdigest())
+        self.resource_ids = set(resource_ids)
+        buf = cStringIO.StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+            f.write(body)
+        self.gzipped = buf.getvalue()
+
+    def response(self, req):
+        """匹配If-None-Match返回304, 客户端支持gzip时返回压缩数据"""
+        headers = [('ETag', self.etag), ('Cache-Control', 'no-cache'), ('Vary', 'Accept-Encoding')]
+        etags = [etag.strip() for etag in req.headers.get('If-None-Match', '').split(',')]
+        if self.etag in etags or '*' in etags:
+            return webob.Response(status=304, headerlist=headers)
+        response = webob.Response(content_type='application/json', charset='UTF-8',
+                                  headerlist=headers)
+        if 'gzip' in req.headers.get('Accept-Encoding', ''):
+            response.body = self.gzipped
+            response.content_encoding = 'gzip'
+        else:
+            response.body = self.body
+        return response
+
+
+class SnapshotCache(object):
+    """
+    按key缓存响应快照, 世代变化, 引用的cdn资源更新或者超过ttl时重建
+    同一个key同时只有一个请求重建
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+        self.locks = {}
+
+    def _fresh(self, snapshot, generation, ttl):
+        if snapshot is None or snapshot.generation < generation:
+            return False
+        if time.time() - snapshot.created > ttl:
+            return False
+        if snapshot.resource_ids and invalidator.subscribed:
+            for resource_id in snapshot.resource_ids:
+                if invalidator.changed.get(resource_id, 0) >= snapshot.created - 3:
+                    return False
+        elif snapshot.resource_ids:
+            cache = get_cache()
+            scores = cache.zrangebyscore(name=cdncommon.CACHESETNAME,
+                                         min=str(snapshot.created - 3), max='+inf')
+            if snapshot.resource_ids & set(int(resource_id) for resource_id in scores):
+                return False
+        return True
+
+    def get(self, key, builder, ttl):
+        """builder(世代)返回Snapshot"""
+        generation = packages_generation()
+        snapshot = self.snapshots.get(key)
+        if self._fresh(snapshot, generation, ttl):
+            return snapshot
+        with self.locks.setdefault(key, Semaphore(1)):
+            snapshot = self.snapshots.get(key)
+            if self._fresh(snapshot, generation, ttl):
+                return snapshot
+            snapshot = builder(generation)
+            self.snapshots[key] = snapshot
+            LOG.debug('Rebuild snapshot %s of generation %d, size %d/%d' %
+                      (key, snapshot.generation, len(snapshot.body), len(snapshot.gzipped)))
+            return snapshot
+
+
+# 实体所在agent, 端口与agent地址, 所有进程共享
+ENTITYS = 'gogamechen3-entity-endpoints'
+
+
+def _metadata(metadata):
+    if metadata:
+        metadata = dict(local_ip=metadata.get('local_ip'),
+                        external_ips=metadata.get('external_ips'),
+                        dnsnames=metadata.get('dnsnames'))
+    return metadata
+
+
+def entity_endpoints(entitys):
+    """
+    与entity_controller.shows返回格式一致, metadata只有local_ip, external_ips, dnsnames
+    只缓存实体的agent与端口, 缓存未命中或超过entity_cache_ttl时批量调用shows
+    metadata随agent在线状态变化, 不缓存, 命中的实体按agent读取当前metadata
+    """
+    entitys = list(set(entitys))
+    ttl = CONF[common.NAME].entity_cache_ttl
+    emaps = {}
+    missed = entitys
+    if ttl and entitys:
+        cache = get_cache()
+        now = time.time()
+        missed = []
+        for entity, value in zip(entitys, cache.hmget(ENTITYS, entitys)):
+            if value:
+                info = json.loads(value)
+                if now - info.pop('cached') <= ttl:
+                    emaps[entity] = info
+                    continue
+            missed.append(entity)
+        metadatas = {}
+        for info in six.itervalues(emaps):
+            agent_id = info['agent_id']
+            if agent_id not in metadatas:
+                metadatas[agent_id] = _metadata(BaseContorller.agent_metadata(agent_id))
+            info['metadata'] = metadatas[agent_id]
+    if not missed:
+        return emaps
+    maps = entity_controller.shows(common.NAME, missed, ports=True, metadata=True)
+    caching = {}
+    for entity in missed:
+        info = maps.get(entity)
+        if info is None:
+            emaps[entity] = None
+            continue
+        info = dict(agent_id=info.get('agent_id'), ports=info.get('ports'))
+        if ttl:
+            caching[entity] = json.dumps(dict(info, cached=int(time.time())))
+        info['metadata'] = _metadata(maps[entity].get('metadata'))
+        emaps[entity] = info
+    if caching:
+        get_cache().hmset(ENTITYS, caching)
+    return emaps
+
+
+def invalidate_entitys(entitys):
+    """端口变更, 迁移, 删除后清除实体缓存"""
+    if not entitys:
+        return
+    try:
+        get_cache().hdel(ENTITYS, *entitys)
+    except Exception as e:
+        LOG.error('Clean entity endpoints cache fail, %s' % e.__class__.__name__)
@@ -10,6 +10,57 @@ resource_opts = [
     cfg.IntOpt('package_resource',
                default=0,
                help='Gopcdn resource for packages files'),
+    cfg.IntOpt('objfile_fanout',
+               default=4,
+               min=1, max=32,
+               help='Agents one agent send objfile to in peer mode'),
+    cfg.IntOpt('packages_cache_ttl',
+               default=60,
+               min=0, max=3600,
+               help='Packages list response snapshot max live seconds, rebuild at once when '
+                    'packages, areas, entitys or resources change, 0 means no cache'),
+    cfg.IntOpt('changelog_size',
+               default=100,
+               min=1, max=10000,
+               help='Generations kept for packages and areas changes feed'),
+    cfg.IntOpt('serverlist_resource',
+               default=0,
+               help='Gopcdn resource for server list static files, 0 means not publish'),
+    cfg.IntOpt('serverlist_delay',
+               default=5,
+               min=1, max=300,
+               help='Publish server list seconds after packages, areas or entitys change'),
+    cfg.IntOpt('serverlist_keep',
+               default=3,
+               min=2, max=100,
+               help='Keep server list files of newest generations'),
+    cfg.IntOpt('resource_reconcile_interval',
+               default=1,
+               min=1, max=60,
+               help='Seconds between scans of gopcdn resource cache set, changed resources '
+                    'are published to other processes to clean local cache'),
+    cfg.IntOpt('entity_cache_ttl',
+               default=60,
+               min=0, max=3600,
+               help='Entity agent and ports cache live seconds, cleared at once when entity '
+                    'ports or agent change, agent metadata is never cached, 0 means no cache'),
+    cfg.BoolOpt('appfile_delta',
+                default=False,
+                help='Send appfile deltas with upgrade, agent has the base file download delta only'),
+]
+
+merge_opts = [
+    cfg.IntOpt('merge_dump_speed',
+               default=20, min=1,
+               help='Default merge dump speed(MB/s) of one worker, '
+                    'used when no merge history found'),
+    cfg.IntOpt('merge_load_speed',
+               default=10, min=1,
+               help='Default merge load speed(MB/s) of one worker, '
+                    'used when no merge history found'),
+    cfg.IntOpt('merge_history',
+               default=10, min=1, max=100,
+               help='Count of finished merge task used for merge plan'),
 ]
 
 
@@ -17,3 +68,4 @@ def register_opts(group):
     # database for gopdb
     CONF.register_opts(database_opts, group)
     CONF.register_opts(resource_opts, group)
+    CONF.register_opts(merge_opts, group)
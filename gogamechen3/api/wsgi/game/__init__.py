@@ -43,6 +43,11 @@ from gopcdn.api.wsgi.resource import CdnResourceReuest
 from gogamechen3 import common
 from gogamechen3 import utils
 from gogamechen3.api import endpoint_session
+from gogamechen3.api.wsgi.caches import Snapshot
+from gogamechen3.api.wsgi.caches import SnapshotCache
+from gogamechen3.api.wsgi.caches import record_changelog
+from gogamechen3.api.wsgi.caches import changelog
+from gogamechen3.api.wsgi.caches import entity_endpoints
 
 from gogamechen3.models import Group
 from gogamechen3.models import AppEntity
@@ -79,6 +84,9 @@ cdnresource_controller = CdnResourceReuest()
 
 CONF = cfg.CONF
 
+# 区服变更快照, 世代变化或者超过ttl时重建
+areas_snapshots = SnapshotCache()
+
 
 def areas_map(group_id):
     session = endpoint_session(readonly=True)
@@ -294,7 +302,7 @@ class GroupReuest(BaseContorller):
 
             th = eventlet.spawn(_pmaps)
 
-        emaps = entity_controller.shows(common.NAME, entitys, ports=True, metadata=True)
+        emaps = entity_endpoints(entitys)
 
         if packages and common.GAMESERVER in objtypes:
             th.wait()
@@ -375,6 +383,51 @@ class GroupReuest(BaseContorller):
         return resultutils.results(result='list group areas success',
                                    data=[dict(chiefs=chiefs, areas=areas)])
 
+    def areachanges(self, req, group_id, body=None):
+        """
+        返回generation世代之后变化的区服与chief, 以及删除的区服id与chief实体id
+        没有generation或者世代已经不在变更记录中时返回全部
+        """
+        body = body or {}
+        need_ok = bool(body.get('need_ok', False))
+        packages = bool(body.get('packages', False))
+        since = body.get('generation')
+        try:
+            since = int(since) if since is not None else None
+        except (TypeError, ValueError):
+            raise InvalidArgument('Generation value error')
+        group_ids = None
+        if group_id != 'all':
+            group_ids = sorted(argutils.map_to_int(group_id))
+        kind = 'areas-%s-%d-%d' % (','.join(map(str, group_ids)) if group_ids else 'all',
+                                   need_ok, packages)
+
+        def _build(generation):
+            chiefs, areas = self.entitys([common.GAMESERVER, common.GMSERVER],
+                                         group_ids, need_ok, packages)
+            items = dict(('chief-%d' % chief['entity'], chief) for chief in chiefs)
+            items.update(('area-%d' % area['area_id'], area) for area in areas)
+            revision = record_changelog(kind, items, CONF[common.NAME].changelog_size)
+            # 只使用条目计算变更, 不需要预先序列化的响应
+            return Snapshot(generation, '', [], items, revision)
+
+        snapshot = areas_snapshots.get(kind, _build, CONF[common.NAME].packages_cache_ttl)
+        items = snapshot.items
+        generation = snapshot.revision
+        changes = None
+        if since is not None:
+            changes = ([], []) if since == generation else changelog(kind, since, items)
+        full = changes is None
+        changed, removed = (items.values(), []) if full else changes
+        return resultutils.results(result='list group areas changes success',
+                                   data=[dict(generation=generation, full=full,
+                                              chiefs=[item for item in changed if 'area_id' not in item],
+                                              areas=[item for item in changed if 'area_id' in item],
+                                              removed=dict(chiefs=[int(key[6:]) for key in removed
+                                                                   if key.startswith('chief-')],
+                                                           areas=[int(key[5:]) for key in removed
+                                                                  if key.startswith('area-')]))])
+
     def databases(self, req, group_id, body=None):
         body = body or {}
         objtype = body.get('objtype', common.GAMESERVER)
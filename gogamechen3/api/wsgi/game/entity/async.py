@@ -25,6 +25,7 @@ from goperation.manager.wsgi.entity.controller import EntityReuest
 from gogamechen3 import common
 from gogamechen3.api import endpoint_session
 from gogamechen3.models import AppEntity
+from gogamechen3.models import ObjtypeFileDelta
 
 from gogamechen3.api.wsgi.utils import gmurl
 
@@ -132,6 +133,39 @@ class AppEntityAsyncReuest(AppEntityReuestBase):
                                      }}}
               }
 
+    PREPARE = {'type': 'object',
+               'required': [common.APPFILE],
+               'properties': {
+                   common.APPFILE: {
+                       'type': 'object',
+                       'required': ['md5', 'timeout'],
+                       'properties': {'md5': {'type': 'string', 'format': 'md5',
+                                              'description': '更新程序文件所需文件'},
+                                      'timeout': {'type': 'integer', 'minimum': 10, 'maxmum': 600,
+                                                  'description': '下载与解压超时时间'}}}}
+               }
+
+    COMMIT = {'type': 'object',
+              'required': [common.APPFILE],
+              'properties': {
+                  common.APPFILE: {
+                      'type': 'object',
+                      'required': ['md5'],
+                      'properties': {'md5': {'type': 'string', 'format': 'md5',
+                                             'description': '已经准备好的程序文件'}}}}
+              }
+
+    @staticmethod
+    def _appfile_deltas(appfile):
+        """附带程序文件的差分包, 本地有基础文件的agent只下载差分包"""
+        if not appfile or not CONF[common.NAME].appfile_delta:
+            return
+        session = endpoint_session(readonly=True)
+        query = model_query(session, ObjtypeFileDelta, filter=ObjtypeFileDelta.target == appfile.get('md5'))
+        deltas = [dict(md5=delta.md5, base=delta.base) for delta in query]
+        if deltas:
+            appfile.setdefault('deltas', deltas)
+
     def _async_bluck_rpc(self, action, group_id, objtype, entity, body=None, context=None):
         caller = inspect.stack()[0][3]
         body = body or {}
@@ -246,8 +280,30 @@ class AppEntityAsyncReuest(AppEntityReuestBase):
         body.update({'timeline': timeline,
                      'deadline': finishtime + 3 + (runtime * 2)})
         body.setdefault('objtype', objtype)
+        self._appfile_deltas(objfiles.get(common.APPFILE))
         return self._async_bluck_rpc('upgrade', group_id, objtype, entity, body)
 
+    def prepare(self, req, group_id, objtype, entity, body=None):
+        """两阶段更新, 程序运行中预先下载并解压程序文件"""
+        body = body or {}
+        jsonutils.schema_validate(body, self.PREPARE)
+        body.setdefault('objtype', objtype)
+        self._appfile_deltas(body.get(common.APPFILE))
+        return self._async_bluck_rpc('prepare', group_id, objtype, entity, body)
+
+    def commit(self, req, group_id, objtype, entity, body=None):
+        """两阶段更新, 停服切换到已经准备好的版本并重新启动"""
+        body = body or {}
+        jsonutils.schema_validate(body, self.COMMIT)
+        body.setdefault('objtype', objtype)
+        return self._async_bluck_rpc('commit', group_id, objtype, entity, body)
+
+    def rollback(self, req, group_id, objtype, entity, body=None):
+        """版本目录模式, 停服切换回上一个版本并重新启动"""
+        body = body or {}
+        body.setdefault('objtype', objtype)
+        return self._async_bluck_rpc('rollback', group_id, objtype, entity, body)
+
     def flushconfig(self, req, group_id, objtype, entity, body=None):
         body = body or {}
         group_id = int(group_id)
@@ -33,6 +33,7 @@ from gopcdn.api.wsgi.resource import CdnQuoteRequest
 from gogamechen3 import common
 from gogamechen3.api import get_gamelock
 from gogamechen3.api import endpoint_session
+from gogamechen3.api.wsgi import caches
 
 from gogamechen3.models import Group
 from gogamechen3.models import AppEntity
@@ -136,8 +137,7 @@ class AppEntityCURDRequest(AppEntityReuestBase):
         if not results['data']:
             return results
 
-        emaps = entity_controller.shows(endpoint=common.NAME,
-                                        entitys=[column.get('entity') for column in results['data']])
+        emaps = caches.entity_endpoints([column.get('entity') for column in results['data']])
 
         for column in results['data']:
             entity = column.get('entity')
@@ -312,7 +312,7 @@ class AppEntityCURDRequest(AppEntityReuestBase):
                     if not cross:
                         raise InvalidArgument('cross server can not be found or not active')
                     # 获取实体相关服务器信息(端口/ip)
-                    maps = entity_controller.shows(endpoint=common.NAME, entitys=[gm.entity, cross.entity])
+                    maps = caches.entity_endpoints([gm.entity, cross.entity])
                     for v in six.itervalues(maps):
                         if v is None:
                             raise InvalidArgument('Get chiefs info error, agent not online?')
@@ -401,6 +401,7 @@ class AppEntityCURDRequest(AppEntityReuestBase):
         # threadpool.add_thread(port_controller.unsafe_create,
         #                       agent_id, common.NAME, entity, rpc_result.get('ports'))
         port_controller.unsafe_create(agent_id, common.NAME, entity, rpc_result.get('ports'))
+        caches.invalidate_entitys([entity])
         # agent 后续通知
         threadpool.add_thread(entity_controller.post_create_entity,
                               entity, common.NAME, objtype=objtype,
@@ -1,5 +1,10 @@
 # -*- coding:utf-8 -*-
+import time
+import six
+import eventlet
+
 from sqlalchemy.orm import joinedload
+from simpleutil.common.exceptions import InvalidArgument
 from simpleutil.log import log as logging
 from simpleutil.utils import argutils
 from simpleutil.config import cfg
@@ -7,7 +12,11 @@ from simpleutil.config import cfg
 from simpleservice.ormdb.api import model_query
 
 
+from goperation.manager import common as manager_common
+from goperation.manager.api import get_client
 from goperation.manager.utils import resultutils
+from goperation.manager.utils import targetutils
+from goperation.manager.wsgi.contorller import BaseContorller
 from goperation.manager.wsgi.port.controller import PortReuest
 from goperation.manager.wsgi.entity.controller import EntityReuest
 
@@ -36,6 +45,27 @@ cdnresource_controller = CdnResourceReuest()
 CONF = cfg.CONF
 
 
+def _aggregate(records):
+    """按flow统计次数, 失败数, 耗时, 处理量"""
+    flows = {}
+    for record in records:
+        stats = flows.setdefault(record.get('flow'), dict(count=0, fail=0, elapsed=0, maxelapsed=0,
+                                                           size=0, rows=0))
+        elapsed = record.get('elapsed') or 0
+        stats['count'] += 1
+        if record.get('outcome') != 'SUCCESS':
+            stats['fail'] += 1
+        stats['elapsed'] += elapsed
+        stats['maxelapsed'] = max(stats['maxelapsed'], elapsed)
+        stats['size'] += record.get('size') or 0
+        stats['rows'] += record.get('rows') or 0
+    for stats in six.itervalues(flows):
+        stats['elapsed'] = round(stats['elapsed'], 3)
+        # 每秒处理字节数
+        stats['speed'] = int(stats['size'] / stats['elapsed']) if stats['elapsed'] else 0
+    return flows
+
+
 class AppEntityInternalReuest(AppEntityReuestBase):
     """async internal function"""
 
@@ -83,6 +113,104 @@ class AppEntityInternalReuest(AppEntityReuestBase):
         return resultutils.results(result='get agents chioces success',
                                    data=chioces)
 
+    def metrics(self, req, body=None):
+        """汇总agent上的taskflow执行记录, 按agent与数据库地址统计"""
+        body = body or {}
+        since = body.get('since') or int(time.time()) - 604800
+        flow = body.get('flow')
+        agents = body.get('agents')
+        if agents:
+            agents = argutils.map_to_int(agents)
+        else:
+            session = endpoint_session(readonly=True)
+            query = model_query(session, AppEntity.agent_id, filter=AppEntity.status > common.DELETED)
+            agents = set([_entity.agent_id for _entity in query.distinct()])
+        results = {}
+        for agent_id, rpc_ret in six.iteritems(self._agents_call(agents, 'metrics', dict(since=since, flow=flow))):
+            if isinstance(rpc_ret, dict):
+                results[agent_id] = dict(agent_id=agent_id, result=rpc_ret.get('result'),
+                                         records=rpc_ret.get('records') or [])
+            else:
+                results[agent_id] = dict(agent_id=agent_id, result=rpc_ret, flows={})
+
+        hosts = {}
+        for info in six.itervalues(results):
+            records = info.pop('records', [])
+            info['flows'] = _aggregate([record for record in records if record.get('kind') == 'flow'])
+            # 数据库地址按task统计, 避免与flow重复
+            for record in records:
+                if record.get('kind') == 'task' and record.get('host'):
+                    hosts.setdefault(record['host'], []).append(record)
+
+        return resultutils.results(result='get taskflow metrics success',
+                                   data=[dict(since=since,
+                                              agents=sorted(results.values(), key=lambda x: x['agent_id']),
+                                              hosts=[dict(host=host, flows=_aggregate(records))
+                                                     for host, records in six.iteritems(hosts)])])
+
+    @staticmethod
+    def _agents_call(agents, method, args):
+        """
+        并发调用多个agent的只读rpc接口
+        成功返回agent的rpc结果dict, 失败返回错误信息字符串
+        """
+        rpc = get_client()
+        results = {}
+
+        def _call(agent_id):
+            metadata = BaseContorller.agent_metadata(agent_id)
+            if not metadata:
+                results[agent_id] = 'agent is off line'
+                return
+            target = targetutils.target_agent_by_string(metadata.get('agent_type'), metadata.get('host'))
+            target.namespace = common.NAME
+            try:
+                rpc_ret = rpc.call(target, ctxt={'agents': [agent_id, ]},
+                                   msg={'method': method, 'args': args},
+                                   timeout=10)
+            except Exception as e:
+                LOG.error('Call %s on agent %d fail, %s' % (method, agent_id, e.__class__.__name__))
+                results[agent_id] = 'rpc call fail'
+                return
+            if not rpc_ret or rpc_ret.get('resultcode') != manager_common.RESULT_SUCCESS:
+                results[agent_id] = 'get %s fail' % method
+                return
+            results[agent_id] = rpc_ret
+
+        if agents:
+            pool = eventlet.GreenPool(min(len(agents), 20))
+            for agent_id in agents:
+                pool.spawn_n(_call, agent_id)
+            pool.waitall()
+        return results
+
+    def profile(self, req, body=None):
+        """获取agent的rpc耗时, 实体锁等待与hub阻塞记录, 只读"""
+        body = body or {}
+        return self._profile(body.get('agents'), dump=False, reset=False)
+
+    def profile_reset(self, req, body=None):
+        """获取agent性能记录后清空统计, dump为True时agent同时写入本地文件"""
+        body = body or {}
+        return self._profile(body.get('agents'), dump=body.get('dump', False),
+                             reset=body.get('reset', True))
+
+    @staticmethod
+    def _profile(agents, dump, reset):
+        if not agents:
+            raise InvalidArgument('Agents is none')
+        agents = argutils.map_to_int(agents)
+        results = []
+        rets = AppEntityInternalReuest._agents_call(agents, 'profile', dict(dump=dump, reset=reset))
+        for agent_id, rpc_ret in six.iteritems(rets):
+            if isinstance(rpc_ret, dict):
+                results.append(dict(agent_id=agent_id, result=rpc_ret.get('result'),
+                                    profile=rpc_ret.get('profile')))
+            else:
+                results.append(dict(agent_id=agent_id, result=rpc_ret))
+        return resultutils.results(result='get agent profile success',
+                                   data=sorted(results, key=lambda x: x['agent_id']))
+
     def entitys(self, req, body=None):
         """批量查询entitys信息接口,内部接口agent启动的时调用,一般由agent端调用"""
         entitys = body.get('entitys')
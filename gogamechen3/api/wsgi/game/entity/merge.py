@@ -1,6 +1,9 @@
 # -*- coding:utf-8 -*-
 import time
+import math
+import six
 import eventlet
+import mysql.connector
 
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import and_
@@ -33,6 +36,7 @@ from gopcdn.api.wsgi.resource import CdnResourceReuest
 from gogamechen3 import common
 from gogamechen3.api import get_gamelock
 from gogamechen3.api import endpoint_session
+from gogamechen3.api.wsgi import caches
 from gogamechen3.api import exceptions
 
 from gogamechen3.models import AppEntity
@@ -54,6 +58,24 @@ cdnresource_controller = CdnResourceReuest()
 CONF = cfg.CONF
 
 
+def schema_tables(database):
+    """从information_schema获取每张表的行数与大小"""
+    conn = mysql.connector.connect(user=database.get('user'), passwd=database.get('passwd'),
+                                   host=database.get('host'), port=database.get('port'),
+                                   database='information_schema')
+    try:
+        cursor = conn.cursor()
+        cursor.execute('select TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH '
+                       'from TABLES where TABLE_SCHEMA = %s', (database.get('schema'), ))
+        tables = dict((table, dict(rows=int(rows or 0), datasize=int(datasize or 0),
+                                   indexsize=int(indexsize or 0)))
+                      for table, rows, datasize, indexsize in cursor.fetchall())
+        cursor.close()
+    finally:
+        conn.close()
+    return tables
+
+
 class AppEntityMergeReuest(AppEntityReuestBase):
     """合服相关代码"""
 
@@ -77,6 +99,131 @@ class AppEntityMergeReuest(AppEntityReuestBase):
                            'databases': {'type': 'object', 'description': '程序使用的数据库,不填自动分配'}}
                        }
 
+    MERGEPLAN = {'type': 'object',
+                 'required': ['entitys', 'group_id'],
+                 'properties': {
+                     'entitys': {'type': 'array',
+                                 'items': {'type': 'integer', 'minimum': 2},
+                                 'description': '需要合并的实体列表'},
+                     'group_id': {'type': 'integer', 'minimum': 1,
+                                  'description': '区服所在的组的ID'},
+                     'workers': {'type': 'integer', 'minimum': 1, 'maximum': 32,
+                                 'description': '合服并发数, 不填使用推荐并发数'}}
+                 }
+
+    def _merge_sizes(self, session, group_id, entitys):
+        """并行查询被合并实体数据库每张表大小, 去掉不导出的表"""
+        query = model_query(session, AppEntity,
+                            filter=and_(AppEntity.group_id == group_id, AppEntity.entity.in_(entitys)))
+        query = query.options(joinedload(AppEntity.databases, innerjoin=False))
+        appentitys = query.all()
+        if len(appentitys) != len(entitys):
+            raise InvalidArgument('Can not match entitys count')
+        databases = {}
+        for appentity in appentitys:
+            if appentity.objtype != common.GAMESERVER:
+                raise InvalidArgument('Target entity %d is not %s' % (appentity.entity, common.GAMESERVER))
+            database = self._database_to_dict(appentity).get(common.DATADB)
+            if not database:
+                raise InvalidArgument('Target entity %d has no %s' % (appentity.entity, common.DATADB))
+            databases[appentity.entity] = database
+        mini = min(entitys)
+        sizes = {}
+
+        def _sizes(entity):
+            tables = schema_tables(databases[entity])
+            nodumps = common.MERGE_NODUMPTABLES if entity == mini \
+                else common.MERGE_NODUMPTABLES + common.MERGE_DUMPONLYONE
+            for table in nodumps:
+                tables.pop(table, None)
+            sizes[entity] = tables
+
+        pool = eventlet.GreenPool(min(len(entitys), 10))
+        for entity in entitys:
+            pool.spawn_n(_sizes, entity)
+        pool.waitall()
+        if len(sizes) != len(entitys):
+            raise InvalidArgument('Get table size of entitys fail, miss %s' %
+                                  ','.join(map(str, set(entitys) - set(sizes))))
+        return databases, sizes
+
+    @staticmethod
+    def _merge_speed(session):
+        """根据最近完成的合服记录计算单并发每秒处理字节数"""
+        conf = CONF[common.NAME]
+        dumpspeed = conf.merge_dump_speed * 1024 * 1024
+        loadspeed = conf.merge_load_speed * 1024 * 1024
+        query = model_query(session, MergeTask, filter=MergeTask.status == common.MERGEFINISH)
+        query = query.order_by(MergeTask.mergetime.desc()).limit(conf.merge_history)
+        dumps = []
+        loads = []
+        for etask in query:
+            if not etask.metrics:
+                continue
+            metrics = jsonutils.loads_as_bytes(etask.metrics)
+            datasize = metrics.get('datasize')
+            workers = metrics.get('workers') or 1
+            if not datasize:
+                continue
+            if metrics.get('dumptime'):
+                dumps.append(float(datasize) / (metrics['dumptime'] * workers))
+            if metrics.get('loadtime'):
+                loads.append(float(datasize) / (metrics['loadtime'] * workers))
+        return dict(history=max(len(dumps), len(loads)),
+                    dumpspeed=int(sum(dumps) / len(dumps)) if dumps else dumpspeed,
+                    loadspeed=int(sum(loads) / len(loads)) if loads else loadspeed)
+
+    def plan(self, req, body=None):
+        """
+        合服预估, 不执行任何合服操作
+        按表统计数据量, 根据历史合服速度预测导出与导入时间并给出推荐并发数
+        """
+        body = body or {}
+        jsonutils.schema_validate(body, self.MERGEPLAN)
+        group_id = body.get('group_id')
+        entitys = sorted(set(body.get('entitys')))
+        session = endpoint_session(readonly=True)
+        databases, sizes = self._merge_sizes(session, group_id, entitys)
+        speed = self._merge_speed(session)
+
+        infos = []
+        # 同一张表多个实体只能依次导入
+        tables = {}
+        largest = 0
+        for entity in entitys:
+            _tables = sizes[entity]
+            datasize = 0
+            for table, size in six.iteritems(_tables):
+                datasize += size['datasize'] + size['indexsize']
+                largest = max(largest, size['datasize'] + size['indexsize'])
+                tables[table] = tables.get(table, 0) + size['datasize'] + size['indexsize']
+            infos.append(dict(entity=entity,
+                              host=databases[entity].get('host'),
+                              schema=databases[entity].get('schema'),
+                              tables=len(_tables),
+                              rows=sum(size['rows'] for size in six.itervalues(_tables)),
+                              datasize=sum(size['datasize'] for size in six.itervalues(_tables)),
+                              indexsize=sum(size['indexsize'] for size in six.itervalues(_tables))))
+        total = sum(six.itervalues(tables))
+        # 最大的单表决定并发上限
+        recommend = int(math.ceil(float(total) / largest)) if largest else 1
+        recommend = max(1, min(32, recommend, sum(info['tables'] for info in infos)))
+        workers = body.get('workers') or recommend
+        # 导出按单表并行, 导入同表串行
+        dumptime = max(float(total) / (workers * speed['dumpspeed']),
+                       float(largest) / speed['dumpspeed'])
+        loadtime = max(float(total) / (workers * speed['loadspeed']),
+                       float(max(tables.values()) if tables else 0) / speed['loadspeed'])
+        return resultutils.results(result='plan merge entitys success',
+                                   data=[dict(entitys=infos,
+                                              skips=common.MERGE_NODUMPTABLES,
+                                              datasize=total,
+                                              workers=workers,
+                                              recommend=recommend,
+                                              speed=speed,
+                                              dumptime=int(dumptime),
+                                              loadtime=int(loadtime))])
+
     def merge(self, req, body=None):
         """合服接口,用于合服, 部分代码和create代码一直,未整合"""
         body = body or {}
@@ -110,6 +257,16 @@ class AppEntityMergeReuest(AppEntityReuestBase):
         crosss = []
         # 默认平台识标
         platform = None
+        # 合服数据量, 远程查询在加锁和事务之外
+        try:
+            datasize = 0
+            for tables in six.itervalues(self._merge_sizes(endpoint_session(readonly=True),
+                                                           group_id, entitys)[1]):
+                for size in six.itervalues(tables):
+                    datasize += size['datasize'] + size['indexsize']
+        except Exception as e:
+            LOG.warning('Count merge data size fail, %s' % e.__class__.__name__)
+            datasize = 0
         # 锁组
         glock = get_gamelock()
         with glock.grouplock(group_id):
@@ -136,7 +293,7 @@ class AppEntityMergeReuest(AppEntityReuestBase):
             if not cross:
                 raise InvalidArgument('cross server can not be found?')
             # 获取实体相关服务器信息(端口/ip)
-            maps = entity_controller.shows(endpoint=common.NAME, entitys=[gm.entity, cross.entity])
+            maps = caches.entity_endpoints([gm.entity, cross.entity])
             chiefs = dict()
             # 战场与GM服务器信息
             for chief in (cross, gm):
@@ -212,8 +369,9 @@ class AppEntityMergeReuest(AppEntityReuestBase):
                     self._bondto(session, mergetd_entity, rpc_result.get('databases'))
                 else:
                     LOG.error('New entity database miss')
-                # 插入合服记录
-                mtask = MergeTask(uuid=uuid, entity=mergetd_entity, mergetime=int(time.time()))
+                # 插入合服记录, 记录数据量用于预测后续合服时间
+                mtask = MergeTask(uuid=uuid, entity=mergetd_entity, mergetime=int(time.time()),
+                                  metrics=jsonutils.dumps(dict(datasize=datasize)))
                 session.add(mtask)
                 session.flush()
                 for _appentity in appentitys:
@@ -225,6 +383,7 @@ class AppEntityMergeReuest(AppEntityReuestBase):
                 session.flush()
             port_controller.unsafe_create(agent_id, common.NAME,
                                           mergetd_entity, rpc_result.get('ports'))
+            caches.invalidate_entitys([mergetd_entity])
             # agent 后续通知
             threadpool.add_thread(entity_controller.post_create_entity,
                                   appentity.entity, common.NAME, objtype=common.GAMESERVER,
@@ -428,6 +587,13 @@ class AppEntityMergeReuest(AppEntityReuestBase):
             if _entity.status != common.MERGEED:
                 raise InvalidArgument('Entity %d status is not mergeed' % _entity.entity)
         etask.status = common.MERGEFINISH
+        # agent上报的合服耗时
+        if body:
+            metrics = jsonutils.loads_as_bytes(etask.metrics) if etask.metrics else {}
+            for key in ('dumptime', 'loadtime', 'workers'):
+                if body.get(key) is not None:
+                    metrics[key] = int(body.get(key))
+            etask.metrics = jsonutils.dumps(metrics)
         session.flush()
         return resultutils.results(result='swallowed finished',
                                    data=[dict(uuid=etask.uuid,
@@ -33,6 +33,7 @@ from gopcdn.api.wsgi.resource import CdnResourceReuest
 from gogamechen3 import common
 from gogamechen3.api import get_gamelock
 from gogamechen3.api import endpoint_session
+from gogamechen3.api.wsgi import caches
 
 from gogamechen3.models import Group
 from gogamechen3.models import AppEntity
@@ -197,6 +198,7 @@ class AppEntitySyncReuest(AppEntityReuestBase):
                     # roll back unquote
                     threadpool.add_thread(_rollback)
                     raise e
+                caches.invalidate_entitys([entity])
         return resultutils.results(result='delete %s:%d success' % (objtype, entity),
                                    data=[dict(entity=entity, objtype=objtype,
                                               ports=ports, metadata=metadata)])
@@ -470,16 +472,22 @@ class AppEntitySyncReuest(AppEntityReuestBase):
         LOG.debug('Check appfile success, migrate start')
         areas = [dict(area_id=area.area_id, areaname=area.areaname, show_id=area.show_id)
                  for area in _entity.areas]
-        with entity_controller.migrate_with_out_data(common.NAME, entity, new,
-                                                     dict(token=uuidutils.generate_uuid()),
-                                                     drop_ports=True):
+        try:
+            with entity_controller.migrate_with_out_data(common.NAME, entity, new,
+                                                         dict(token=uuidutils.generate_uuid()),
+                                                         drop_ports=True):
 
-            _entity.agent_id = new
-            session.commit()
-            LOG.info('Migrate finish, now call post create entity and reset entity on new agent')
-            entity_controller.post_create_entity(
-                entity, common.NAME, objtype=objtype,
-                status=_entity.status, opentime=_entity.opentime, group_id=group_id,
-                areas=areas, migrate=True)
-            LOG.info('Notify create entity in new agent success')
-            return self.reset(req, group_id, objtype, entity, body)
\ No newline at end of file
+                _entity.agent_id = new
+                session.commit()
+                # agent与端口已经变更
+                caches.invalidate_entitys([entity])
+                LOG.info('Migrate finish, now call post create entity and reset entity on new agent')
+                entity_controller.post_create_entity(
+                    entity, common.NAME, objtype=objtype,
+                    status=_entity.status, opentime=_entity.opentime, group_id=group_id,
+                    areas=areas, migrate=True)
+                LOG.info('Notify create entity in new agent success')
+                return self.reset(req, group_id, objtype, entity, body)
+        finally:
+            # 新agent上报的端口
+            caches.invalidate_entitys([entity])
\ No newline at end of file
@@ -1,6 +1,7 @@
 # -*- coding:utf-8 -*-
 import time
 import os
+import zlib
 import urllib
 import eventlet
 import webob.exc
@@ -10,11 +11,13 @@ from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.exc import MultipleResultsFound
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql import and_
+from sqlalchemy.sql import or_
 
 from simpleutil.common.exceptions import InvalidArgument
 from simpleutil.log import log as logging
 from simpleutil.utils import jsonutils
 from simpleutil.utils import singleton
+from simpleutil.utils import uuidutils
 from simpleutil.config import cfg
 
 from simpleservice.ormdb.api import model_query
@@ -43,10 +46,12 @@ from gopcdn.api.wsgi.resource import CdnQuoteRequest
 from gogamechen3 import common
 from gogamechen3 import utils
 
+from gogamechen3.api import gfile
 from gogamechen3.api import endpoint_session
 from gogamechen3.api import get_gamelock
 from gogamechen3.models import AppEntity
 from gogamechen3.models import ObjtypeFile
+from gogamechen3.models import ObjtypeFileDelta
 from gogamechen3.models import Package
 from gogamechen3.models import PackageFile
 from gogamechen3.models import PackageArea
@@ -54,6 +59,11 @@ from gogamechen3.models import PackageRemark
 from gogamechen3.api.wsgi.game import GroupReuest
 from gogamechen3.api.wsgi.caches import resource_cache_map
 from gogamechen3.api.wsgi.caches import map_resources
+from gogamechen3.api.wsgi import serverlist
+from gogamechen3.api.wsgi.caches import Snapshot
+from gogamechen3.api.wsgi.caches import SnapshotCache
+from gogamechen3.api.wsgi.caches import record_changelog
+from gogamechen3.api.wsgi.caches import changelog
 from gogamechen3.api.wsgi.utils import gmurl
 
 LOG = logging.getLogger(__name__)
@@ -76,6 +86,9 @@ cdnquote_controller = CdnQuoteRequest()
 
 group_controller = GroupReuest()
 
+# 包列表响应快照
+packages_snapshots = SnapshotCache()
+
 CONF = cfg.CONF
 
 DEFAULTVALUE = object()
@@ -108,6 +121,26 @@ def gopcdn_upload(req, resource_id, body, fileinfo, notify=None):
     return uri
 
 
+def peer_plan(agents, fanout):
+    """
+    生成分发树, agents为{agent_id: (zone, peer地址)}
+    每个zone第一个agent从源地址下载, 其他agent按fanout叉树从上级获取
+    没有peer地址的agent从源地址下载并且不作为上级
+    """
+    plan = {}
+    zones = {}
+    for agent_id in sorted(agents):
+        zone, url = agents[agent_id]
+        if not url:
+            plan[agent_id] = None
+            continue
+        zones.setdefault(zone, []).append(agent_id)
+    for members in zones.values():
+        for index, agent_id in enumerate(members):
+            plan[agent_id] = members[(index - 1) // fanout] if index else None
+    return plan
+
+
 @singleton.singleton
 class ObjtypeFileReuest(BaseContorller):
 
@@ -127,6 +160,29 @@ class ObjtypeFileReuest(BaseContorller):
                             'description': '上传超时时间'},
                 'address': {'oneOf': [{'type': 'string'}, {'type': 'null'}]},
                 'fileinfo': cdncommon.FILEINFOSCHEMA,
+                'manifest': {'oneOf': [{'type': 'object',
+                                        'required': ['files'],
+                                        'properties': {'files': {'type': 'object'},
+                                                       'dirs': {'type': 'array'}}},
+                                       {'type': 'null'}],
+                             'description': '程序文件清单, agent只更新变化的文件'},
+            }
+    }
+
+    DELTASCHEMA = {
+        'type': 'object',
+        'required': ['base', 'fileinfo'],
+        'properties':
+            {
+                'base': {'type': 'string', 'format': 'md5', 'description': '差分包基础文件'},
+                'impl': {'oneOf': [{'type': 'string'}, {'type': 'null'}],
+                         'description': '上传方式,默认为websocket'},
+                'auth': {'oneOf': [{'type': 'string'}, {'type': 'object'}, {'type': 'null'}],
+                         'description': '上传认证相关信息'},
+                'timeout': {'oneOf': [{'type': 'integer', 'minimum': 30}, {'type': 'null'}],
+                            'description': '上传超时时间'},
+                'address': {'oneOf': [{'type': 'string'}, {'type': 'null'}]},
+                'fileinfo': cdncommon.FILEINFOSCHEMA,
             }
     }
 
@@ -183,30 +239,19 @@ class ObjtypeFileReuest(BaseContorller):
         if ext.startswith('.'):
             ext = ext[1:]
 
+        manifest = body.pop('manifest', None)
+        if manifest and subtype == common.APPFILE:
+            try:
+                gfile.check_manifest(objtype, manifest)
+            except ValueError as e:
+                raise InvalidArgument('Appfile manifest check fail, %s' % e.message)
         objfile = ObjtypeFile(md5=md5, srcname=srcname,
                               objtype=objtype, version=version,
                               subtype=subtype, group=group)
-        # 没有地址,通过gopcdn上传并存放
-        if not address:
-            resource_id = CONF[common.NAME].objfile_resource
-            if not resource_id:
-                raise InvalidArgument('Both address and resource_id is None')
-            resource = resource_cache_map(resource_id)
-            if not resource.get('internal', False):
-                raise InvalidArgument('objtype file resource not a internal resource')
-            objfile.resource_id = resource_id
-            # 上传结束后通知
-            notify = {'success': dict(action='/files/%s' % md5,
-                                      method='PUT',
-                                      body=dict(status=manager_common.DOWNFILE_FILEOK)),
-                      'fail': dict(action='/gogamechen3/objfiles/%s' % md5,
-                                   method='DELETE')}
-            uri = gopcdn_upload(req, resource_id, body,
-                                fileinfo=fileinfo, notify=notify)
-            address = resource_url(resource_id, uri.get('filename'))[0]
-            status = manager_common.DOWNFILE_UPLOADING
-        else:
-            status = manager_common.DOWNFILE_FILEOK
+        if manifest:
+            objfile.manifest = zlib.compress(jsonutils.dumps_as_bytes(manifest))
+        objfile.resource_id, uri, address, status = self._upload(req, body, fileinfo, address,
+                                                                 fail='/gogamechen3/objfiles/%s' % md5)
 
         session = endpoint_session()
         with session.begin():
@@ -226,6 +271,44 @@ class ObjtypeFileReuest(BaseContorller):
         return resultutils.results(result='creat file for %s success' % objtype,
                                    data=[dict(md5=objfile.md5, uri=uri)])
 
+    def _upload(self, req, body, fileinfo, address, fail):
+        """没有地址,通过gopcdn上传并存放"""
+        if address:
+            return None, None, address, manager_common.DOWNFILE_FILEOK
+        md5 = fileinfo.get('md5')
+        resource_id = CONF[common.NAME].objfile_resource
+        if not resource_id:
+            raise InvalidArgument('Both address and resource_id is None')
+        resource = resource_cache_map(resource_id)
+        if not resource.get('internal', False):
+            raise InvalidArgument('objtype file resource not a internal resource')
+        # 上传结束后通知
+        notify = {'success': dict(action='/files/%s' % md5,
+                                  method='PUT',
+                                  body=dict(status=manager_common.DOWNFILE_FILEOK)),
+                  'fail': dict(action=fail,
+                               method='DELETE')}
+        uri = gopcdn_upload(req, resource_id, body,
+                            fileinfo=fileinfo, notify=notify)
+        address = resource_url(resource_id, uri.get('filename'))[0]
+        return resource_id, uri, address, manager_common.DOWNFILE_UPLOADING
+
+    def _delete_file(self, req, md5, resource_id):
+        if resource_id:
+            show_result = file_controller.show(req, md5)
+            if show_result['resultcode'] == manager_common.RESULT_SUCCESS:
+                file_info = show_result['data'][0]
+                rpath = urlparse.urlparse(file_info['address']).path
+                filename = os.path.basename(rpath)
+                try:
+                    cdnresource_controller.delete_file(req, resource_id,
+                                                       body=dict(filename=filename))
+                except NoResultFound:
+                    LOG.error('Delete file from resource fail, resource disappeard')
+            else:
+                LOG.error('objfile %s can not be found from file controller' % md5)
+        return file_controller.delete(req, md5)
+
     def show(self, req, md5, body=None):
         body = body or {}
         session = endpoint_session(readonly=True)
@@ -251,27 +334,99 @@ class ObjtypeFileReuest(BaseContorller):
         query = model_query(session, ObjtypeFile, filter=ObjtypeFile.md5 == md5)
         objfile = query.one()
         resource_id = objfile.resource_id
+        deltas = model_query(session, ObjtypeFileDelta,
+                             filter=or_(ObjtypeFileDelta.target == md5,
+                                        ObjtypeFileDelta.base == md5)).all()
         with session.begin():
             session.delete(objfile)
             session.flush()
-            if resource_id:
-                show_result = file_controller.show(req, objfile.md5)
-                if show_result['resultcode'] == manager_common.RESULT_SUCCESS:
-                    file_info = show_result['data'][0]
-                    rpath = urlparse.urlparse(file_info['address']).path
-                    filename = os.path.basename(rpath)
-                    try:
-                        cdnresource_controller.delete_file(req, resource_id,
-                                                           body=dict(filename=filename))
-                    except NoResultFound:
-                        LOG.error('Delete file from resource fail, resource disappeard')
-                else:
-                    LOG.error('objfile %s can not be found from file controller')
-        return file_controller.delete(req, objfile.md5)
+            # 差分包随程序文件外键删除
+            for delta in deltas:
+                self._delete_file(req, delta.md5, delta.resource_id)
+            return self._delete_file(req, objfile.md5, resource_id)
 
     def update(self, req, md5, body=None):
         raise NotImplementedError
 
+    def manifest(self, req, md5, body=None):
+        """程序文件清单"""
+        session = endpoint_session(readonly=True)
+        query = model_query(session, ObjtypeFile.manifest, filter=ObjtypeFile.md5 == md5)
+        objfile = query.one()
+        manifest = jsonutils.loads_as_bytes(zlib.decompress(objfile.manifest)) if objfile.manifest else None
+        return resultutils.results(result='get manifest of %s success' % md5,
+                                   data=[dict(md5=md5, manifest=manifest)])
+
+    def deltas(self, req, md5, body=None):
+        """列出以md5为目标的差分包"""
+        session = endpoint_session(readonly=True)
+        query = model_query(session, ObjtypeFileDelta, filter=ObjtypeFileDelta.target == md5)
+        return resultutils.results(result='list deltas of %s success' % md5,
+                                   data=[dict(md5=delta.md5, base=delta.base, size=delta.size,
+                                              resource_id=delta.resource_id)
+                                         for delta in query])
+
+    def add_delta(self, req, md5, body=None):
+        """注册md5的差分包, 差分包由客户端用gdelta生成后上传"""
+        body = body or {}
+        jsonutils.schema_validate(body, self.DELTASCHEMA)
+        base = body.pop('base')
+        address = body.get('address')
+        fileinfo = body.pop('fileinfo')
+        if base == md5:
+            raise InvalidArgument('Delta base is target')
+        session = endpoint_session()
+        query = model_query(session, ObjtypeFile, filter=ObjtypeFile.md5.in_([md5, base]))
+        objfiles = dict([(objfile.md5, objfile) for objfile in query])
+        if len(objfiles) != 2:
+            raise InvalidArgument('Delta target or base not found')
+        target, _base = objfiles[md5], objfiles[base]
+        if (target.objtype, target.subtype) != (_base.objtype, _base.subtype):
+            raise InvalidArgument('Delta target and base not the same objtype or subtype')
+        if target.subtype != common.APPFILE:
+            raise InvalidArgument('Delta only for %s' % common.APPFILE)
+        delta = ObjtypeFileDelta(md5=fileinfo.get('md5'), target=md5, base=base,
+                                 size=fileinfo.get('size'))
+        delta.resource_id, uri, address, status = self._upload(req, body, fileinfo, address,
+                                                               fail='/gogamechen3/objfiles/%s/delta/%s'
+                                                                    % (md5, delta.md5))
+        ext = fileinfo.get('ext') or os.path.splitext(fileinfo.get('filename'))[1][1:]
+        if ext.startswith('.'):
+            ext = ext[1:]
+        with session.begin():
+            try:
+                session.add(delta)
+                session.flush()
+            except DBDuplicateEntry:
+                raise InvalidArgument('Delta of %s from %s duplicate' % (md5, base))
+            try:
+                file_controller.create(req, body=dict(md5=delta.md5,
+                                                      address=address,
+                                                      size=delta.size,
+                                                      ext=ext,
+                                                      status=status))
+            except DBDuplicateEntry:
+                raise InvalidArgument('File info Duplicate error')
+        return resultutils.results(result='creat delta for %s success' % md5,
+                                   data=[dict(md5=delta.md5, uri=uri)])
+
+    def del_delta(self, req, md5, delta, body=None):
+        session = endpoint_session()
+        query = model_query(session, ObjtypeFileDelta, filter=and_(ObjtypeFileDelta.target == md5,
+                                                                   ObjtypeFileDelta.md5 == delta))
+        _delta = query.one()
+        with session.begin():
+            session.delete(_delta)
+            session.flush()
+            return self._delete_file(req, _delta.md5, _delta.resource_id)
+
+    @staticmethod
+    def appfile_deltas(md5):
+        """更新时附带的差分包信息, agent选择本地已有的基础文件"""
+        session = endpoint_session(readonly=True)
+        query = model_query(session, ObjtypeFileDelta, filter=ObjtypeFileDelta.target == md5)
+        return [dict(md5=delta.md5, base=delta.base) for delta in query]
+
     def find(self, objtype, subtype, version):
         session = endpoint_session(readonly=True)
         query = model_query(session, ObjtypeFile, filter=and_(ObjtypeFile.objtype == objtype,
@@ -307,16 +462,33 @@ class ObjtypeFileReuest(BaseContorller):
             for r in query:
                 agents.append(r[0])
         agents = list(set(agents))
+        peer = body.pop('peer', False)
         asyncrequest = self.create_asyncrequest(body)
         target = targetutils.target_endpoint(common.NAME)
         async_ctxt = dict(pre_run=body.pop('pre_run', None),
                           after_run=body.pop('after_run', None),
                           post_run=body.pop('post_run', None))
-        target.namespace = manager_common.NAME
         rpc_ctxt = {}
         rpc_ctxt.setdefault('agents', agents)
-        rpc_method = 'getfile'
-        rpc_args = {'md5': md5, 'timeout': asyncrequest.deadline - 1}
+        if peer:
+            # agent之间分发, 源地址只需要提供每个zone一份
+            peers = {}
+            for agent_id in agents:
+                metadata = BaseContorller.agent_metadata(agent_id) or {}
+                port = metadata.get('gogamechen3-peer')
+                url = 'http://%s:%d' % (metadata.get('local_ip'), port) if port else None
+                peers[agent_id] = (metadata.get('zone'), url)
+            plan = peer_plan(peers, CONF[common.NAME].objfile_fanout)
+            # peer文件服务只向带有本次分发token的agent提供文件
+            rpc_ctxt.setdefault('peer_token', uuidutils.generate_uuid())
+            rpc_method = 'peer_getfile'
+            rpc_args = {'md5': md5,
+                        'plan': dict([(str(k), v) for k, v in plan.items()]),
+                        'peers': dict([(str(k), v[1]) for k, v in peers.items() if v[1]])}
+        else:
+            target.namespace = manager_common.NAME
+            rpc_method = 'getfile'
+            rpc_args = {'md5': md5, 'timeout': asyncrequest.deadline - 1}
 
         def wapper():
             self.send_asyncrequest(asyncrequest, target,
@@ -376,7 +548,79 @@ class PackageReuest(BaseContorller):
 
     def packages(self, req, body=None):
         body = body or {}
-        areas = body.get('areas', False)
+        areas = bool(body.get('areas', False))
+        ttl = CONF[common.NAME].packages_cache_ttl
+        if not ttl:
+            data, resource_ids = self._packages(areas)
+            return resultutils.results(result='list packages success', data=data)
+
+        snapshot = self._snapshot(areas, ttl)
+        return snapshot.response(req)
+
+    @staticmethod
+    def _kind(areas):
+        return 'packages-areas' if areas else 'packages'
+
+    def _snapshot(self, areas, ttl):
+        kind = self._kind(areas)
+
+        def _build(generation):
+            data, resource_ids = self._packages(areas)
+            items = dict((str(info['package_id']), info) for info in data)
+            revision = record_changelog(kind, items, CONF[common.NAME].changelog_size)
+            ret = resultutils.results(result='list packages success', data=data)
+            ret['generation'] = revision
+            return Snapshot(generation, jsonutils.dumps_as_bytes(ret), resource_ids, items, revision)
+
+        return packages_snapshots.get(kind, _build, ttl)
+
+    def serverlist(self, req, body=None):
+        """最近一次发布的服务器列表静态文件"""
+        info = serverlist.published()
+        if info:
+            info.pop('history', None)
+            info.pop('filenames', None)
+        return resultutils.results(result='get server list success',
+                                   data=[info] if info else [])
+
+    def publish(self, req, body=None):
+        """立即发布服务器列表静态文件"""
+        if not CONF[common.NAME].serverlist_resource:
+            raise InvalidArgument('Server list resource not set')
+        info = serverlist.publish(req)
+        info.pop('history', None)
+        info.pop('filenames', None)
+        return resultutils.results(result='publish server list success', data=[info])
+
+    def changes(self, req, body=None):
+        """返回generation世代之后变化的包与删除的包id, 世代已经不在变更记录中时返回全部包"""
+        body = body or {}
+        areas = bool(body.get('areas', False))
+        try:
+            since = int(body.get('generation'))
+        except (TypeError, ValueError):
+            raise InvalidArgument('Generation value error')
+        ttl = CONF[common.NAME].packages_cache_ttl
+        if not ttl:
+            raise InvalidArgument('Packages cache disabled, changes not supported')
+        snapshot = self._snapshot(areas, ttl)
+        full = False
+        if since == snapshot.revision:
+            changed, removed = [], []
+        else:
+            changes = changelog(self._kind(areas), since, snapshot.items)
+            if changes is None:
+                full = True
+                changed, removed = snapshot.items.values(), []
+            else:
+                changed, removed = changes
+        return resultutils.results(result='list packages changes success',
+                                   data=[dict(generation=snapshot.revision, full=full,
+                                              packages=sorted(changed, key=lambda x: x['package_id']),
+                                              removed=sorted(int(package_id) for package_id in removed))])
+
+    def _packages(self, areas):
+        """包列表, 返回包信息与引用的资源id"""
         session = endpoint_session(readonly=True)
         query = model_query(session, Package, filter=Package.status == common.ENABLE)
         query = query.options(joinedload(Package.files, innerjoin=False))
@@ -467,7 +711,7 @@ class PackageReuest(BaseContorller):
                          if areas_maps[area_id].get('versions') else None)
                     for area_id in sorted(pareas[package.package_id])] if package.package_id in pareas else [])
             data.append(info)
-        return resultutils.results(result='list packages success', data=data)
+        return data, resource_ids
 
     def resources(self, req, group_id, body=None):
         session = endpoint_session(readonly=True)
@@ -29,6 +29,13 @@ class Routers(router.RoutersBase):
                                        collection_actions=COLLECTION_ACTIONS,
                                        member_actions=MEMBER_ACTIONS)
         collection.member.link('send', method='PUT')
+        collection.member.link('manifest', method='GET')
+        # 差分包
+        collection.member.link('delta', name='add_delta', method='POST', action='add_delta')
+        collection.member.link('delta', name='deltas', method='GET', action='deltas')
+        self._add_resource(mapper, objfile_controller,
+                           path='/%s/objfiles/{md5}/delta/{delta}' % common.NAME,
+                           delete_action='del_delta')
 
         resource_name = 'package'
         collection_name = resource_name + 's'
@@ -38,6 +45,15 @@ class Routers(router.RoutersBase):
                            path='/%s/packages' % common.NAME,
                            get_action='packages')
 
+        self._add_resource(mapper, package_controller,
+                           path='/%s/packages/changes' % common.NAME,
+                           get_action='changes')
+
+        self._add_resource(mapper, package_controller,
+                           path='/%s/serverlist' % common.NAME,
+                           get_action='serverlist',
+                           post_action='publish')
+
         self._add_resource(mapper, package_controller,
                            path='/%s/group/{group_id}/resources' % common.NAME,
                            get_action='resources')
@@ -89,6 +105,7 @@ class Routers(router.RoutersBase):
         collection.member.link('maps', method='GET')
         collection.member.link('chiefs', method='GET')
         collection.member.link('areas', method='GET')
+        collection.member.link('areachanges', method='GET')
         collection.member.link('packages', method='GET')
         collection.member.link('area', method='PUT')
         collection.member.link('databases', method='GET')
@@ -119,6 +136,19 @@ class Routers(router.RoutersBase):
                            path='/%s/merge' % common.NAME,
                            post_action='merge')
 
+        self._add_resource(mapper, game_controller,
+                           path='/%s/mergeplan' % common.NAME,
+                           get_action='plan')
+
+        self._add_resource(mapper, game_controller,
+                           path='/%s/metrics' % common.NAME,
+                           get_action='metrics')
+
+        self._add_resource(mapper, game_controller,
+                           path='/%s/profile' % common.NAME,
+                           get_action='profile',
+                           put_action='profile_reset')
+
         self._add_resource(mapper, game_controller,
                            path='/%s/merge/{uuid}' % common.NAME,
                            put_action='continues')
@@ -152,5 +182,8 @@ class Routers(router.RoutersBase):
         collection.member.link('status', method='GET')
         collection.member.link('opentime', method='PUT')
         collection.member.link('upgrade', method='POST')
+        collection.member.link('prepare', method='POST')
+        collection.member.link('commit', method='POST')
+        collection.member.link('rollback', method='POST')
         collection.member.link('flushconfig', method='PUT')
         collection.member.link('hotfix', method='POST')
@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+"""
+服务器列表静态文件
+
+包, 区服, 实体变更后(包列表世代增加)延迟生成每个包与每个平台的服务器列表json
+通过gopcdn上传到serverlist_resource, 文件名带世代, 内容不再变化可以长期缓存
+servers-latest.json记录最新世代与各文件地址, 客户端先读取latest再读取对应文件
+"""
+import os
+import time
+import json
+import shutil
+import tempfile
+import eventlet
+import webob
+
+from simpleutil.log import log as logging
+from simpleutil.config import cfg
+
+from goperation.manager.api import get_cache
+
+from gopcdn.utils import build_fileinfo
+
+from gogamechen3 import common
+
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+
+LATEST = 'servers-latest.json'
+PUBLISHED = 'gogamechen3-serverlist-published'
+PUBLISHLOCK = 'gogamechen3-serverlist-lock'
+
+_scheduled = None
+
+
+def _filename(name, generation):
+    return 'servers-%s-g%d.json' % (name, generation)
+
+
+def _send(uri, path):
+    import websocket
+    ws = websocket.create_connection("ws://%s:%d" % (uri.get('ipaddr'), uri.get('port')),
+                                     subprotocols=["binary"])
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(4096)
+                if not buf:
+                    break
+                ws.send(buf)
+    finally:
+        ws.close()
+
+
+def _upload(req, resource_id, tmp, filename, data):
+    from gogamechen3.api.wsgi.resource import gopcdn_upload
+    path = os.path.join(tmp, filename)
+    with open(path, 'wb') as f:
+        json.dump(data, f, separators=(',', ':'))
+    fileinfo = build_fileinfo(path)
+    uri = gopcdn_upload(req, resource_id, dict(timeout=30), fileinfo=fileinfo)
+    _send(uri, path)
+    return uri.get('filename') or filename
+
+
+def _delete(req, resource_id, filename):
+    from gogamechen3.api.wsgi.resource import cdnresource_controller
+    try:
+        cdnresource_controller.delete_file(req, resource_id, body=dict(filename=filename))
+    except Exception as e:
+        LOG.warning('Delete server list file %s fail, %s' % (filename, e.__class__.__name__))
+
+
+def _replace_latest(req, resource_id, tmp, info):
+    """
+    latest不带世代, 先直接上传覆盖, 客户端始终能读到旧的或者新的latest
+    cdn不允许覆盖(上传失败或者文件名被修改)时才删除后重新上传
+    """
+    try:
+        filename = _upload(req, resource_id, tmp, LATEST, info)
+    except Exception as e:
+        LOG.debug('Overwrite %s fail, %s' % (LATEST, e.__class__.__name__))
+    else:
+        if filename == LATEST:
+            return
+        _delete(req, resource_id, filename)
+    _delete(req, resource_id, LATEST)
+    _upload(req, resource_id, tmp, LATEST, info)
+
+
+def published():
+    """最近一次发布信息"""
+    cache = get_cache()
+    info = cache.get(PUBLISHED)
+    return json.loads(info) if info else None
+
+
+def publish(req):
+    """生成并上传服务器列表, 世代没有变化时不上传"""
+    from gogamechen3.api.wsgi.resource import PackageReuest
+    from gogamechen3.api.wsgi.resource import resource_url
+    from gogamechen3.api.wsgi.caches import resource_cache_map
+    conf = CONF[common.NAME]
+    resource_id = conf.serverlist_resource
+    if not resource_id:
+        return None
+    last = published()
+    snapshot = PackageReuest()._snapshot(True, conf.packages_cache_ttl or 1)
+    generation = snapshot.revision
+    if last and last['generation'] == generation:
+        return last
+    packages = sorted(snapshot.items.values(), key=lambda x: x['package_id'])
+    files = {}
+    tmp = tempfile.mkdtemp(prefix='serverlist-')
+    try:
+        for package in packages:
+            name = 'p%d' % package['package_id']
+            files[name] = _upload(req, resource_id, tmp, _filename(name, generation), package)
+        for platform, value in ((common.ANDROID, common.android), (common.IOS, common.ios)):
+            files[platform] = _upload(req, resource_id, tmp, _filename(platform, generation),
+                                      [package for package in packages if package['platform'] & value])
+        # 加载资源信息, resource_url只读取缓存
+        resource_cache_map(resource_id)
+        info = dict(generation=generation, time=int(time.time()),
+                    files=dict((name, resource_url(resource_id, filename)[0])
+                               for name, filename in files.items()))
+        _replace_latest(req, resource_id, tmp, info)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    info['filenames'] = files.values()
+    history = (last or {}).get('history', [])
+    if last:
+        history.append(last['filenames'])
+    # 删除过期的世代文件
+    while len(history) >= conf.serverlist_keep:
+        for filename in history.pop(0):
+            _delete(req, resource_id, filename)
+    info['history'] = history
+    get_cache().set(PUBLISHED, json.dumps(info))
+    LOG.info('Publish server list of generation %d, %d files' % (generation, len(files)))
+    return info
+
+
+def _run():
+    global _scheduled
+    _scheduled = None
+    cache = get_cache()
+    # 多个进程只有一个发布
+    if not cache.set(PUBLISHLOCK, str(os.getpid()), nx=True, ex=300):
+        schedule()
+        return
+    try:
+        # 后台发布没有请求对象, 用空请求调用gopcdn接口
+        publish(webob.Request.blank('/%s/serverlist' % common.NAME))
+    except Exception:
+        LOG.exception('Publish server list fail')
+    finally:
+        cache.delete(PUBLISHLOCK)
+
+
+def schedule():
+    """延迟发布, 延迟期间的多次变更只发布一次"""
+    global _scheduled
+    if not CONF[common.NAME].serverlist_resource or _scheduled is not None:
+        return
+    _scheduled = eventlet.spawn_after(CONF[common.NAME].serverlist_delay, _run)
@@ -3,15 +3,12 @@ from sqlalchemy.sql import and_
 
 from simpleservice.ormdb.api import model_query
 
-from goperation.manager.wsgi.entity.controller import EntityReuest
-
 from gogamechen3 import common
 from gogamechen3.api import endpoint_session
 from gogamechen3.api import exceptions
+from gogamechen3.api.wsgi.caches import entity_endpoints
 from gogamechen3.models import AppEntity
 
-entity_controller = EntityReuest()
-
 
 def gmurl(req, group_id, interface):
     session = endpoint_session(readonly=True)
@@ -21,13 +18,11 @@ def gmurl(req, group_id, interface):
     gm = query.one_or_none()
     if not gm or gm.status != common.OK:
         raise exceptions.GmSvrHttpError('GM is none or not active' % common.GMSERVER)
-    entityinfo = entity_controller.show(req=req, entity=gm.entity,
-                                        endpoint=common.NAME,
-                                        body={'ports': True})['data'][0]
-    port = entityinfo.get('ports')[0]
-    metadata = entityinfo.get('metadata')
+    entityinfo = entity_endpoints([gm.entity]).get(gm.entity)
+    metadata = entityinfo.get('metadata') if entityinfo else None
     if not metadata:
         raise exceptions.GmSvrHttpError('%s.%d is off line, can not stop by %s' % (gm.objtype, gm.entity, gm.objtype))
+    port = entityinfo.get('ports')[0]
     ipaddr = metadata.get('local_ip')
     url = 'http://%s:%d/%s' % (ipaddr, port, interface)
     return url
@@ -20,6 +20,27 @@ SWALLOWING = 2
 MERGEED = 4
 MERGEFINISH = 5
 
+# 合服不导出的表
+MERGE_NODUMPTABLES = [
+    'battlefield_log_lowfight',
+    'limit_level',
+    'mining_area',
+    'pay_censoring',
+    'player_censoring',
+    'quick_report',
+    'pvp_arena_pet_rank',
+    'var_world',
+    'pvp_cupmatch_fight_log',
+    'oper_record_plot',
+    'timer_boss',
+    'pvp_arena_rank',
+    'pve_campaign_log',
+]
+# 合服只导出一份的表
+MERGE_DUMPONLYONE = [
+    'var_world'
+]
+
 POSTS_COUNT = {
     GAMESERVER: 2,
     GMSERVER: 2,
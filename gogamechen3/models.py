@@ -10,6 +10,7 @@ from sqlalchemy.dialects.mysql import INTEGER
 from sqlalchemy.dialects.mysql import CHAR
 from sqlalchemy.dialects.mysql import ENUM
 from sqlalchemy.dialects.mysql import BLOB
+from sqlalchemy.dialects.mysql import MEDIUMBLOB
 from sqlalchemy.dialects.mysql import MEDIUMINT
 from sqlalchemy.dialects.mysql import BOOLEAN
 from sqlalchemy.dialects.mysql import BIGINT
@@ -116,6 +117,8 @@ class ObjtypeFile(TableBase):
     version = sa.Column(VARCHAR(128), nullable=False)
     # cdn资源id,为None表示外部资源
     resource_id = sa.Column(INTEGER(unsigned=True), nullable=True)
+    # 程序文件清单, zlib压缩的json
+    manifest = sa.Column(MEDIUMBLOB, nullable=True)
 
     __table_args__ = (
         sa.UniqueConstraint('objtype', 'subtype', 'version', name='file_unique'),
@@ -123,6 +126,24 @@ class ObjtypeFile(TableBase):
     )
 
 
+class ObjtypeFileDelta(TableBase):
+    """程序文件差分包, 已有base的agent只下载差分包"""
+    # 差分包文件md5
+    md5 = sa.Column(CHAR(36), nullable=False, primary_key=True)
+    target = sa.Column(sa.ForeignKey('objtypefiles.md5', ondelete="CASCADE", onupdate='RESTRICT'),
+                       nullable=False)
+    base = sa.Column(sa.ForeignKey('objtypefiles.md5', ondelete="CASCADE", onupdate='RESTRICT'),
+                     nullable=False)
+    # 差分包大小
+    size = sa.Column(BIGINT(unsigned=True), nullable=False)
+    resource_id = sa.Column(INTEGER(unsigned=True), nullable=True)
+
+    __table_args__ = (
+        sa.UniqueConstraint('target', 'base', name='delta_unique'),
+        InnoDBTableBase.__table_args__
+    )
+
+
 class AreaDatabase(TableBase):
     quote_id = sa.Column(INTEGER(unsigned=True), nullable=False, primary_key=True)
     database_id = sa.Column(INTEGER(unsigned=True), nullable=False)
@@ -220,5 +241,6 @@ class MergeTask(TableBase):
     entity = sa.Column(INTEGER(unsigned=True), default=0)
     status = sa.Column(TINYINT(64), nullable=False, default=common.MERGEING)
     mergetime = sa.Column(INTEGER(unsigned=True), nullable=False)
+    metrics = sa.Column(BLOB, nullable=True)
     entitys = orm.relationship(MergeEntity, backref='mergetask', lazy='select',
                                cascade='delete,delete-orphan')
@@ -1,4 +1,5 @@
 import re
+import time
 import psutil
 
 from gogamechen3 import common
@@ -22,6 +23,127 @@ def find_process(procnames=None):
     return pids
 
 
+class ProcessIndex(object):
+    """
+    进程索引
+    一次扫描/proc, 以(exe, cwd, username)为键缓存进程信息
+    后续刷新只处理新增和消失的pid
+    """
+    # fork后execve前进程名会变化, 新pid在此时间内会被重复检查
+    # 超过时间后不再检查, 每次刷新只处理变化的pid
+    SETTLE = 10
+    # 完整重建索引间隔, 防止pid复用导致的错误
+    RESCAN = 600
+
+    def __init__(self, procnames=None):
+        if isinstance(procnames, basestring):
+            procnames = [procnames, ]
+        self.procnames = frozenset(procnames or common.ALLTYPES)
+        self.infos = {}
+        self.keys = {}
+        self.paths = {}
+        self.ignores = {}
+        self.scantime = 0
+
+    def __iter__(self):
+        return iter(self.infos.values())
+
+    def __len__(self):
+        return len(self.infos)
+
+    def _examine(self, pid):
+        try:
+            proc = psutil.Process(pid=pid)
+            name = proc.name()
+            if name not in self.procnames:
+                return None
+            exe = proc.exe()
+            if not exe:
+                return None
+            return dict(pid=pid, exe=exe, name=name,
+                        pwd=proc.cwd(), username=proc.username(),
+                        create_time=proc.create_time())
+        except psutil.Error:
+            return None
+
+    def _add(self, info):
+        pid = info.get('pid')
+        self.infos[pid] = info
+        self.keys[(info.get('exe'), info.get('pwd'), info.get('username'))] = pid
+        self.paths.setdefault((info.get('exe'), info.get('pwd')), set()).add(pid)
+
+    def _remove(self, pid):
+        info = self.infos.pop(pid)
+        key = (info.get('exe'), info.get('pwd'), info.get('username'))
+        if self.keys.get(key) == pid:
+            self.keys.pop(key)
+        path = (info.get('exe'), info.get('pwd'))
+        pids = self.paths.get(path)
+        if pids is not None:
+            pids.discard(pid)
+            if not pids:
+                self.paths.pop(path)
+
+    def clear(self):
+        self.infos.clear()
+        self.keys.clear()
+        self.paths.clear()
+        self.ignores.clear()
+        self.scantime = 0
+
+    def refresh(self):
+        """刷新索引, 只检查pid变化部分"""
+        now = time.time()
+        if now - self.scantime > self.RESCAN:
+            self.clear()
+            self.scantime = now
+        pids = set(psutil.pids())
+        for pid in set(self.infos) - pids:
+            self._remove(pid)
+        for pid in set(self.ignores) - pids:
+            self.ignores.pop(pid)
+        for pid in pids:
+            if pid in self.infos:
+                continue
+            seen = self.ignores.get(pid)
+            # 超过SETTLE的非游戏进程不再检查, pid复用或者之后execve的进程由RESCAN重建发现
+            if seen is not None and now - seen > self.SETTLE:
+                continue
+            info = self._examine(pid)
+            if info:
+                self.ignores.pop(pid, None)
+                self._add(info)
+            elif seen is None:
+                self.ignores[pid] = now
+        return self.copy()
+
+    def copy(self):
+        """索引快照, 后续刷新不影响快照"""
+        index = ProcessIndex(self.procnames)
+        index.infos = dict(self.infos)
+        index.keys = dict(self.keys)
+        index.paths = dict((path, set(pids)) for path, pids in self.paths.items())
+        index.scantime = self.scantime
+        return index
+
+    def get(self, pid):
+        return self.infos.get(pid)
+
+    def lookup(self, exe, pwd, username=None):
+        """
+        O(1)查找进程信息
+        不指定username时返回任意一个exe与cwd相同的进程
+        """
+        if username:
+            pid = self.keys.get((exe, pwd, username))
+        else:
+            pids = self.paths.get((exe, pwd))
+            pid = min(pids) if pids else None
+        if pid is None:
+            return None
+        return self.infos.get(pid)
+
+
 def validate_string(value, lower=True):
     if not value:
         raise ValueError('String is empty')
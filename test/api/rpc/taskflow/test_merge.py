@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from gogamechen3.api.rpc.taskflow import merge
+
+
+class FakeTables(object):
+    """模拟目标库行数, 记录count次数"""
+
+    def __init__(self):
+        self.rows = {}
+        self.counts = 0
+
+    def tablerows(self, database, table):
+        self.counts += 1
+        return self.rows.get(table, 0)
+
+
+class MergeCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.stepsfile = os.path.join(self.tmp, 'steps.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _checkpoint(self):
+        checkpoint = merge.MergeCheckpoint(self.stepsfile, dict(steps={1: merge.INSERT, 2: merge.INSERT}))
+        checkpoint.tables[1] = dict(role=dict(state=merge.LOADED, rows=10, base=0))
+        checkpoint.tables[2] = dict(role=dict(state=merge.DUMPED, rows=5, base=None))
+        return checkpoint
+
+    def test_save_load(self):
+        checkpoint = self._checkpoint()
+        checkpoint.data['initialized'] = True
+        checkpoint.save()
+        loaded = merge.MergeCheckpoint.load(self.stepsfile)
+        self.assertEqual(loaded.tables, checkpoint.tables)
+        self.assertTrue(loaded.resumable)
+
+    def test_not_resumable(self):
+        checkpoint = self._checkpoint()
+        self.assertFalse(checkpoint.resumable)
+        checkpoint.data['initialized'] = True
+        checkpoint.tables.pop(2)
+        self.assertFalse(checkpoint.resumable)
+
+    def test_base(self):
+        checkpoint = self._checkpoint()
+        self.assertIsNone(checkpoint.base('role'))
+        checkpoint.initial['role'] = 3
+        self.assertEqual(checkpoint.base('role'), 13)
+
+    def test_reset(self):
+        checkpoint = self._checkpoint()
+        checkpoint.data['initialized'] = True
+        checkpoint.initial['role'] = 3
+        checkpoint.tables[2]['role']['state'] = merge.LOADING
+        checkpoint.reset()
+        self.assertFalse(checkpoint.resumable)
+        self.assertEqual(checkpoint.initial, {})
+        self.assertEqual(checkpoint.tables[1]['role']['state'], merge.DUMPED)
+        self.assertEqual(checkpoint.tables[2]['role']['state'], merge.DUMPED)
+
+
+class InserDbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = FakeTables()
+        self.loads = []
+        self.patched = dict(tablerows=merge.tablerows, load_artifact=merge.load_artifact)
+        merge.tablerows = self.db.tablerows
+        merge.load_artifact = self._load_artifact
+        self.checkpoint = merge.MergeCheckpoint(os.path.join(self.tmp, 'steps.dat'),
+                                                dict(steps={1: merge.INSERT, 2: merge.INSERT}))
+        for entity, rows in ((1, 10), (2, 5)):
+            self.checkpoint.tables[entity] = dict(role=dict(state=merge.DUMPED, rows=rows, base=None))
+            path = os.path.dirname(merge.tablefile(self.tmp, entity, 'role'))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            with open(merge.tablefile(self.tmp, entity, 'role'), 'wb') as f:
+                f.write('insert')
+        self.checkpoint.initial['role'] = 0
+
+    def tearDown(self):
+        for name, func in self.patched.items():
+            setattr(merge, name, func)
+        shutil.rmtree(self.tmp)
+
+    def _load_artifact(self, path, codec, cmd, logfile=None, timeout=None):
+        entity = 1 if merge.sqlpath(1) + os.sep in path else 2
+        self.loads.append(entity)
+        self.db.rows['role'] = self.db.rows.get('role', 0) + self.checkpoint.tables[entity]['role']['rows']
+        with open(logfile, 'wb'):
+            pass
+
+    def _insert(self, entity):
+        return merge.InserDb(entity, [0], self.checkpoint, {})
+
+    def test_load_without_count(self):
+        for entity in (1, 2):
+            self._insert(entity)._load_table(0, self.tmp, {}, 'role', 10, {})
+        self.assertEqual(self.db.counts, 0)
+        self.assertEqual(self.checkpoint.tables[2]['role']['base'], 10)
+        self.assertEqual(self.checkpoint.base('role'), 15)
+        merge.VerifyRows(self.checkpoint).execute({})
+        self.assertEqual(self.db.counts, 1)
+
+    def test_resume_committed(self):
+        # 导入已经提交但是没有记录状态
+        self.checkpoint.tables[1]['role'].update(state=merge.LOADING, base=0)
+        self.db.rows['role'] = 10
+        self._insert(1)._load_table(0, self.tmp, {}, 'role', 10, {})
+        self.assertEqual(self.loads, [])
+        self.assertEqual(self.checkpoint.tables[1]['role']['state'], merge.LOADED)
+
+    def test_resume_not_committed(self):
+        self.checkpoint.tables[1]['role'].update(state=merge.LOADING, base=0)
+        self._insert(1)._load_table(0, self.tmp, {}, 'role', 10, {})
+        self.assertEqual(self.loads, [1])
+        self.assertEqual(self.checkpoint.tables[1]['role']['state'], merge.LOADED)
+
+    def test_resume_mismatch(self):
+        self.checkpoint.tables[1]['role'].update(state=merge.LOADING, base=0)
+        self.db.rows['role'] = 3
+        self.assertRaises(merge.exceptions.MergeException,
+                          self._insert(1)._load_table, 0, self.tmp, {}, 'role', 10, {})
+
+    def test_verify_fail(self):
+        for entity in (1, 2):
+            self._insert(entity)._load_table(0, self.tmp, {}, 'role', 10, {})
+        self.db.rows['role'] -= 1
+        self.assertRaises(merge.exceptions.MergeException,
+                          merge.VerifyRows(self.checkpoint).execute, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
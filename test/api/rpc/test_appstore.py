@@ -0,0 +1,104 @@
+# -*- coding:utf-8 -*-
+import os
+import grp
+import pwd
+import time
+import shutil
+import tempfile
+import unittest
+
+from gogamechen3.api.rpc import appstore
+
+
+def _write(path, data, mode=0o644):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+class AppStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = appstore.AppStore(os.path.join(self.tmp, 'store'))
+        self.user = pwd.getpwuid(os.getuid()).pw_name
+        self.group = grp.getgrgid(os.getgid()).gr_name
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _source(self, name, files):
+        path = os.path.join(self.tmp, name)
+        for relpath, data in files.items():
+            _write(os.path.join(path, relpath), data)
+        return path
+
+    def _objects(self):
+        return [key for prefix in os.listdir(self.store.objects)
+                for key in os.listdir(os.path.join(self.store.objects, prefix))]
+
+    def test_ingest_dedup(self):
+        first = self.store.ingest('v1', self._source('v1', {'bin/gamesvr': 'app', 'conf/a.json': 'conf'}))
+        second = self.store.ingest('v2', self._source('v2', {'bin/gamesvr': 'app', 'conf/a.json': 'new'}))
+        self.assertEqual(first['files']['bin/gamesvr'], second['files']['bin/gamesvr'])
+        self.assertEqual(len(self._objects()), 3)
+        self.assertEqual(self.store.tree('v1'), first)
+        self.assertIsNone(self.store.tree('v3'))
+
+    def test_assemble_share(self):
+        src = self._source('v1', {'bin/gamesvr': 'app', 'conf/a.json': 'conf'})
+        _write(os.path.join(src, 'bin/writable'), 'data', mode=0o664)
+        tree = self.store.ingest('v1', src)
+        dst = os.path.join(self.tmp, 'entity')
+        self.store.assemble(tree, dst, self.user, self.group)
+        obj = self.store._object(tree['files']['bin/gamesvr'])
+        # 不可修改的文件与存储共享inode
+        self.assertTrue(os.path.samefile(obj, os.path.join(dst, 'bin/gamesvr')))
+        # 配置文件与组可写的文件是独立副本
+        for relpath in ('conf/a.json', 'bin/writable'):
+            path = os.path.join(dst, relpath)
+            self.assertFalse(os.path.samefile(self.store._object(tree['files'][relpath]), path))
+            self.assertEqual(os.stat(path).st_nlink, 1)
+        with open(os.path.join(dst, 'conf/a.json'), 'rb') as f:
+            self.assertEqual(f.read(), 'conf')
+
+    def test_assemble_replace(self):
+        tree = self.store.ingest('v1', self._source('v1', {'bin/gamesvr': 'app', 'conf/a.json': 'conf'}))
+        dst = os.path.join(self.tmp, 'entity')
+        self.store.assemble(tree, dst, self.user, self.group)
+        conf = os.stat(os.path.join(dst, 'conf/a.json')).st_ino
+        tree = self.store.ingest('v2', self._source('v2', {'bin/gamesvr': 'new', 'conf/a.json': 'conf'}))
+        self.store.assemble(tree, dst, self.user, self.group)
+        with open(os.path.join(dst, 'bin/gamesvr'), 'rb') as f:
+            self.assertEqual(f.read(), 'new')
+        # 旧版本存储对象不被修改
+        with open(self.store._object(self.store.tree('v1')['files']['bin/gamesvr']), 'rb') as f:
+            self.assertEqual(f.read(), 'app')
+        # 没有变化的副本跳过
+        self.assertEqual(os.stat(os.path.join(dst, 'conf/a.json')).st_ino, conf)
+        self.assertFalse(os.path.exists(os.path.join(dst, 'bin/gamesvr.store-tmp')))
+
+    def test_gc(self):
+        old = self.store.ingest('v1', self._source('v1', {'bin/gamesvr': 'old'}))
+        new = self.store.ingest('v2', self._source('v2', {'bin/gamesvr': 'new'}))
+        dst = os.path.join(self.tmp, 'entity')
+        self.store.assemble(old, dst, self.user, self.group)
+        shutil.rmtree(os.path.join(self.tmp, 'v1'))
+        shutil.rmtree(os.path.join(self.tmp, 'v2'))
+        past = time.time() - 3600
+        os.utime(self.store._treefile('v1'), (past, past))
+        self.store.gc(60)
+        self.assertFalse(os.path.exists(self.store._treefile('v1')))
+        # 实体程序目录仍然链接的对象保留
+        self.assertTrue(os.path.exists(self.store._object(old['files']['bin/gamesvr'])))
+        self.assertTrue(os.path.exists(self.store._object(new['files']['bin/gamesvr'])))
+        shutil.rmtree(dst)
+        self.store.gc(60)
+        self.assertFalse(os.path.exists(self.store._object(old['files']['bin/gamesvr'])))
+        self.assertEqual(len(self._objects()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import eventlet
+from eventlet import wsgi
+
+from gogamechen3.api.rpc import download
+
+
+CHUNK = 1024
+RANGE = re.compile('^bytes=(\d+)-(\d+)$')
+
+
+class RangeServer(object):
+    """支持range的文件服务, broken中的分段返回500"""
+
+    def __init__(self, data):
+        self.data = data
+        self.broken = set()
+        self.requests = []
+        self.sock = eventlet.listen(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%d/file' % self.sock.getsockname()[1]
+        self.thread = eventlet.spawn(wsgi.server, self.sock, self, log_output=False)
+
+    def __call__(self, environ, start_response):
+        size = len(self.data)
+        match = re.match(RANGE, environ.get('HTTP_RANGE', ''))
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            start_response('200 OK', [('Content-Length', str(size)), ('Accept-Ranges', 'bytes')])
+            return []
+        start, end = int(match.group(1)), int(match.group(2))
+        self.requests.append(start // CHUNK)
+        if start // CHUNK in self.broken:
+            start_response('500 Internal Server Error', [('Content-Length', '0')])
+            return []
+        start_response('206 Partial Content',
+                       [('Content-Length', str(end - start + 1)),
+                        ('Content-Range', 'bytes %d-%d/%d' % (start, end, size))])
+        return [self.data[start:end + 1]]
+
+    def stop(self):
+        self.thread.kill()
+        self.sock.close()
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data = os.urandom(CHUNK * 3 + 10)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.path = os.path.join(self.tmp, self.md5)
+        self.server = RangeServer(self.data)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def _downloader(self):
+        return download.Downloader([self.server.url], self.path, self.md5,
+                                   connections=2, chunk=CHUNK)
+
+    def test_download(self):
+        self._downloader().run(30)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(self.path + '.state'))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_resume(self):
+        self.server.broken.add(2)
+        self.assertRaises(download.DownloadError, self._downloader().run, 30)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(self.path + '.state'))
+        # 续传只下载失败的分段
+        self.server.broken.clear()
+        del self.server.requests[:]
+        downloader = self._downloader()
+        downloader.run(30)
+        self.assertEqual(downloader.resumed, 3)
+        self.assertEqual(self.server.requests, [2])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_md5_not_match(self):
+        downloader = download.Downloader([self.server.url], self.path, '0' * 32,
+                                         connections=2, chunk=CHUNK)
+        self.assertRaises(download.DownloadError, downloader.run, 30)
+        self.assertFalse(os.path.exists(self.path + '.state'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding:utf-8 -*-
+import time
+import shutil
+import tempfile
+import unittest
+
+from gogamechen3.api.rpc import peer
+
+
+class PeerTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.peerfiles = peer.PeerFiles(self.tmp, None)
+
+    def tearDown(self):
+        peer._peerfiles = None
+        shutil.rmtree(self.tmp)
+
+    def test_multi_send(self):
+        now = time.time()
+        self.peerfiles.allow('a' * 32, 'first', now + 60)
+        self.peerfiles.allow('a' * 32, 'second', now + 60)
+        # 第二次分发不覆盖第一次的token
+        self.assertTrue(self.peerfiles._authorized('a' * 32, 'first'))
+        self.assertTrue(self.peerfiles._authorized('a' * 32, 'second'))
+        self.assertFalse(self.peerfiles._authorized('a' * 32, 'third'))
+        self.assertFalse(self.peerfiles._authorized('b' * 32, 'first'))
+        self.assertFalse(self.peerfiles._authorized('a' * 32, None))
+
+    def test_expire(self):
+        now = time.time()
+        self.peerfiles.allow('a' * 32, 'old', now - 1)
+        self.peerfiles.allow('a' * 32, 'new', now + 60)
+        self.assertFalse(self.peerfiles._authorized('a' * 32, 'old'))
+        self.assertTrue(self.peerfiles._authorized('a' * 32, 'new'))
+        # 过期的token在下一次分发时清理
+        self.peerfiles.allow('b' * 32, 'other', now + 60)
+        self.assertEqual(list(self.peerfiles.tokens['a' * 32]), ['new'])
+        self.peerfiles.allow('a' * 32, None, now)
+        self.assertEqual(set(self.peerfiles.tokens), set(['a' * 32, 'b' * 32]))
+
+
+if __name__ == '__main__':
+    unittest.main()
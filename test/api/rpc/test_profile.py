@@ -0,0 +1,29 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+from gogamechen3.api.rpc import profile
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = profile.Histogram()
+        for value in (0.001, 0.01, 0.02, 2, 100):
+            histogram.add(value)
+        info = histogram.to_dict()
+        self.assertEqual(info['count'], 5)
+        self.assertEqual(info['max'], 100)
+        self.assertEqual(info['buckets']['<=0.01'], 2)
+        self.assertEqual(info['buckets']['<=0.05'], 1)
+        self.assertEqual(info['buckets']['<=5'], 1)
+        self.assertEqual(info['buckets']['>%s' % profile.BUCKETS[-1]], 1)
+        self.assertEqual(sum(info['buckets'].values()), 5)
+
+    def test_empty(self):
+        info = profile.Histogram().to_dict()
+        self.assertEqual(info['count'], 0)
+        self.assertEqual(info['avg'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from goperation.manager.rpc.exceptions import RpcEntityError
+
+from gogamechen3 import common
+from gogamechen3.api import rpc
+
+
+def _write(path, data):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class FakeEndpoint(object):
+    """只使用Application中版本目录相关的方法"""
+
+    releasepath = rpc.Application.releasepath
+    release_root = rpc.Application.release_root.__func__
+    current_release = rpc.Application.current_release.__func__
+    previous_release = rpc.Application.previous_release.__func__
+    entity_release = rpc.Application.entity_release.__func__
+    switch_release = rpc.Application.switch_release.__func__
+    rollback_release = rpc.Application.rollback_release.__func__
+    clear_release = rpc.Application.clear_release.__func__
+
+    def __init__(self, root):
+        self.endpoint_backup = os.path.join(root, 'backup')
+        self.root = root
+        self.pruned = []
+
+    def _objtype(self, entity):
+        return common.GAMESERVER
+
+    def entity_home(self, entity):
+        return os.path.join(self.root, 'entity', str(entity))
+
+    def apppath(self, entity):
+        return os.path.join(self.entity_home(entity), 'gogame')
+
+    def prune_releases(self, objtype):
+        self.pruned.append(objtype)
+
+
+class ReleaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.endpoint = FakeEndpoint(self.tmp)
+        root = self.endpoint.release_root(common.GAMESERVER)
+        for name in ('a', 'b'):
+            _write(os.path.join(root, name, 'bin', 'gamesvr'), name)
+            _write(os.path.join(root, name, 'conf', 'app.json'), name)
+        self.apppath = self.endpoint.apppath(1)
+        _write(os.path.join(self.apppath, 'bin', 'gamesvr'), 'legacy')
+        _write(os.path.join(self.apppath, 'conf', 'app.json'), 'entity')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_switch(self):
+        self.endpoint.switch_release(1, 'a')
+        self.assertEqual(self.endpoint.entity_release(1), 'a')
+        self.assertTrue(os.path.islink(os.path.join(self.apppath, 'bin')))
+        self.assertEqual(_read(os.path.join(self.apppath, 'bin', 'gamesvr')), 'a')
+        # 配置由实体自己保存
+        self.assertFalse(os.path.islink(os.path.join(self.apppath, 'conf')))
+        legacy = os.path.join(self.endpoint.entity_home(1), 'legacy')
+        self.assertEqual(_read(os.path.join(legacy, 'bin', 'gamesvr')), 'legacy')
+        self.assertFalse(os.path.lexists(self.endpoint.previous_release(1)))
+
+        self.endpoint.switch_release(1, 'b')
+        self.assertEqual(self.endpoint.entity_release(1), 'b')
+        self.assertEqual(_read(os.path.join(self.apppath, 'bin', 'gamesvr')), 'b')
+        self.assertEqual(os.path.basename(os.path.realpath(self.endpoint.previous_release(1))), 'a')
+        self.assertFalse(os.path.exists(legacy))
+        self.assertEqual(self.endpoint.pruned, [common.GAMESERVER, common.GAMESERVER])
+
+    def test_rollback(self):
+        self.assertRaises(RpcEntityError, self.endpoint.rollback_release, 1)
+        self.endpoint.switch_release(1, 'a')
+        self.endpoint.switch_release(1, 'b')
+        self.endpoint.rollback_release(1)
+        self.assertEqual(self.endpoint.entity_release(1), 'a')
+        self.assertEqual(_read(os.path.join(self.apppath, 'bin', 'gamesvr')), 'a')
+        self.assertEqual(os.path.basename(os.path.realpath(self.endpoint.previous_release(1))), 'b')
+
+    def test_switch_not_prepared(self):
+        self.assertRaises(RpcEntityError, self.endpoint.switch_release, 1, 'c')
+        self.assertIsNone(self.endpoint.entity_release(1))
+
+    def test_clear(self):
+        self.assertFalse(self.endpoint.clear_release(1))
+        self.endpoint.switch_release(1, 'a')
+        self.endpoint.switch_release(1, 'b')
+        self.assertTrue(self.endpoint.clear_release(1))
+        self.assertIsNone(self.endpoint.entity_release(1))
+        self.assertFalse(os.path.lexists(self.endpoint.previous_release(1)))
+        # 共享版本不受影响
+        root = self.endpoint.release_root(common.GAMESERVER)
+        self.assertEqual(_read(os.path.join(root, 'a', 'bin', 'gamesvr')), 'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
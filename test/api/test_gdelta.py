@@ -0,0 +1,119 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+from gogamechen3.api import gdelta
+
+
+def _tar(path, files, links=None):
+    """files为{名称: 内容}, 内容为None时是目录"""
+    with tarfile.open(path, 'w:gz') as objtarget:
+        for name in sorted(files):
+            tarinfo = tarfile.TarInfo(name)
+            data = files[name]
+            if data is None:
+                tarinfo.type = tarfile.DIRTYPE
+                tarinfo.mode = 0o755
+                objtarget.addfile(tarinfo)
+            else:
+                tarinfo.size = len(data)
+                tarinfo.mode = 0o644
+                objtarget.addfile(tarinfo, _Reader(data))
+        for name, target in (links or {}).items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = target
+            objtarget.addfile(tarinfo)
+    return path
+
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, size=None):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+class GdeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.base = _tar(os.path.join(self.tmp, 'base.tar.gz'),
+                         {'bin': None, 'bin/gamesvr': 'a' * 4096, 'bin/old': 'old'})
+        self.target = _tar(os.path.join(self.tmp, 'target.tar.gz'),
+                           {'bin': None, 'bin/gamesvr': 'a' * 4096, 'bin/new': 'new'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _members(self, path):
+        dst = os.path.join(self.tmp, 'members')
+        shutil.rmtree(dst, ignore_errors=True)
+        members = gdelta._extract(path, dst)
+        data = {}
+        for name, isdir in members:
+            if not isdir:
+                with open(os.path.join(dst, name), 'rb') as f:
+                    data[name] = f.read()
+        return data
+
+    def test_build_apply(self):
+        delta = os.path.join(self.tmp, 'delta.tar.gz')
+        info = gdelta.build(self.base, self.target, delta)
+        ops = dict((member['name'], member.get('op')) for member in info['members'])
+        self.assertEqual(ops['bin/gamesvr'], gdelta.KEEP)
+        self.assertEqual(ops['bin/new'], gdelta.ADD)
+        self.assertEqual(gdelta.manifest(delta)['target'], info['target'])
+        output = os.path.join(self.tmp, 'output.tar.gz')
+        gdelta.apply(self.base, delta, output)
+        self.assertEqual(self._members(output), self._members(self.target))
+
+    def test_apply_base_mismatch(self):
+        delta = os.path.join(self.tmp, 'delta.tar.gz')
+        gdelta.build(self.base, self.target, delta)
+        self.assertRaises(gdelta.DeltaError, gdelta.apply, self.target, delta,
+                          os.path.join(self.tmp, 'output.tar.gz'))
+
+    def test_extract_traversal(self):
+        dst = os.path.join(self.tmp, 'dst')
+        for files in ({'../evil': 'x'}, {'/tmp/evil': 'x'}, {'bin/../../evil': 'x'}):
+            path = _tar(os.path.join(self.tmp, 'evil.tar.gz'), files)
+            self.assertRaises(gdelta.DeltaError, gdelta._extract, path, dst)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'evil')))
+
+    def test_extract_zip_traversal(self):
+        path = os.path.join(self.tmp, 'evil.zip')
+        with zipfile.ZipFile(path, 'w') as objtarget:
+            objtarget.writestr('../evil', 'x')
+        self.assertRaises(gdelta.DeltaError, gdelta._extract, path, os.path.join(self.tmp, 'dst'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'evil')))
+
+    def test_extract_link(self):
+        path = _tar(os.path.join(self.tmp, 'link.tar.gz'), {'bin': None},
+                    links={'bin/link': '/etc'})
+        self.assertRaises(gdelta.DeltaError, gdelta._extract, path, os.path.join(self.tmp, 'dst'))
+
+    def test_apply_member_traversal(self):
+        info = dict(base=gdelta.filemd5(self.base), target='', format='gz',
+                    members=[dict(name='../evil', op=gdelta.ADD, md5='', mode=0o644)])
+        delta = _tar(os.path.join(self.tmp, 'delta.tar.gz'),
+                     {gdelta.DELTAFILE: json.dumps(info), 'add/../evil': 'x'})
+        self.assertRaises(gdelta.DeltaError, gdelta.apply, self.base, delta,
+                          os.path.join(self.tmp, 'output.tar.gz'))
+        info['members'][0]['name'] = '../evil'
+        delta = _tar(os.path.join(self.tmp, 'delta.tar.gz'), {gdelta.DELTAFILE: json.dumps(info)})
+        self.assertRaises(gdelta.DeltaError, gdelta.apply, self.base, delta,
+                          os.path.join(self.tmp, 'output.tar.gz'))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'evil')))
+
+
+if __name__ == '__main__':
+    unittest.main()
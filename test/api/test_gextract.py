@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+from gogamechen3.api import gextract
+
+
+class Member(object):
+
+    def __init__(self, filename, file_size):
+        self.filename = filename
+        self.file_size = file_size
+
+
+class SplitTest(unittest.TestCase):
+
+    def test_balance(self):
+        infos = [Member('a', 100), Member('b', 60), Member('c', 50), Member('d', 10)]
+        parts = gextract._split(infos, 2)
+        self.assertEqual(len(parts), 2)
+        sizes = dict((info.filename, info.file_size) for info in infos)
+        totals = sorted(sum(sizes[name] for name in names) for names in parts)
+        self.assertEqual(totals, [110, 110])
+
+    def test_all_members(self):
+        infos = [Member(str(index), index) for index in range(20)]
+        parts = gextract._split(infos, 4)
+        names = [name for names in parts for name in names]
+        self.assertEqual(sorted(names), sorted(info.filename for info in infos))
+
+    def test_no_empty_worker(self):
+        infos = [Member('a', 1), Member('b', 1)]
+        parts = gextract._split(infos, 8)
+        self.assertEqual(len(parts), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
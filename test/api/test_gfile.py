@@ -0,0 +1,66 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from gogamechen3 import common
+from gogamechen3.api import gfile
+
+
+MD5 = 'a' * 32
+
+
+def _zip(path, names):
+    with zipfile.ZipFile(path, 'w') as objtarget:
+        for name in names:
+            objtarget.writestr(name, '' if name.endswith('/') else name)
+    return path
+
+
+class GfileCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.appfile = _zip(os.path.join(self.tmp, 'app.zip'),
+                            ['bin/', 'bin/gamesvr', 'config/', 'config/a.json'])
+        self.indexpath = gfile._indexpath
+
+    def tearDown(self):
+        gfile._indexpath = self.indexpath
+        shutil.rmtree(self.tmp)
+
+    def test_check(self):
+        self.assertFalse(gfile.check(common.GAMESERVER, self.appfile))
+        self.assertRaises(ValueError, gfile.check, common.GMSERVER, self.appfile)
+        self.assertRaises(ValueError, gfile.check, 'unknown', self.appfile)
+
+    def test_index(self):
+        gfile.set_indexpath(os.path.join(self.tmp, 'index'))
+        info = gfile.index(self.appfile, MD5)
+        self.assertEqual(info['members'][1], ['bin/gamesvr', len('bin/gamesvr')])
+        self.assertTrue(os.path.exists(gfile._indexfile(MD5)))
+        # 有索引后不再读取压缩包
+        os.remove(self.appfile)
+        self.assertEqual(gfile.index(self.appfile, MD5)['members'], info['members'])
+        self.assertFalse(gfile.check(common.GAMESERVER, self.appfile, MD5))
+        # 只缓存成员列表, 检查规则按objtype执行
+        self.assertRaises(ValueError, gfile.check, common.GMSERVER, self.appfile, MD5)
+
+    def test_index_broken(self):
+        gfile.set_indexpath(os.path.join(self.tmp, 'index'))
+        with open(gfile._indexfile(MD5), 'wb') as f:
+            f.write('{broken')
+        self.assertTrue(gfile.check(common.GAMESERVER, self.appfile, MD5))
+        # 重建后索引可用
+        self.assertFalse(gfile.check(common.GAMESERVER, self.appfile, MD5))
+
+    def test_check_manifest(self):
+        gfile.check_manifest(common.GAMESERVER, dict(dirs=['bin'], files={'bin/gamesvr': [1, MD5]}))
+        self.assertRaises(ValueError, gfile.check_manifest, common.GAMESERVER,
+                          dict(dirs=['bin'], files={'lib/evil.so': [1, MD5]}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+from gogamechen3.api.wsgi import caches
+
+
+class FakeCache(object):
+    """changelog用到的redis命令"""
+
+    def __init__(self):
+        self.data = {}
+
+    def hgetall(self, name):
+        return dict(self.data.get(name, {}))
+
+    def hmset(self, name, mapping):
+        self.data[name] = dict(mapping)
+
+    def rpush(self, name, value):
+        self.data.setdefault(name, []).append(str(value))
+        return len(self.data[name])
+
+    def lindex(self, name, index):
+        values = self.data.get(name, [])
+        try:
+            return values[index]
+        except IndexError:
+            return None
+
+    def lrange(self, name, start, end):
+        return self.data.get(name, [])[start:end + 1]
+
+    def ltrim(self, name, start, end):
+        values = self.data.get(name, [])
+        self.data[name] = values[start:] if end == -1 else values[start:end + 1]
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def incr(self, name):
+        self.data[name] = self.data.get(name, 0) + 1
+        return self.data[name]
+
+
+class ChangelogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = FakeCache()
+        self.get_cache = caches.get_cache
+        caches.get_cache = lambda: self.cache
+
+    def tearDown(self):
+        caches.get_cache = self.get_cache
+
+    def test_changes(self):
+        revision = caches.record_changelog('test', {'1': dict(id=1, name='a'),
+                                                    '2': dict(id=2, name='b')}, 10)
+        changed, removed = caches.changelog('test', revision, {'1': dict(id=1, name='c'),
+                                                               '3': dict(id=3, name='d')})
+        self.assertEqual(sorted(item['id'] for item in changed), [1, 3])
+        self.assertEqual(removed, ['2'])
+
+    def test_unchanged(self):
+        items = {'1': dict(id=1)}
+        revision = caches.record_changelog('test', items, 10)
+        self.assertEqual(caches.record_changelog('test', items, 10), revision)
+        self.assertEqual(caches.changelog('test', revision, items), ([], []))
+
+    def test_revision(self):
+        first = caches.record_changelog('test', {'1': dict(id=1)}, 10)
+        second = caches.record_changelog('test', {'1': dict(id=2)}, 10)
+        self.assertEqual(second, first + 1)
+        # 不修改共享的包列表世代
+        self.assertNotIn(caches.PACKAGES_GENERATION, self.cache.data)
+
+    def test_empty(self):
+        revision = caches.record_changelog('test', {}, 10)
+        changed, removed = caches.changelog('test', revision, {'1': dict(id=1)})
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(removed, [])
+
+    def test_expired(self):
+        revisions = [caches.record_changelog('test', {'1': dict(id=index)}, 2) for index in range(4)]
+        self.assertIsNone(caches.changelog('test', revisions[0], {}))
+        self.assertIsNone(caches.changelog('test', revisions[1], {}))
+        self.assertIsNotNone(caches.changelog('test', revisions[3], {}))
+
+    def test_unknown_revision(self):
+        self.assertIsNone(caches.changelog('test', 100, {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
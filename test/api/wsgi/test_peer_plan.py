@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+from gogamechen3.api.wsgi.resource import peer_plan
+
+
+class PeerPlanTest(unittest.TestCase):
+
+    def test_zone_root(self):
+        agents = {1: ('a', 'http://1'), 2: ('a', 'http://2'),
+                  3: ('b', 'http://3'), 4: ('b', 'http://4')}
+        plan = peer_plan(agents, 2)
+        # 每个zone第一个agent从源地址下载
+        self.assertIsNone(plan[1])
+        self.assertIsNone(plan[3])
+        self.assertEqual(plan[2], 1)
+        self.assertEqual(plan[4], 3)
+
+    def test_fanout(self):
+        agents = dict((agent_id, ('a', 'http://%d' % agent_id)) for agent_id in range(1, 8))
+        plan = peer_plan(agents, 2)
+        children = {}
+        for agent_id, parent in plan.items():
+            if parent is not None:
+                children.setdefault(parent, []).append(agent_id)
+        self.assertEqual(len(plan), 7)
+        self.assertTrue(all(len(agent_ids) <= 2 for agent_ids in children.values()))
+        # 每个agent都能追溯到根
+        for agent_id in plan:
+            seen = set()
+            while plan[agent_id] is not None:
+                self.assertNotIn(agent_id, seen)
+                seen.add(agent_id)
+                agent_id = plan[agent_id]
+
+    def test_no_peer_address(self):
+        agents = {1: ('a', None), 2: ('a', 'http://2'), 3: ('a', 'http://3')}
+        plan = peer_plan(agents, 2)
+        self.assertIsNone(plan[1])
+        self.assertIsNone(plan[2])
+        self.assertEqual(plan[3], 2)
+        self.assertNotIn(1, plan.values())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+import unittest
+
+import psutil
+
+from gogamechen3 import utils
+
+
+class FakeProcess(object):
+
+    def __init__(self, pid, name, exe='', cwd='/', username='root', create_time=1.0):
+        self.pid = pid
+        self._name = name
+        self._exe = exe
+        self._cwd = cwd
+        self._username = username
+        self._create_time = create_time
+
+    def name(self):
+        return self._name
+
+    def exe(self):
+        return self._exe
+
+    def cwd(self):
+        return self._cwd
+
+    def username(self):
+        return self._username
+
+    def create_time(self):
+        return self._create_time
+
+
+class ProcessIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.procs = {}
+        self.examined = []
+        self.pids = psutil.pids
+        self.process = psutil.Process
+        self.time = utils.time.time
+        self.now = 1000.0
+        psutil.pids = lambda: list(self.procs)
+        utils.time.time = lambda: self.now
+
+        def _process(pid):
+            self.examined.append(pid)
+            try:
+                return self.procs[pid]
+            except KeyError:
+                raise psutil.NoSuchProcess(pid)
+
+        psutil.Process = _process
+
+    def tearDown(self):
+        psutil.pids = self.pids
+        psutil.Process = self.process
+        utils.time.time = self.time
+
+    def _game(self, pid, pwd):
+        self.procs[pid] = FakeProcess(pid, 'gamesvr', exe='/data/bin/gamesvr', cwd=pwd,
+                                      username='gogamechen3-1')
+
+    def test_lookup(self):
+        self._game(10, '/data/1')
+        self.procs[11] = FakeProcess(11, 'bash')
+        index = utils.ProcessIndex()
+        snapshot = index.refresh()
+        info = snapshot.lookup('/data/bin/gamesvr', '/data/1', 'gogamechen3-1')
+        self.assertEqual(info['pid'], 10)
+        self.assertEqual(snapshot.lookup('/data/bin/gamesvr', '/data/1')['pid'], 10)
+        self.assertIsNone(snapshot.lookup('/data/bin/gamesvr', '/data/2'))
+
+    def test_exit(self):
+        self._game(10, '/data/1')
+        index = utils.ProcessIndex()
+        index.refresh()
+        self.procs.pop(10)
+        self.assertIsNone(index.refresh().lookup('/data/bin/gamesvr', '/data/1'))
+
+    def test_snapshot(self):
+        self._game(10, '/data/1')
+        index = utils.ProcessIndex()
+        snapshot = index.refresh()
+        self.procs.pop(10)
+        index.refresh()
+        # 快照不受后续刷新影响
+        self.assertEqual(snapshot.lookup('/data/bin/gamesvr', '/data/1')['pid'], 10)
+
+    def test_exec_in_settle(self):
+        # fork后execve前是其他进程名
+        self.procs[10] = FakeProcess(10, 'python')
+        index = utils.ProcessIndex()
+        index.refresh()
+        self._game(10, '/data/1')
+        self.now += index.SETTLE / 2.0
+        self.assertEqual(index.refresh().lookup('/data/bin/gamesvr', '/data/1')['pid'], 10)
+
+    def test_settled_not_examined(self):
+        self.procs[11] = FakeProcess(11, 'bash')
+        index = utils.ProcessIndex()
+        index.refresh()
+        self.now += index.SETTLE + 1
+        index.refresh()
+        del self.examined[:]
+        self.now += 1
+        index.refresh()
+        # 没有变化的pid不再读取进程信息
+        self.assertEqual(self.examined, [])
+
+    def test_rescan(self):
+        self.procs[10] = FakeProcess(10, 'python')
+        index = utils.ProcessIndex()
+        index.refresh()
+        self.now += index.SETTLE + 1
+        index.refresh()
+        self._game(10, '/data/1')
+        self.assertIsNone(index.refresh().lookup('/data/bin/gamesvr', '/data/1'))
+        self.now += index.RESCAN + 1
+        self.assertEqual(index.refresh().lookup('/data/bin/gamesvr', '/data/1')['pid'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()